@@ -0,0 +1,285 @@
+"""
+JSON API (/api/v1) สำหรับ client ที่ไม่อยากโหลดหน้า HTML ทั้งหน้า / โดน redirect หลังทุก POST
+
+- ต้อง login (cookie session เดียวกับหน้าเว็บ); ไม่ได้ login -> 401 JSON ไม่ redirect ไปหน้า login
+- ?fields=title,artist เลือกเฉพาะ field ของแต่ละ item ใน list (ลดขนาด response)
+- JSON แบบ compact (ไม่มีช่องว่าง, ภาษาไทยไม่ถูก escape เป็น \\uXXXX)
+- การแก้ไขตอบผลลัพธ์ในตัว (201 + ข้อมูล / 204) ไม่ต้องยิง request ซ้ำเพื่อดูผล
+- error เป็น JSON เสมอ ({"error": ...}); Last.fm: ไม่พบ = 404, ล่ม/ถูกจำกัด = 503, อื่นๆ = 502
+
+    GET    /search?q=&mode=genre|artist&limit=
+    GET    /tags/<tag>/tracks?limit=
+    GET    /artists/<name>/tracks?limit=
+    GET    /artists/<name>/similar?limit=&min_match=
+    GET    /playlists                      POST /playlists {name, description, is_public}
+    GET    /playlists/<id>                 PATCH /playlists/<id>   DELETE /playlists/<id>
+    GET    /playlists/<id>/tracks?after=&limit=
+    POST   /playlists/<id>/tracks {title, artist, url, mbid, index} หรือ {tracks: [...]}
+    DELETE /playlists/<id>/tracks          (ล้างทั้งเพลย์ลิสต์)
+    DELETE /playlists/<id>/tracks/<tid>
+    POST   /playlists/<id>/tracks/<tid>/move {index} หรือ {direction: up|down}
+"""
+from __future__ import annotations
+import json
+from typing import Any, Iterable, Optional
+
+from flask import Blueprint, Response, request
+from flask_login import current_user
+
+from circuit import CircuitOpenError
+from lastfm import LastFMError
+from models import Track
+from ratelimit import RateLimitExceeded
+
+API_MAX_LIMIT = 200
+TRACKS_PAGE_DEFAULT = 100
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _json(data: Any, status: int = 200) -> Response:
+    body = json.dumps(data, separators=(",", ":"), ensure_ascii=False, default=str)
+    return Response(body, status=status, mimetype="application/json")
+
+
+def _fields() -> Optional[set]:
+    raw = request.args.get("fields", "")
+    return {f.strip() for f in raw.split(",") if f.strip()} or None
+
+
+def _select(items: Iterable[dict]) -> list:
+    fields = _fields()
+    if fields is None:
+        return list(items)
+    return [{k: v for k, v in item.items() if k in fields} for item in items]
+
+
+def _limit(default: int) -> int:
+    return max(1, min(request.args.get("limit", default, type=int), API_MAX_LIMIT))
+
+
+def _body() -> dict:
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise ApiError(400, "expected a JSON object body")
+    return data
+
+
+def _lastfm_error(e: Exception) -> ApiError:
+    """error จาก LastFMClient -> status: ไม่พบ (error 6) = 404, ล่ม/ถูกจำกัด = 503, อื่นๆ = 502"""
+    if isinstance(e, LastFMError) and str(e.code) == "6":
+        return ApiError(404, f"Last.fm: {e}")
+    if isinstance(e, (CircuitOpenError, RateLimitExceeded)) or \
+            (isinstance(e, LastFMError) and str(e.code) == "29"):
+        return ApiError(503, f"Last.fm: {e}")
+    return ApiError(502, f"Last.fm: {e}")
+
+
+def _is_public(data: dict, default: bool) -> bool:
+    # ต้องเป็น JSON boolean จริง: bool("false") = True จะทำให้เพลย์ลิสต์ถูกเปิด public โดยไม่ตั้งใจ
+    value = data.get("is_public", default)
+    if not isinstance(value, bool):
+        raise ApiError(400, "is_public must be a boolean")
+    return value
+
+
+def _is_index(value) -> bool:
+    # bool เป็น subclass ของ int -> true/false ไม่นับเป็น index
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _track(data: dict) -> Track:
+    title = (data.get("title") or "").strip()
+    artist = (data.get("artist") or "").strip()
+    if not title or not artist:
+        raise ApiError(400, "title and artist are required")
+    return Track(title=title, artist=artist, url=data.get("url") or None, mbid=data.get("mbid") or None)
+
+
+def create_api(repo, playlist, lastfm_client) -> Blueprint:
+    """Blueprint ของ /api/v1 (app.register_blueprint(create_api(...), url_prefix="/api/v1"))"""
+    api = Blueprint("api", __name__)
+
+    def uid() -> int:
+        return int(current_user.id)
+
+    def owned(playlist_id: int) -> dict:
+        pl = playlist.get_playlist(playlist_id, uid())
+        if not pl:
+            raise ApiError(404, "playlist not found")
+        return pl
+
+    def lastfm_list(items: list, key: str) -> Response:
+        # stale = มาจาก cache ที่หมดอายุ (Last.fm ช้า/ล่มอยู่)
+        return _json({key: _select(items), "stale": bool(getattr(items, "stale", False))})
+
+    @api.before_request
+    def _require_login():
+        if not current_user.is_authenticated:
+            return _json({"error": "login required"}, 401)
+
+    @api.errorhandler(ApiError)
+    def _api_error(e: ApiError):
+        return _json({"error": e.message}, e.status)
+
+    @api.errorhandler(PermissionError)
+    def _forbidden(e):
+        return _json({"error": "playlist not found"}, 404)
+
+    @api.errorhandler(404)
+    @api.errorhandler(405)
+    def _http_error(e):
+        return _json({"error": e.description}, e.code)
+
+    # URL ที่ไม่ match route ไหนเลยไม่ผ่าน handler ของ blueprint -> ดักที่ระดับ app แล้วตอบ JSON
+    # เฉพาะ path ของ API (หน้าเว็บยังได้หน้า 404 ปกติ)
+    @api.app_errorhandler(404)
+    @api.app_errorhandler(405)
+    def _app_http_error(e):
+        if request.path.startswith("/api/"):
+            return _json({"error": e.description}, e.code)
+        return e
+
+    # ---------- Last.fm ----------
+    @api.get("/search")
+    def search():
+        q = request.args.get("q", "").strip()
+        if not q:
+            raise ApiError(400, "q is required")
+        limit = _limit(30)
+        try:
+            if request.args.get("mode", "genre") == "artist":
+                tracks = lastfm_client.top_tracks_by_artist(q, limit=limit)
+            else:
+                tracks = lastfm_client.top_tracks_by_tag(q, limit=limit)
+        except Exception as e:
+            raise _lastfm_error(e)
+        return lastfm_list(tracks, "tracks")
+
+    @api.get("/tags/<string:tag>/tracks")
+    def tag_tracks(tag: str):
+        try:
+            tracks = lastfm_client.top_tracks_by_tag(tag, limit=_limit(24))
+        except Exception as e:
+            raise _lastfm_error(e)
+        return lastfm_list(tracks, "tracks")
+
+    @api.get("/artists/<string:name>/tracks")
+    def artist_tracks(name: str):
+        try:
+            tracks = lastfm_client.top_tracks_by_artist(name, limit=_limit(12))
+        except Exception as e:
+            raise _lastfm_error(e)
+        return lastfm_list(tracks, "tracks")
+
+    @api.get("/artists/<string:name>/similar")
+    def similar_artists(name: str):
+        min_match = request.args.get("min_match", 0.0, type=float)
+        try:
+            artists = lastfm_client.similar_artists(name, limit=_limit(12), autocorrect=1)
+        except Exception as e:
+            raise _lastfm_error(e)
+        stale = getattr(artists, "stale", False)
+        artists = [a for a in artists if float(a.get("match", 0.0)) >= min_match]
+        return _json({"artists": _select(artists), "stale": bool(stale)})
+
+    # ---------- Playlists ----------
+    @api.get("/playlists")
+    def list_playlists():
+        return _json({"playlists": _select(repo.list_playlists_with_counts(uid()))})
+
+    @api.post("/playlists")
+    def create_playlist():
+        data = _body()
+        name = (data.get("name") or "").strip() or "New Playlist"
+        pid = playlist.create_playlist(uid(), name, (data.get("description") or "").strip(),
+                                       _is_public(data, False))
+        return _json(owned(pid), 201)
+
+    @api.get("/playlists/<int:playlist_id>")
+    def get_playlist(playlist_id: int):
+        return _json(owned(playlist_id))
+
+    @api.patch("/playlists/<int:playlist_id>")
+    def update_playlist(playlist_id: int):
+        pl = owned(playlist_id)
+        data = _body()
+        playlist.update_playlist_meta(
+            playlist_id, uid(),
+            name=(data.get("name", pl["name"]) or "").strip() or pl["name"],
+            description=(data.get("description", pl["description"]) or "").strip(),
+            is_public=_is_public(data, bool(pl["is_public"])),
+        )
+        return _json(owned(playlist_id))
+
+    @api.delete("/playlists/<int:playlist_id>")
+    def delete_playlist(playlist_id: int):
+        if not repo.delete_playlist(playlist_id, uid()):
+            raise ApiError(404, "playlist not found")
+        return Response(status=204)
+
+    # ---------- Tracks ----------
+    @api.get("/playlists/<int:playlist_id>/tracks")
+    def list_tracks(playlist_id: int):
+        # keyset เหมือนหน้าเว็บ: next = cursor ของหน้าถัดไป (ส่งกลับมาเป็น ?after=) หรือ null
+        after = None
+        if request.args.get("after"):
+            try:
+                pos, tid = request.args["after"].split("_")
+                after = (int(pos), int(tid))
+            except ValueError:
+                raise ApiError(400, "invalid cursor")
+        limit = _limit(TRACKS_PAGE_DEFAULT)
+        rows = playlist.list_tracks(playlist_id, uid(), after=after, limit=limit + 1)
+        tracks = rows[:limit]
+        last = tracks[-1] if len(rows) > limit else None
+        return _json({
+            "tracks": _select(tracks),
+            "next": f"{last['position']}_{last['id']}" if last else None,
+        })
+
+    @api.post("/playlists/<int:playlist_id>/tracks")
+    def add_tracks(playlist_id: int):
+        owned(playlist_id)
+        data = _body()
+        if "tracks" in data:
+            items = data["tracks"]
+            if not isinstance(items, list) or not items:
+                raise ApiError(400, "tracks must be a non-empty list")
+            added = playlist.add_tracks(playlist_id, [_track(t if isinstance(t, dict) else {}) for t in items])
+        else:
+            index = data.get("index")
+            if index is not None and not _is_index(index):
+                raise ApiError(400, "index must be an integer")
+            playlist.add_track(playlist_id, _track(data), index=index)
+            added = 1
+        return _json({"added": added, "track_count": owned(playlist_id)["track_count"]}, 201)
+
+    @api.delete("/playlists/<int:playlist_id>/tracks")
+    def clear_tracks(playlist_id: int):
+        playlist.clear(playlist_id, uid())
+        return Response(status=204)
+
+    @api.delete("/playlists/<int:playlist_id>/tracks/<int:track_id>")
+    def remove_track(playlist_id: int, track_id: int):
+        playlist.remove_track(playlist_id, track_id, uid())
+        return Response(status=204)
+
+    @api.post("/playlists/<int:playlist_id>/tracks/<int:track_id>/move")
+    def move_track(playlist_id: int, track_id: int):
+        data = _body()
+        if _is_index(data.get("index")):
+            if not playlist.move_track_to(playlist_id, track_id, data["index"], uid()):
+                raise ApiError(404, "track not found")
+        elif data.get("direction") in ("up", "down"):
+            playlist.move_track(playlist_id, track_id, data["direction"], uid())
+        else:
+            raise ApiError(400, "index (int) or direction (up|down) is required")
+        return Response(status=204)
+
+    return api
@@ -1,15 +1,29 @@
+import asyncio
+import click
+import hashlib
 import os
 import time
+import threading
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
 from requests import session
 os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
 from typing import Optional
 from urllib.parse import urlencode
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, g, Response, abort, stream_with_context
+from flask import before_render_template, template_rendered
 from dotenv import load_dotenv
 from models import Track, Artist, PlaylistManager
 from storage import StorageRepository
 from lastfm import LastFMClient
+from ratelimit import parse_retry_after
+from spotify_async import AsyncSpotify
+from api import create_api
+from jobs import make_job_queue
+from cache import MemoryCache
+import metrics
+from exporters import EXPORT_FORMATS, stream_export
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user, UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from requests_oauthlib import OAuth2Session
@@ -26,12 +40,61 @@ db_url = os.getenv("DATABASE_URL", "sqlite:///music.db")
 repo = StorageRepository(db_url)
 playlist = PlaylistManager(repo)
 lastfm_client = LastFMClient()
+job_queue = make_job_queue()
 
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 app.config.update(
     PREFERRED_URL_SCHEME="https"  # บน Render/VPS ใช้ https
 )
 
+# --- Metrics (/metrics): เวลาต่อ route, render template, query DB, call ไป upstream (ดู metrics.py) ---
+REQUEST_SECONDS = metrics.REGISTRY.histogram(
+    "http_request_duration_seconds", "Time to handle a request, by route", ("route", "method", "status"))
+TEMPLATE_SECONDS = metrics.REGISTRY.histogram(
+    "template_render_duration_seconds", "Jinja render time", ("template",))
+metrics.instrument_engine(repo.engine)
+
+@app.before_request
+def _start_request_timer():
+    g.metrics_started = time.perf_counter()
+
+@app.after_request
+def _remember_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+@app.teardown_request
+def _observe_request(exc):
+    started = g.pop("metrics_started", None)
+    if started is None:
+        return
+    # route = rule ของ Flask (/playlist/<int:playlist_id>) ไม่ใช่ path จริง -> label ไม่บานตาม id
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method,
+                            status=g.pop("metrics_status", 500))
+
+def _template_started(sender, template, context, **extra):
+    g.setdefault("metrics_templates", []).append(time.perf_counter())
+
+def _template_done(sender, template, context, **extra):
+    stack = g.get("metrics_templates")
+    if stack:
+        TEMPLATE_SECONDS.observe(time.perf_counter() - stack.pop(), template=template.name or "")
+
+before_render_template.connect(_template_started, app)
+template_rendered.connect(_template_done, app)
+
+# --- DB: 1 request = 1 connection (repo call ทั้งหมดใน request ใช้ร่วมกัน) ---
+@app.before_request
+def _open_db_unit_of_work():
+    g.db_uow = repo.unit_of_work().open()
+
+@app.teardown_request
+def _close_db_unit_of_work(exc):
+    uow = g.pop("db_uow", None)
+    if uow is not None:
+        uow.close()
+
 # --- Auth setup ---
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
@@ -41,10 +104,37 @@ class AuthUser(UserMixin):
         self.id = str(user_id)
         self.username = username
 
+# user_loader ถูกเรียกทุก request ที่ login อยู่ -> ไม่อ่านตาราง users ทุกครั้ง
+# - cache (id -> username) ใน process อายุ USER_CACHE_TTL วินาที (0 = ปิด); worker อื่นเห็นการเปลี่ยนแปลงภายใน TTL
+# - SESSION_CARRIES_USERNAME=1: เก็บ username ไว้ใน session (signed cookie) ด้วย -> ไม่แตะ storage เลย
+#   แลกกับการที่บัญชีที่ถูกลบ/เปลี่ยนชื่อจะยังใช้ session เดิมได้จนกว่าจะ logout หรือ session หมดอายุ
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))
+SESSION_CARRIES_USERNAME = os.getenv("SESSION_CARRIES_USERNAME", "0") == "1"
+_user_cache = MemoryCache(max_entries=int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000")))
+
+def _login(user: AuthUser):
+    login_user(user)
+    if SESSION_CARRIES_USERNAME:
+        flask_session["_username"] = [user.id, user.username]
+
+def forget_user(user_id) -> None:
+    """เรียกทุกครั้งที่ข้อมูลบัญชีเปลี่ยน (สมัคร/ออกจากระบบ/แก้ไข/ลบ)"""
+    _user_cache.delete(f"user:{user_id}")
+
 @login_manager.user_loader
 def load_user(user_id: str):
-    rec = repo.get_user_by_id(int(user_id))
-    if not rec: return None
+    if SESSION_CARRIES_USERNAME:
+        carried = flask_session.get("_username")
+        if carried and carried[0] == user_id:
+            return AuthUser(int(user_id), carried[1])
+    key = f"user:{user_id}"
+    rec = _user_cache.get(key) if USER_CACHE_TTL > 0 else None
+    if rec is None:
+        row = repo.get_user_by_id(int(user_id))
+        if not row: return None
+        rec = {"id": row["id"], "username": row["username"]}     # ไม่เก็บ password_hash ใน cache
+        if USER_CACHE_TTL > 0:
+            _user_cache.set(key, rec, USER_CACHE_TTL)
     return AuthUser(rec["id"], rec["username"])
 
 # ----------------- Auth routes -----------------
@@ -60,7 +150,8 @@ def register():
             flash("มีชื่อผู้ใช้นี้แล้ว")
             return redirect(url_for("register"))
         uid = repo.create_user(username, generate_password_hash(password))
-        login_user(AuthUser(uid, username))
+        forget_user(uid)
+        _login(AuthUser(uid, username))
         flash("สมัครสมาชิกสำเร็จ")
         return redirect(url_for("index"))
     return render_template("login_register/register.html") if template_exists("login_register/register.html") else render_template("register.html")
@@ -74,7 +165,7 @@ def login():
         if not rec or not check_password_hash(rec["password_hash"], password):
             flash("เข้าสู่ระบบไม่สำเร็จ")
             return redirect(url_for("login"))
-        login_user(AuthUser(rec["id"], rec["username"]))
+        _login(AuthUser(rec["id"], rec["username"]))
         flash("เข้าสู่ระบบแล้ว")
         return redirect(url_for("index"))
     return render_template("login_register/login.html") if template_exists("login_register/login.html") else render_template("login.html")
@@ -82,6 +173,8 @@ def login():
 @app.route("/logout")
 @login_required
 def logout():
+    forget_user(current_user.id)
+    flask_session.pop("_username", None)
     logout_user()
     flash("ออกจากระบบแล้ว")
     return redirect(url_for("index"))
@@ -95,6 +188,9 @@ def template_exists(path: str) -> bool:
     except Exception:
         return False
 
+# --- JSON API (/api/v1) ดู api.py ---
+app.register_blueprint(create_api(repo, playlist, lastfm_client), url_prefix="/api/v1")
+
 # ----------------- Home / Search -----------------
 @app.route("/")
 @login_required
@@ -103,6 +199,25 @@ def index():
     user_playlists = playlist.list_playlists(int(current_user.id))
     return render_template("index.html", tags=TAG_CARDS,default_genre=default_genre, user_playlists=user_playlists)
 
+# --- asgi.py: ข้อมูล Last.fm ของ request ถูกดึงบน event loop ไว้ก่อนแล้ว (ดู ASYNC_PREFETCH) ---
+# ค่า = (results, errors) แบบเดียวกับ lastfm_client.gather; รันแบบ WSGI ปกติจะเป็น None
+prefetched: ContextVar[tuple | None] = ContextVar("prefetched", default=None)
+
+def _prefetched_or(key: str, fetch):
+    """ผลของ key ที่ asgi.py ดึงไว้ (raise error เดิมถ้าดึงไม่สำเร็จ) หรือ fetch() ถ้าไม่มี"""
+    pre = prefetched.get()
+    if pre is None:
+        return fetch()
+    results, errors = pre
+    if key in errors:
+        raise errors[key]
+    return results[key]
+
+def _flash_if_stale(*results):
+    # lastfm.StaleList: ได้จาก cache ที่หมดอายุแล้ว (กำลัง refresh เบื้องหลัง หรือ Last.fm ใช้ไม่ได้ชั่วคราว)
+    if any(getattr(r, "stale", False) for r in results):
+        flash("ข้อมูลจาก Last.fm อาจยังไม่อัปเดตล่าสุด")
+
 @app.route("/search", methods=["GET"])
 @login_required
 def search():
@@ -114,9 +229,10 @@ def search():
         return redirect(url_for("index"))
     try:
         if mode == "artist":
-            results = lastfm_client.top_tracks_by_artist(q, limit=30)
+            results = _prefetched_or("results", lambda: lastfm_client.top_tracks_by_artist(q, limit=30))
         else:
-            results = lastfm_client.top_tracks_by_tag(q, limit=30)
+            results = _prefetched_or("results", lambda: lastfm_client.top_tracks_by_tag(q, limit=30))
+        _flash_if_stale(results)
         return render_template("search_results.html", q=q, mode=mode, results=results, user_playlists=user_playlists)
     except Exception as e:
         flash(f"เกิดข้อผิดพลาดในการค้นหา: {e}")
@@ -135,29 +251,37 @@ def artist_view():
         flash("ไม่พบชื่อศิลปิน")
         return redirect(url_for("index"))
 
-    try:
+    # ยิง similar + top tracks พร้อมกัน; ถ้าอันใดอันหนึ่งช้า/พังก็ยัง render ส่วนที่ได้
+    results, errors = prefetched.get() or lastfm_client.gather({
         # แนะนำเปิด autocorrect=1 ให้ Last.fm ช่วยสะกด
-        similar = lastfm_client.similar_artists(name, limit=limit, autocorrect=1)
-        # กรองศิลปินที่คะแนน match ต่ำเกินไปออก (0..1)
-        similar = [a for a in similar if float(a.get("match", 0.0)) >= match_threshold]
-
-        top_tracks = lastfm_client.top_tracks_by_artist(name, limit=limit)
-
-        if not similar and not top_tracks:
-            flash("ไม่พบข้อมูลศิลปิน/เพลงที่เกี่ยวข้องจาก Last.fm")
-            return redirect(url_for("index"))
-
-        return render_template(
-            "artist.html",
-            name=name,
-            similar=similar,
-            top_tracks=top_tracks
-        )
-    except Exception as e:
-        # คุณจะเห็น error ชัดขึ้นใน console; หน้าเว็บแจ้งสั้นๆพอ
-        current_app.logger.exception("artist_view failed")
-        flash(f"โหลดข้อมูลศิลปินไม่ได้: {e}")
+        "similar": lambda: lastfm_client.similar_artists(name, limit=limit, autocorrect=1),
+        "top_tracks": lambda: lastfm_client.top_tracks_by_artist(name, limit=limit),
+    })
+    for key, err in errors.items():
+        current_app.logger.warning("artist_view %s failed: %s", key, err)
+
+    # กรองศิลปินที่คะแนน match ต่ำเกินไปออก (0..1)
+    similar = [a for a in results.get("similar", []) if float(a.get("match", 0.0)) >= match_threshold]
+    top_tracks = results.get("top_tracks", [])
+
+    if errors and not similar and not top_tracks:
+        flash(f"โหลดข้อมูลศิลปินไม่ได้: {next(iter(errors.values()))}")
+        return redirect(url_for("index"))
+    if not similar and not top_tracks:
+        flash("ไม่พบข้อมูลศิลปิน/เพลงที่เกี่ยวข้องจาก Last.fm")
         return redirect(url_for("index"))
+    if errors:
+        flash("โหลดข้อมูลจาก Last.fm ได้ไม่ครบ แสดงเฉพาะส่วนที่โหลดได้")
+    _flash_if_stale(*results.values())
+
+    user_playlists = repo.list_playlists(int(current_user.id))
+    return render_template(
+        "artist.html",
+        name=name,
+        similar=similar,
+        top_tracks=top_tracks,
+        user_playlists=user_playlists
+    )
 
 # ----------------- Playlists (multi) -----------------
 @app.route("/playlists")
@@ -176,6 +300,49 @@ def playlist_new():
     flash("สร้างเพลย์ลิสต์แล้ว")
     return redirect(url_for("playlist_detail", playlist_id=pid))
 
+# หน้าเพลย์ลิสต์แสดงทีละ PLAYLIST_PAGE_SIZE เพลง ต่อหน้าด้วย cursor (keyset บน position, id)
+# ?after=<position>_<id> ของเพลงสุดท้ายในหน้าก่อน, ?n= จำนวนเพลงก่อนหน้านี้ (ใช้แค่แสดงเลขลำดับ)
+PLAYLIST_PAGE_SIZE = int(os.getenv("PLAYLIST_PAGE_SIZE", "100"))
+
+def _parse_cursor(value: Optional[str]) -> Optional[tuple]:
+    try:
+        pos, tid = (value or "").split("_")
+        return int(pos), int(tid)
+    except ValueError:
+        return None         # ไม่มี/ผิดรูปแบบ -> หน้าแรก
+
+def _page_start(after: Optional[tuple], total: int) -> int:
+    # n มาจาก URL (แก้เองได้) -> บีบให้อยู่ในช่วงที่เป็นไปได้ (0..จำนวนเพลง)
+    if not after:
+        return 0
+    return min(max(0, request.args.get("n", 0, type=int)), total)
+
+def _page_args() -> dict:
+    """after/n ของหน้าที่กำลังดู -> ส่งต่อให้ลิงก์ action แล้ว redirect กลับมาหน้าเดิม"""
+    if _parse_cursor(request.args.get("after")) is None:
+        return {}
+    return {"after": request.args["after"], "n": max(0, request.args.get("n", 0, type=int))}
+
+def _back_to_playlist(playlist_id: int):
+    return redirect(url_for("playlist_detail", playlist_id=playlist_id, **_page_args()))
+
+def _track_page(fetch, total: int) -> dict:
+    """
+    fetch(after=..., limit=...) -> list ของเพลง; ดึงเกิน 1 แถวเพื่อรู้ว่ามีหน้าถัดไปไหม
+    total = จำนวนเพลงทั้งหมด (ใช้บีบ n); คืน {tracks, start, after, next: cursor ของหน้าถัดไปหรือ None}
+    """
+    after = _parse_cursor(request.args.get("after"))
+    start = _page_start(after, total)
+    rows = fetch(after=after, limit=PLAYLIST_PAGE_SIZE + 1)
+    tracks = rows[:PLAYLIST_PAGE_SIZE]
+    last = tracks[-1] if len(rows) > PLAYLIST_PAGE_SIZE else None
+    return {
+        "tracks": tracks,
+        "start": start,
+        "after": f"{after[0]}_{after[1]}" if after else None,
+        "next": f"{last['position']}_{last['id']}" if last else None,
+    }
+
 @app.route("/playlist/<int:playlist_id>")
 @login_required
 def playlist_detail(playlist_id: int):
@@ -183,8 +350,10 @@ def playlist_detail(playlist_id: int):
     if not pl:
         flash("ไม่พบเพลย์ลิสต์")
         return redirect(url_for("playlists_view"))
-    tracks = playlist.list_tracks(playlist_id, int(current_user.id))
-    return render_template("playlist_detail.html", pl=pl, tracks=tracks)
+    page = _track_page(lambda **kw: playlist.list_tracks(playlist_id, int(current_user.id), **kw),
+                       pl["track_count"])
+    return render_template("playlist_detail.html", pl=pl, job_id=request.args.get("job"),
+                           page_args=_page_args(), **page)
 
 @app.route("/playlist/<int:playlist_id>/edit", methods=["POST"])
 @login_required
@@ -222,21 +391,65 @@ def playlist_share(playlist_id: int):
     flash("สร้างลิงก์แชร์แล้ว คัดลอกลิงก์ด้านล่างได้เลย")
     return render_template("share.html", share_url=share_url)
 
+# หน้า /p/<token> ไม่ต้อง login และถูกแชร์ต่อ -> traffic มาเป็นก้อน
+# cache ด้วย key = (token, playlists.updated_at): ทุก method ของ repo ที่แก้เพลย์ลิสต์จะขยับ updated_at
+# (StorageRepository._touch) -> entry เดิมไม่ถูกอ่านอีกแล้วหลุดออกจาก LRU เอง ไม่ต้องสั่งลบข้าม worker
+# - รายการเพลง: cache ให้ทุกคน; HTML ทั้งหน้า: cache เฉพาะผู้ที่ไม่ได้ login (base.html มีชื่อผู้ใช้/flash)
+# - ETag/Last-Modified -> browser/CDN ที่ส่ง If-None-Match กลับมาได้ 304 โดยไม่ render อะไรเลย
+PUBLIC_PAGE_TTL = int(os.getenv("PUBLIC_PAGE_TTL", "3600"))
+_public_page_cache = MemoryCache(max_entries=int(os.getenv("PUBLIC_PAGE_CACHE_ENTRIES", "1024")),
+                                 max_bytes=int(os.getenv("PUBLIC_PAGE_CACHE_BYTES", str(32 * 1024 * 1024))))
+
+def _public_tracks(pl: dict, version: str) -> dict:
+    key = f"public:tracks:{version}"
+    page = _public_page_cache.get(key)
+    if page is None:
+        # public view ไม่ต้องตรวจ owner => ไม่ต้องส่ง user_id
+        page = _track_page(lambda **kw: repo.fetch_playlist_tracks(pl["id"], **kw), pl["track_count"])
+        _public_page_cache.set(key, page, PUBLIC_PAGE_TTL)
+    return page
+
 @app.route("/p/<token>")
 def public_playlist(token: str):
-    # ใช้ repo (StorageRepository) แทน playlist
+    # ใช้ repo (StorageRepository) แทน playlist; query เดียวผ่าน index ของ share_token
     pl = repo.get_public_playlist_by_token(token)
     if not pl or not pl.get("is_public"):
         flash("ไม่พบเพลย์ลิสต์สาธารณะ หรือเพลย์ลิสต์ถูกปิดแล้ว")
         return redirect(url_for("index"))
 
-    # public view ไม่ต้องตรวจ owner => ไม่ต้องส่ง user_id
-    tracks = repo.fetch_playlist_tracks(pl["id"])
-
-    # ลิงก์แบบเต็มเพื่อคัดลอกง่าย (_external=True)
-    share_url = url_for("public_playlist", token=token, _external=True)
+    # แต่ละหน้า (cursor) เป็นคนละ entry; n มีผลแค่เลขลำดับ แต่อยู่ใน HTML -> อยู่ใน key ด้วย
+    # (ค่าที่บีบแล้ว: ?n= ที่สุ่มมาไม่สร้าง entry ใหม่เกินจำนวนเพลง)
+    cursor = _parse_cursor(request.args.get("after"))
+    version = f"{token}:{pl['updated_at']}:{cursor}:{_page_start(cursor, pl['track_count'])}"
+    viewer = current_user.id if current_user.is_authenticated else "anon"
+    has_flashes = bool(flask_session.get("_flashes"))
+    etag = hashlib.sha1(f"{version}:{viewer}".encode()).hexdigest()[:24]
 
-    return render_template("playlist_public.html", pl=pl, tracks=tracks, share_url=share_url)
+    def conditional(resp: Response) -> Response:
+        resp.set_etag(etag)
+        try:
+            resp.last_modified = datetime.fromisoformat(pl["updated_at"])
+        except (TypeError, ValueError):
+            pass
+        resp.cache_control.no_cache = True      # ให้ถามกลับทุกครั้ง (ได้ 304 ถ้ายังไม่เปลี่ยน)
+        resp.vary.add("Cookie")
+        # flash ที่ค้างอยู่ต้องถูกแสดง -> ห้ามตอบ 304
+        return resp if has_flashes else resp.make_conditional(request)
+
+    if not has_flashes and etag in request.if_none_match:
+        return conditional(Response(status=304))
+
+    page_key = f"public:page:{request.host}:{version}"     # share_url ในหน้าเป็น URL เต็ม
+    anonymous = viewer == "anon" and not has_flashes
+    html = _public_page_cache.get(page_key) if anonymous else None
+    if html is None:
+        page = _public_tracks(pl, version)
+        # ลิงก์แบบเต็มเพื่อคัดลอกง่าย (_external=True)
+        share_url = url_for("public_playlist", token=token, _external=True)
+        html = render_template("playlist_public.html", pl=pl, share_url=share_url, **page)
+        if anonymous:
+            _public_page_cache.set(page_key, html, PUBLIC_PAGE_TTL)
+    return conditional(Response(html, mimetype="text/html"))
 
 # ---- Track ops in a specific playlist ----
 @app.route("/playlist/<int:playlist_id>/add", methods=["POST"])
@@ -267,16 +480,24 @@ def playlist_add(playlist_id: int):
 def playlist_remove(playlist_id: int, track_id: int):
     playlist.remove_track(playlist_id, track_id, int(current_user.id))
     flash("ลบเพลงออกจากรายการแล้ว")
-    return redirect(url_for("playlist_detail", playlist_id=playlist_id))
+    return _back_to_playlist(playlist_id)
 
 @app.route("/playlist/<int:playlist_id>/move/<int:track_id>/<direction>")
 @login_required
 def playlist_move(playlist_id: int, track_id: int, direction: str):
     if direction not in ("up", "down"):
         flash("ทิศทางไม่ถูกต้อง")
-        return redirect(url_for("playlist_detail", playlist_id=playlist_id))
+        return _back_to_playlist(playlist_id)
     playlist.move_track(playlist_id, track_id, direction, int(current_user.id))
-    return redirect(url_for("playlist_detail", playlist_id=playlist_id))
+    return _back_to_playlist(playlist_id)
+
+@app.route("/playlist/<int:playlist_id>/move/<int:track_id>/to/<int:index>", methods=["GET", "POST"])
+@login_required
+def playlist_move_to(playlist_id: int, track_id: int, index: int):
+    # index เริ่มที่ 0 (= บนสุด); เกินจำนวนเพลงจะไปอยู่ท้ายสุด
+    if not playlist.move_track_to(playlist_id, track_id, index, int(current_user.id)):
+        flash("ไม่พบเพลงในเพลย์ลิสต์นี้")
+    return _back_to_playlist(playlist_id)
 
 @app.route("/playlist/<int:playlist_id>/clear")
 @login_required
@@ -285,11 +506,29 @@ def playlist_clear(playlist_id: int):
     flash("ล้างรายการแล้ว")
     return redirect(url_for("playlist_detail", playlist_id=playlist_id))
 
+# export ทั้งเพลย์ลิสต์แบบ streaming (csv / jsonl / m3u / xspf): ไม่เขียนไฟล์ลงดิสก์
+# /playlist/<id>/export/spotify เป็น rule แบบ static จึงถูกเลือกก่อน rule นี้เสมอ
+@app.route("/playlist/<int:playlist_id>/export/<fmt>")
+@login_required
+def export_playlist(playlist_id: int, fmt: str):
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    pl = repo.get_playlist(playlist_id, int(current_user.id))   # เช็กสิทธิ์ก่อนเริ่มส่ง header
+    if not pl:
+        flash("ไม่พบเพลย์ลิสต์")
+        return redirect(url_for("playlists_view"))
+    spec = EXPORT_FORMATS[fmt]
+    rows = repo.iter_playlist_tracks(playlist_id)
+    return Response(
+        stream_with_context(stream_export(fmt, pl, rows)),
+        mimetype=spec.mimetype,
+        headers={"Content-Disposition": f'attachment; filename="playlist-{playlist_id}.{spec.extension}"'},
+    )
+
 @app.route("/export/csv/<int:playlist_id>")
 @login_required
 def export_csv(playlist_id: int):
-    path = repo.export_playlist_csv(playlist_id, int(current_user.id))
-    return send_file(path, as_attachment=True, download_name=os.path.basename(path))
+    return export_playlist(playlist_id, "csv")
 
 # ----------------- User Profile -----------------
 @app.route("/profile/<username>")
@@ -347,6 +586,7 @@ def mood():
         tag = resolve_mood_tag(mood_text)
         try:
             results = lastfm_client.top_tracks_by_tag(tag, limit=30)
+            _flash_if_stale(results)
             return render_template("mood.html", mood_text=mood_text, tag=tag, results=results, user_playlists=user_playlists)
         except Exception as e:
             flash(f"แนะนำเพลงตามอารมณ์ไม่สำเร็จ: {e}")
@@ -374,10 +614,11 @@ def mood_build_top10():
         # สร้างเพลย์ลิสต์ใหม่
         pid = repo.create_playlist(int(current_user.id), name, f"Top 10 from tag '{tag}'", is_public)
 
-        # ใส่เพลงลงเพลย์ลิสต์ (เรียงตามอันดับ)
-        for t in tracks:
-            tr = Track(title=t["title"], artist=t["artist"], url=t.get("url"), mbid=t.get("mbid"))
-            repo.insert_playlist_track(pid, tr)
+        # ใส่เพลงลงเพลย์ลิสต์ (เรียงตามอันดับ) ใน transaction เดียว
+        playlist.add_tracks(pid, [
+            Track(title=t["title"], artist=t["artist"], url=t.get("url"), mbid=t.get("mbid"))
+            for t in tracks
+        ])
 
         flash("สร้างเพลย์ลิสต์ Top 10 สำเร็จ")
         return redirect(url_for("playlist_detail", playlist_id=pid))
@@ -389,7 +630,7 @@ def mood_build_top10():
 # ----------------- Spotify Export -----------------
 SPOTIFY_AUTH_BASE = "https://accounts.spotify.com/authorize"
 SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
-SPOTIFY_API_BASE = "https://api.spotify.com/v1"
+SPOTIFY_API_BASE = os.getenv("SPOTIFY_API_BASE", "https://api.spotify.com/v1")   # bench ชี้ไปที่ stub ได้
 
 def _save_spotify_token(user_id: int, token: dict):
     """บันทึก access/refresh token ทุกครั้งที่รีเฟรชสำเร็จ"""
@@ -409,7 +650,10 @@ SPOTIFY_AUTH_BASE = "https://accounts.spotify.com/authorize"
 SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
 SPOTIFY_SCOPE = ["playlist-modify-public", "playlist-modify-private"]
 
-def spotify_session(token: dict | None = None):
+def spotify_session(token: dict | None = None, user_id: int | None = None):
+    # ผูก user_id ไว้ตอนสร้าง session เพื่อให้ token_updater ใช้ได้นอก request thread ด้วย
+    if user_id is None and current_user and current_user.is_authenticated:
+        user_id = int(current_user.id)
     client_id = os.getenv("SPOTIFY_CLIENT_ID")
     redirect_uri = os.getenv("SPOTIFY_REDIRECT_URI")
     return OAuth2Session(
@@ -423,7 +667,7 @@ def spotify_session(token: dict | None = None):
             "client_secret": os.getenv("SPOTIFY_CLIENT_SECRET"),
         },
         token_updater=lambda t: repo.upsert_user_token(
-            int(current_user.id), "spotify",
+            user_id, "spotify",
             t.get("access_token"), t.get("refresh_token"),
             datetime.utcfromtimestamp(t["expires_at"]).isoformat() if t.get("expires_at") else None
         ),
@@ -501,26 +745,46 @@ def _get_spotify_session_for_user(user_id: int) -> OAuth2Session | None:
         ),
         "token_type": "Bearer",
     }
-    return spotify_session(token=token)
+    return spotify_session(token=token, user_id=user_id)
+
+SPOTIFY_MAX_RETRIES = int(os.getenv("SPOTIFY_MAX_RETRIES", "3"))
+SPOTIFY_SEARCH_CONCURRENCY = int(os.getenv("SPOTIFY_SEARCH_CONCURRENCY", "4"))
+# ASYNC_UPSTREAM=1: งาน export ค้น URI ด้วย AsyncSpotify (asyncio) แทน thread pool
+ASYNC_UPSTREAM = os.getenv("ASYNC_UPSTREAM", "0") == "1"
+
+# เวลา (monotonic) ที่ Spotify อนุญาตให้ยิงต่อได้หลังเจอ 429 — ใช้ร่วมทุก thread
+_sp_retry_lock = threading.Lock()
+_sp_retry_until = 0.0
+
+def _sp_request(sess: OAuth2Session, method: str, path: str, **kwargs):
+    global _sp_retry_until
+    for attempt in range(SPOTIFY_MAX_RETRIES + 1):
+        delay = _sp_retry_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        started = time.perf_counter()
+        try:
+            r = sess.request(method, f"{SPOTIFY_API_BASE}{path}", timeout=15, **kwargs)
+        except Exception:
+            metrics.observe_upstream("spotify", f"{method} {metrics.spotify_endpoint(path)}", "error",
+                                     time.perf_counter() - started)
+            raise
+        metrics.observe_upstream("spotify", f"{method} {metrics.spotify_endpoint(path)}", r.status_code,
+                                 time.perf_counter() - started)
+        if r.status_code != 429 or attempt == SPOTIFY_MAX_RETRIES:
+            break
+        # จัดการ 429 (rate limit): ทุก thread รอตาม Retry-After ก่อนยิงครั้งถัดไป
+        retry_after = parse_retry_after(r.headers.get("Retry-After"), default=1.0)
+        with _sp_retry_lock:
+            _sp_retry_until = max(_sp_retry_until, time.monotonic() + retry_after)
+    r.raise_for_status()
+    return r
 
 def _sp_get(sess: OAuth2Session, path: str, **kwargs):
-    r = sess.get(f"{SPOTIFY_API_BASE}{path}", timeout=15, **kwargs)
-    r.raise_for_status()
-    return r.json()
+    return _sp_request(sess, "GET", path, **kwargs).json()
 
 def _sp_post(sess: OAuth2Session, path: str, json=None, **kwargs):
-    r = sess.post(
-        f"{SPOTIFY_API_BASE}{path}",
-        json=json,
-        timeout=15,
-        **kwargs
-    )
-    # จัดการ 429 (rate limit) แบบง่ายๆ
-    if r.status_code == 429:
-        retry_after = int(r.headers.get("Retry-After", "1"))
-        time.sleep(retry_after)
-        r = sess.post(f"{SPOTIFY_API_BASE}{path}", json=json, timeout=15, **kwargs)
-    r.raise_for_status()
+    r = _sp_request(sess, "POST", path, json=json, **kwargs)
     return r.json() if r.text else {}
 
 def _spotify_get_user_id_sess(sess: OAuth2Session) -> str:
@@ -541,55 +805,160 @@ def _spotify_search_track_uri_sess(sess: OAuth2Session, title: str, artist: str)
         return None
     return items[0]["uri"]
 
+def _spotify_resolve_track_uris(sess: OAuth2Session, tracks: list, on_progress=None) -> list:
+    """
+    แปลงเพลงเป็น Spotify URI ตามลำดับเดิม: ดูใน cache (spotify_track_uris) ก่อน
+    ส่วนที่ไม่เจอค่อยค้น /search พร้อมกันไม่เกิน SPOTIFY_SEARCH_CONCURRENCY
+    on_progress(done) ถูกเรียกทุกครั้งที่ได้ผลเพิ่ม (นับเป็นจำนวนคู่ title/artist ที่ไม่ซ้ำ)
+    """
+    pairs = [(t["title"], t["artist"]) for t in tracks]
+    known = repo.get_spotify_uris(pairs)
+    missing = list(dict.fromkeys(p for p in pairs if p not in known))
+    done = len(set(pairs)) - len(missing)
+    if on_progress:
+        on_progress(done)
+    if missing and ASYNC_UPSTREAM:
+        # ค้นบน event loop ของ job นี้: /search พร้อมกันได้หลายสิบ call โดยไม่ต้องมี thread ต่อ call
+        # (token เพิ่ง refresh จาก call /me ฝั่ง sync แล้ว)
+        fresh = asyncio.run(_spotify_search_async(
+            sess.token["access_token"], missing, lambda n: on_progress and on_progress(done + n)))
+        repo.save_spotify_uris(fresh)
+        known.update(fresh)
+    elif missing:
+        fresh = {}
+        with ThreadPoolExecutor(max_workers=SPOTIFY_SEARCH_CONCURRENCY) as ex:
+            found = ex.map(lambda p: _spotify_search_track_uri_sess(sess, *p), missing)
+            for n, (p, uri) in enumerate(zip(missing, found), start=1):
+                if uri:
+                    fresh[p] = uri
+                if on_progress and (n % 10 == 0 or n == len(missing)):
+                    on_progress(done + n)
+        repo.save_spotify_uris(fresh)
+        known.update(fresh)
+    return [known[p] for p in pairs if p in known]
+
+async def _spotify_search_async(access_token: str, pairs: list, on_progress=None) -> dict:
+    async with AsyncSpotify(access_token, base_url=SPOTIFY_API_BASE, max_retries=SPOTIFY_MAX_RETRIES) as sp:
+        return await sp.search_track_uris(pairs, on_progress=on_progress)
+
+def run_spotify_export(job_id: str, user_id: int, playlist_id: int):
+    """
+    งานเบื้องหลัง: หา URI -> สร้างเพลย์ลิสต์บน Spotify -> เพิ่มเพลงทีละ 100
+    (สร้างเพลย์ลิสต์หลังสุด: หาเพลงไม่เจอ/เพลย์ลิสต์ว่างจะไม่ทิ้งเพลย์ลิสต์เปล่าไว้ในบัญชี Spotify)
+    อัปเดตสถานะลงตาราง jobs ให้หน้าเว็บ poll ผ่าน /jobs/<job_id>
+    """
+    repo.update_job(job_id, status="running", message="กำลังเตรียมข้อมูล")
+    sess = _get_spotify_session_for_user(user_id)
+    pl = playlist.get_playlist(playlist_id, user_id)
+    if not sess or not pl:
+        repo.update_job(job_id, status="failed", message="ไม่พบการเชื่อมต่อ Spotify หรือเพลย์ลิสต์")
+        return
+    tracks = playlist.list_tracks(playlist_id, user_id)
+    if not tracks:
+        repo.update_job(job_id, status="failed", message="เพลย์ลิสต์ว่าง")
+        return
+    unique_tracks = len({(t["title"], t["artist"]) for t in tracks})
+    repo.update_job(job_id, total=unique_tracks, message="กำลังค้นหาเพลงบน Spotify")
+
+    # /me ก่อน: refresh token (ถ้าจำเป็น) ให้การค้นแบบ async ใช้ token ที่ยังไม่หมดอายุ
+    user_spotify_id = _spotify_get_user_id_sess(sess)
+
+    # ค้นหา URIs ของเพลง (cache + ค้นพร้อมกันแบบจำกัดจำนวน)
+    uris = _spotify_resolve_track_uris(sess, tracks, on_progress=lambda n: repo.update_job(job_id, progress=n))
+    if not uris:
+        repo.update_job(job_id, status="failed", message="หาเพลงบน Spotify ไม่เจอ")
+        return
+
+    # สร้างเพลย์ลิสต์บน Spotify
+    repo.update_job(job_id, message="กำลังสร้างเพลย์ลิสต์บน Spotify")
+    sp_pl_id = _spotify_create_playlist_sess(
+        sess, user_spotify_id, pl["name"], pl["description"], bool(pl["is_public"])
+    )
+
+    # เพิ่มเพลงทีละก้อน (สูงสุด 100/ครั้ง)
+    repo.update_job(job_id, message="กำลังเพิ่มเพลงลงเพลย์ลิสต์บน Spotify")
+    for i in range(0, len(uris), 100):
+        chunk = uris[i:i+100]
+        _sp_post(sess, f"/playlists/{sp_pl_id}/tracks", json={"uris": chunk})
+
+    repo.update_job(job_id, status="done", progress=unique_tracks, message="ส่งออกเพลย์ลิสต์ไป Spotify สำเร็จ",
+                    result={"spotify_playlist_id": sp_pl_id, "exported": len(uris), "total": len(tracks)})
+
+job_queue.register("spotify_export", run_spotify_export)
+job_queue.on_error = lambda job_id, e: repo.update_job(job_id, status="failed", message=f"ส่งออกไม่สำเร็จ: {e}")
+
 @app.route("/playlist/<int:playlist_id>/export/spotify")
 @login_required
 def export_spotify(playlist_id: int):
-    sess = _get_spotify_session_for_user(int(current_user.id))
-    if not sess:
+    # ตรวจเบื้องต้นแบบเร็วๆ แล้วโยนงานจริงเข้า job queue; request thread คืนทันที
+    if not repo.get_user_token(int(current_user.id), "spotify"):
         flash("กรุณาเชื่อมต่อ Spotify ก่อน")
         return redirect(url_for("spotify_login"))
 
-    # เตรียมข้อมูลเพลย์ลิสต์
     pl = playlist.get_playlist(playlist_id, int(current_user.id))
     if not pl:
         flash("ไม่พบเพลย์ลิสต์")
         return redirect(url_for("playlists_view"))
-    tracks = playlist.list_tracks(playlist_id, int(current_user.id))
-    if not tracks:
+    if not pl["track_count"]:
         flash("เพลย์ลิสต์ว่าง")
         return redirect(url_for("playlist_detail", playlist_id=playlist_id))
 
-    # สร้างเพลย์ลิสต์บน Spotify
-    try:
-        user_spotify_id = _spotify_get_user_id_sess(sess)
-        sp_pl_id = _spotify_create_playlist_sess(
-            sess, user_spotify_id, pl["name"], pl["description"], bool(pl["is_public"])
-        )
-    except Exception as e:
-        flash(f"สร้างเพลย์ลิสต์บน Spotify ไม่สำเร็จ: {e}")
-        return redirect(url_for("playlist_detail", playlist_id=playlist_id))
-
-    # ค้นหา URIs ของเพลงทีละรายการ
-    uris = []
-    for t in tracks:
-        uri = _spotify_search_track_uri_sess(sess, t["title"], t["artist"])
-        if uri:
-            uris.append(uri)
-    if not uris:
-        flash("หาเพลงบน Spotify ไม่เจอ")
-        return redirect(url_for("playlist_detail", playlist_id=playlist_id))
-
-    # เพิ่มเพลงทีละก้อน (สูงสุด 100/ครั้ง)
-    try:
-        for i in range(0, len(uris), 100):
-            chunk = uris[i:i+100]
-            _sp_post(sess, f"/playlists/{sp_pl_id}/tracks", json={"uris": chunk})
-    except Exception as e:
-        flash(f"เพิ่มเพลงลงเพลย์ลิสต์บน Spotify ไม่สำเร็จ: {e}")
-        return redirect(url_for("playlist_detail", playlist_id=playlist_id))
+    job_id = repo.create_job(int(current_user.id), "spotify_export")
+    job_queue.enqueue("spotify_export", job_id, user_id=int(current_user.id), playlist_id=playlist_id)
+    flash("เริ่มส่งออกไป Spotify แล้ว ดูความคืบหน้าด้านล่าง")
+    return redirect(url_for("playlist_detail", playlist_id=playlist_id, job=job_id))
 
-    flash("ส่งออกเพลย์ลิสต์ไป Spotify สำเร็จ")
-    return redirect(url_for("playlist_detail", playlist_id=playlist_id))
+@app.get("/jobs/<job_id>")
+@login_required
+def job_status(job_id: str):
+    job = repo.get_job(job_id, int(current_user.id))
+    if not job:
+        return jsonify({"error": "not found"}), 404
+    return jsonify({k: job[k] for k in ("id", "kind", "status", "progress", "total", "message", "result", "updated_at")})
+
+def _collect_app_stats():
+    yield from metrics.cache_samples("lastfm", lastfm_client.cache)
+    yield from metrics.cache_samples("users", _user_cache)
+    yield from metrics.cache_samples("public_page", _public_page_cache)
+    for event, n in lastfm_client.stats_snapshot().items():
+        yield "lastfm_client_events_total", "counter", "LastFMClient events (throttled, retried, stale, ...)", \
+            {"event": event}, n
+
+metrics.REGISTRY.register_collector("app", _collect_app_stats)
+
+# ปิดไว้โดย default (404): ตั้ง METRICS_TOKEN -> ต้องส่ง Authorization: Bearer <token>
+# หรือ METRICS_PUBLIC=1 -> เปิดให้ทุกคน (ใช้เฉพาะหลัง network ภายใน)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_PUBLIC = os.getenv("METRICS_PUBLIC", "0") == "1"
+
+@app.get("/metrics")
+def metrics_view():
+    if not METRICS_TOKEN:
+        if not METRICS_PUBLIC:
+            abort(404)
+    elif request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        abort(401)
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+@app.cli.command("run-jobs")
+def run_jobs():
+    """Worker สำหรับ JOB_QUEUE_URL=redis://... (LocalJobQueue รันใน web process อยู่แล้ว)"""
+    if not hasattr(job_queue, "work"):
+        raise SystemExit("JOB_QUEUE_URL is not a Redis URL; jobs already run in-process")
+    job_queue.work()
+
+@app.cli.command("check-counters")
+@click.option("--fix", is_flag=True, help="rebuild counters from playlist_tracks/playlists if they drifted")
+def check_counters(fix: bool):
+    """ตรวจ track_count / user_stats / user_artist_counts เทียบกับข้อมูลจริง"""
+    drift = repo.check_counters()
+    for table, n in drift.items():
+        click.echo(f"{table}: {n} mismatched row(s)")
+    if any(drift.values()):
+        if not fix:
+            raise SystemExit(1)
+        repo.rebuild_counters()
+        click.echo("counters rebuilt")
 
 @app.route("/prefs/genre", methods=["POST"])
 @login_required
@@ -616,12 +985,56 @@ TAG_CARDS = [
     {"slug": "hip-hop",     "name": "hip-hop",     "caption": "Including Eminem, Kanye West and Gorillaz"},
 ]
 
+TAG_PAGE_LIMIT = 24
+
+# เติม cache ของทุกการ์ดบนหน้า Home ตอนบูตและก่อน TTL หมด -> คลิกแรกไม่ต้องรอ Last.fm
+# (ปิดไว้โดย default; เปิดด้วย LASTFM_WARMUP=1) ทุก worker รัน warmer ของตัวเอง: ถ้า cache เป็น
+# MemoryCache แต่ละ worker ดึง Last.fm เองทุกรอบ; ถ้า CACHE_URL=redis://... tag ที่ยังสดใน Redis
+# ถูกข้าม -> ส่วนใหญ่มี worker เดียวที่ดึงต่อรอบ (worker ที่บูตพร้อมกันอาจดึงซ้ำกันได้ในรอบแรก)
+if os.getenv("LASTFM_WARMUP", "0") == "1":
+    lastfm_client.start_warmer([c["slug"] for c in TAG_CARDS], limit=TAG_PAGE_LIMIT,
+                               interval=float(os.getenv("LASTFM_WARMUP_INTERVAL", "0")) or None)
+
 @app.get("/tag/<string:tag>")
 @login_required
 def tag_view(tag: str):
-    tracks = lastfm_client.top_tracks_by_tag(tag, limit=24)
+    try:
+        tracks = _prefetched_or("tracks", lambda: lastfm_client.top_tracks_by_tag(tag, limit=TAG_PAGE_LIMIT))
+    except Exception as e:
+        flash(f"โหลดเพลงของแท็กนี้ไม่ได้: {e}")
+        return redirect(url_for("index"))
+    _flash_if_stale(tracks)
     user_playlists = repo.list_playlists(int(current_user.id))
     return render_template("tag.html", tag=tag, tracks=tracks, user_playlists=user_playlists)
 
+# --- prefetch สำหรับ asgi.py: endpoint -> coroutine ที่ดึงข้อมูล Last.fm ชุดเดียวกับที่ view ใช้ ---
+# รับ (AsyncLastFMClient, request.args, view_args) คืน (results, errors) หรือ None ถ้าไม่ต้องดึง
+async def _prefetch_search(alf, args, view_args):
+    q = args.get("q", "").strip()
+    if not q:
+        return None
+    if args.get("mode", "genre") == "artist":
+        return await alf.gather({"results": alf.top_tracks_by_artist(q, limit=30)})
+    return await alf.gather({"results": alf.top_tracks_by_tag(q, limit=30)})
+
+async def _prefetch_artist(alf, args, view_args):
+    name = (args.get("name") or "").strip()
+    if not name:
+        return None
+    limit = args.get("limit", default=12, type=int)
+    return await alf.gather({
+        "similar": alf.similar_artists(name, limit=limit, autocorrect=1),
+        "top_tracks": alf.top_tracks_by_artist(name, limit=limit),
+    })
+
+async def _prefetch_tag(alf, args, view_args):
+    return await alf.gather({"tracks": alf.top_tracks_by_tag(view_args["tag"], limit=TAG_PAGE_LIMIT)})
+
+ASYNC_PREFETCH = {
+    "search": _prefetch_search,
+    "artist_view": _prefetch_artist,
+    "tag_view": _prefetch_tag,
+}
+
 if __name__ == "__main__":
     app.run(ssl_context="adhoc")  # dev-only self-signed
\ No newline at end of file
@@ -0,0 +1,114 @@
+"""
+ASGI entry point: gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+
+หน้าที่ต้องรอ Last.fm (search / artist / tag ดู app.ASYNC_PREFETCH) จะถูกดึงข้อมูลบน event loop
+ด้วย AsyncLastFMClient ก่อน แล้วจึงส่งต่อให้ Flask render ใน thread pool โดย view ใช้ผลที่ดึงไว้
+(app.prefetched) -> ระหว่างรอ upstream ไม่มี thread ถูกจอง, worker เดียวรอได้หลายร้อย request พร้อมกัน
+thread pool ใช้แค่ช่วง DB + render ที่สั้น
+"""
+from __future__ import annotations
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_cookie
+
+import app as flask_app
+from lastfm_async import AsyncLastFMClient
+
+log = logging.getLogger(__name__)
+
+# thread ที่รัน Flask (DB + render) ต่อ worker; ค่าเดียวกับ gthread เดิม
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("THREADS", "4")), thread_name_prefix="wsgi")
+
+
+class _WsgiToAsgiInstance(WsgiToAsgiInstance):
+    # ของ asgiref เป็น thread_sensitive=True -> ทุก request ต่อคิวกันบน thread เดียว
+    # (พึ่งโครงสร้างภายในของ asgiref: run_wsgi_app เป็น SyncToAsync ที่มี .func -> pin เวอร์ชันไว้ใน
+    # requirements.txt; test_asgi_run_wsgi_app_override_matches_asgiref เช็คไว้ตอนอัปเกรด)
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__["run_wsgi_app"].func,
+                                 thread_sensitive=False, executor=_executor)
+
+
+class _WsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await _WsgiToAsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+
+class PrefetchingASGIApp:
+    def __init__(self, app):
+        self.app = app
+        self.wsgi = _WsgiToAsgi(app)
+        self._alf: AsyncLastFMClient | None = None
+
+    @property
+    def alf(self) -> AsyncLastFMClient:
+        # สร้างตอนใช้ครั้งแรก (อยู่ใน event loop ของ worker แล้ว); ใช้ cache/limiter/breaker ร่วมกับ lastfm_client
+        if self._alf is None:
+            self._alf = AsyncLastFMClient(flask_app.lastfm_client)
+        return self._alf
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        data = None
+        prefetch = self._match_prefetch(scope)
+        if prefetch is not None:
+            fn, args, view_args = prefetch
+            try:
+                data = await fn(self.alf, args, view_args)
+            except Exception:
+                # ดึงไม่ได้ก็ปล่อยให้ view ยิงเองแบบ sync ตามเดิม
+                log.warning("async prefetch failed for %s", scope.get("path"), exc_info=True)
+        # context (รวม prefetched) ถูก copy ไปกับ thread ที่รัน Flask
+        token = flask_app.prefetched.set(data)
+        try:
+            await self.wsgi(scope, receive, send)
+        finally:
+            flask_app.prefetched.reset(token)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._alf is not None:
+                    await self._alf.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _match_prefetch(self, scope):
+        """(prefetcher, args, view_args) ถ้า path นี้มี prefetch และผู้ใช้ login อยู่ ไม่งั้น None"""
+        try:
+            adapter = self.app.url_map.bind("", script_name=scope.get("root_path") or None)
+            endpoint, view_args = adapter.match(scope["path"], method=scope["method"])
+        except Exception:           # 404 / 405 / redirect -> ให้ Flask ตอบเอง
+            return None
+        fn = flask_app.ASYNC_PREFETCH.get(endpoint)
+        if fn is None or not self._logged_in(scope):
+            return None         # view ที่ต้อง login จะ redirect อยู่แล้ว ไม่ยิง Last.fm ให้เปล่าๆ
+        args = MultiDict(parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True))
+        return fn, args, view_args
+
+    def _logged_in(self, scope) -> bool:
+        headers = dict(scope.get("headers") or [])
+        cookie = parse_cookie(headers.get(b"cookie", b"").decode("latin-1"))
+        value = cookie.get(self.app.config["SESSION_COOKIE_NAME"])
+        serializer = self.app.session_interface.get_signing_serializer(self.app)
+        if not value or serializer is None:
+            return False
+        try:
+            data = serializer.loads(value, max_age=int(self.app.permanent_session_lifetime.total_seconds()))
+        except Exception:
+            return False
+        return "_user_id" in data
+
+
+application = PrefetchingASGIApp(flask_app.app)
@@ -0,0 +1,87 @@
+"""
+/artist under slow Last.fm: gthread-style WSGI (THREADS threads) vs asgi.py (prefetch on the event loop).
+
+    python bench/async_upstream.py --requests 64 --latency-ms 200 --threads 4
+
+Both sides run one worker against bench/stub_upstream.py. Every request uses a
+different artist name, so each one waits for two uncached upstream calls. The
+rate limiter is raised out of the way: this measures how many slow upstream
+waits one worker can overlap, not Last.fm's quota.
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench.stub_upstream import start_stub  # noqa: E402
+
+
+def _setup(latency_ms: float, threads: int):
+    stub = start_stub(0, latency_ms)
+    os.environ.update({
+        "LASTFM_BASE_URL": f"http://127.0.0.1:{stub.server_port}/2.0/",
+        "LASTFM_API_KEY": "bench",
+        "DATABASE_URL": f"sqlite:///{tempfile.mkdtemp()}/bench.db",
+        "LASTFM_RATE_LIMIT": "100000",
+        "LASTFM_RATE_BURST": "100000",
+        "THREADS": str(threads),
+    })
+    import app as app_module
+    import asgi
+    uid = app_module.repo.create_user("bench", "x")
+    client = app_module.app.test_client()
+    with client.session_transaction() as s:
+        s["_user_id"] = str(uid)
+        s["_fresh"] = True
+    return app_module, asgi, client
+
+
+def run_wsgi(client, n: int, threads: int, tag: str) -> float:
+    def one(i):
+        r = client.get(f"/artist?name={tag}{i}")
+        assert r.status_code == 200, r.status_code
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as ex:
+        list(ex.map(one, range(n)))
+    return time.perf_counter() - t0
+
+
+async def _run_asgi(application, cookie: str, n: int, tag: str) -> float:
+    import httpx
+    transport = httpx.ASGITransport(app=application)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench",
+                                 cookies={"session": cookie}) as http:
+        t0 = time.perf_counter()
+        responses = await asyncio.gather(*(http.get("/artist", params={"name": f"{tag}{i}"}) for i in range(n)))
+        elapsed = time.perf_counter() - t0
+    assert all(r.status_code == 200 for r in responses), {r.status_code for r in responses}
+    await application.alf.aclose()
+    return elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=64)
+    ap.add_argument("--latency-ms", type=float, default=200.0)
+    ap.add_argument("--threads", type=int, default=4)
+    args = ap.parse_args()
+
+    app_module, asgi, client = _setup(args.latency_ms, args.threads)
+    cookie = client.get_cookie("session").value
+    n = args.requests
+
+    wsgi = run_wsgi(client, n, args.threads, "wsgi-")
+    aio = asyncio.run(_run_asgi(asgi.application, cookie, n, "asgi-"))
+    print(f"{n} x /artist, upstream latency {args.latency_ms:g} ms, {args.threads} threads")
+    print(f"  WSGI (gthread-style) : {wsgi:6.2f} s  {n / wsgi:7.1f} req/s")
+    print(f"  ASGI (asgi.py)       : {aio:6.2f} s  {n / aio:7.1f} req/s")
+
+
+if __name__ == "__main__":
+    main()
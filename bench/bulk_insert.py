@@ -0,0 +1,52 @@
+"""
+Playlist build time: one insert_playlist_track per track vs a single insert_playlist_tracks.
+
+    python bench/bulk_insert.py --sizes 10 100 1000
+
+Each run uses a fresh SQLite file in a temp dir, like the app's default music.db.
+"""
+from __future__ import annotations
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import PlaylistManager, Track  # noqa: E402
+from storage import StorageRepository  # noqa: E402
+
+
+def _build(n: int, bulk: bool) -> float:
+    with tempfile.TemporaryDirectory() as d:
+        repo = StorageRepository(f"sqlite:///{os.path.join(d, 'bench.db')}")
+        manager = PlaylistManager(repo)
+        uid = repo.create_user("bench", "x")
+        pid = repo.create_playlist(uid, "bench", "", False)
+        tracks = [Track(title=f"Track {i}", artist=f"Artist {i % 50}") for i in range(n)]
+
+        started = time.perf_counter()
+        if bulk:
+            manager.add_tracks(pid, tracks)
+        else:
+            for t in tracks:
+                manager.add_track(pid, t)
+        elapsed = time.perf_counter() - started
+        repo.engine.dispose()
+        return elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    args = ap.parse_args()
+
+    print(f"{'tracks':>7} {'per-track':>12} {'bulk':>12} {'speedup':>8}")
+    for n in args.sizes:
+        loop = _build(n, bulk=False)
+        bulk = _build(n, bulk=True)
+        print(f"{n:>7} {loop * 1000:>10.1f}ms {bulk * 1000:>10.1f}ms {loop / bulk:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
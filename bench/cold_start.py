@@ -0,0 +1,63 @@
+"""
+StorageRepository boot time vs. size of the legacy "playlist" table.
+
+    python bench/cold_start.py --rows 1000 10000 100000
+
+"first boot" runs the pending migrations (including the set-based legacy
+copy). "warm boot" is what every gunicorn worker pays afterwards, and it
+should stay flat as the table grows.
+"""
+from __future__ import annotations
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from storage import StorageRepository  # noqa: E402
+
+
+def _legacy_db(path: str, rows: int, users: int = 200):
+    raw = sqlite3.connect(path)
+    raw.executescript("""
+        CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL,
+                            password_hash TEXT NOT NULL, created_at TEXT NOT NULL);
+        CREATE TABLE playlist (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+                               title TEXT NOT NULL, artist TEXT NOT NULL, url TEXT, mbid TEXT,
+                               added_at TEXT NOT NULL);
+    """)
+    raw.executemany("INSERT INTO users (username, password_hash, created_at) VALUES (?, 'x', 'now')",
+                    [(f"user{i}",) for i in range(users)])
+    raw.executemany("INSERT INTO playlist (user_id, title, artist, added_at) VALUES (?, ?, ?, 'now')",
+                    [(i % users + 1, f"Track {i}", f"Artist {i % 97}") for i in range(rows)])
+    raw.commit()
+    raw.close()
+
+
+def _boot(url: str) -> float:
+    started = time.perf_counter()
+    repo = StorageRepository(url)
+    elapsed = time.perf_counter() - started
+    repo.engine.dispose()
+    return elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    args = ap.parse_args()
+
+    print(f"{'legacy rows':>12} {'first boot':>12} {'warm boot':>11}")
+    for n in args.rows:
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "legacy.db")
+            _legacy_db(path, n)
+            first = _boot(f"sqlite:///{path}")
+            warm = min(_boot(f"sqlite:///{path}") for _ in range(5))
+            print(f"{n:>12} {first * 1000:>10.1f}ms {warm * 1000:>9.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
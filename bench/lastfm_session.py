@@ -0,0 +1,67 @@
+"""
+Requests/sec of Last.fm calls: per-call requests.get vs LastFMClient's pooled keep-alive session.
+
+    python bench/lastfm_session.py --threads 8 --calls 200
+
+Runs against bench/stub_upstream.py on localhost with the response cache
+disabled, so every call goes over the wire. Against the real API the gap is
+larger, since each new connection there also pays a TLS handshake.
+"""
+from __future__ import annotations
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench.stub_upstream import start_stub  # noqa: E402
+from cache import MemoryCache  # noqa: E402
+from lastfm import LastFMClient  # noqa: E402
+from ratelimit import TokenBucket  # noqa: E402
+
+
+def _run(fn, threads: int, calls: int) -> float:
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as ex:
+        list(ex.map(lambda i: fn(i), range(threads * calls)))
+    return threads * calls / (time.perf_counter() - started)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--threads", type=int, default=8)
+    ap.add_argument("--calls", type=int, default=200, help="calls per thread")
+    ap.add_argument("--limit", type=int, default=5)
+    args = ap.parse_args()
+
+    server = start_stub()
+    base = f"http://127.0.0.1:{server.server_port}/2.0/"
+
+    def per_call(i):
+        # แบบเดิม: requests.get ระดับ module -> connection ใหม่ทุกครั้ง
+        p = {"api_key": "bench", "format": "json", "method": "tag.getTopTracks", "tag": f"t{i}", "limit": args.limit}
+        r = requests.get(base, params=p, timeout=15)
+        r.raise_for_status()
+        return r.json()
+
+    client = LastFMClient(api_key="bench", base_url=base, cache=MemoryCache(), pool_size=args.threads,
+                          ttls={"tag.getTopTracks": 0},
+                          rate_limiter=TokenBucket(rate=1e9, burst=10**9))   # วัด connection ไม่ใช่โควตา
+
+    def pooled(i):
+        return client.top_tracks_by_tag(f"t{i}", limit=args.limit)
+
+    before = _run(per_call, args.threads, args.calls)
+    after = _run(pooled, args.threads, args.calls)
+    print(f"threads={args.threads} calls={args.threads * args.calls} limit={args.limit}")
+    print(f"  requests.get per call : {before:8.1f} req/s")
+    print(f"  pooled session        : {after:8.1f} req/s  ({after / before:.2f}x)")
+    client.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Load test: drive the Flask routes at a fixed concurrency and report latency percentiles and req/s per route.
+
+    python bench/load.py --concurrency 16 --requests 400 --latency-ms 50
+    python bench/load.py --routes artist,tag --distinct 0 --error-rate 0.05 --errors 500,lastfm
+    python bench/load.py --url http://127.0.0.1:5000 --routes home,playlist,public
+
+By default the app runs in-process (werkzeug threaded server, temp SQLite DB)
+against bench/stub_upstream.py, so nothing hits the real Last.fm/Spotify.
+With --url it drives an already-running server instead (gunicorn, uvicorn
+asgi:application, ...). Start that server with LASTFM_BASE_URL/SPOTIFY_API_BASE
+pointing at `python bench/stub_upstream.py`.
+
+Each route gets --requests requests from --concurrency client threads. Every
+client thread keeps its own keep-alive session, logged in as one bench user.
+--distinct controls how many different tag/artist names are used: a small
+number measures the cache-hit path, and 0 makes every request unique (cold
+upstream path). A request counts as ok when it returns the route's expected
+status. A view that redirects home because Last.fm failed counts as a failure.
+"""
+from __future__ import annotations
+import argparse
+import json
+import math
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench.stub_upstream import ERROR_KINDS, start_stub  # noqa: E402
+
+
+class Route(NamedTuple):
+    path: str
+    expect: int = 200
+
+
+# placeholders: {tag} {artist} (ตาม --distinct), {pid} {token} (เพลย์ลิสต์ที่ seed ไว้)
+ROUTES: Dict[str, Route] = {
+    "home": Route("/"),
+    "search": Route("/search?q={tag}&mode=genre"),
+    "artist": Route("/artist?name={artist}"),
+    "tag": Route("/tag/{tag}"),
+    "playlists": Route("/playlists"),
+    "playlist": Route("/playlist/{pid}"),
+    "public": Route("/p/{token}"),
+    "export_csv": Route("/playlist/{pid}/export/csv"),
+    "export_spotify": Route("/playlist/{pid}/export/spotify", 302),
+}
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """nearest-rank percentile ของ list ที่เรียงแล้ว"""
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def _start_app(args) -> str:
+    """รัน app ใน process นี้ (ชี้ไปที่ stub) แล้วคืน base URL"""
+    stub = start_stub(0, args.latency_ms, args.jitter_ms, args.error_rate, args.errors.split(","), args.seed)
+    upstream = f"http://127.0.0.1:{stub.server_port}"
+    for k, v in {
+        "LASTFM_BASE_URL": f"{upstream}/2.0/",
+        "SPOTIFY_API_BASE": f"{upstream}/v1",
+        "LASTFM_API_KEY": "bench",
+        "DATABASE_URL": f"sqlite:///{tempfile.mkdtemp()}/bench.db",
+        # วัดตัว app ไม่ใช่โควตาของ Last.fm
+        "LASTFM_RATE_LIMIT": "100000",
+        "LASTFM_RATE_BURST": "100000",
+    }.items():
+        os.environ.setdefault(k, v)
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    import app as app_module
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True, request_handler=QuietHandler)
+    server.stub = stub
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    _start_app.server, _start_app.app_module = server, app_module
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def _seed(base: str, tracks: int) -> dict:
+    """สมัคร user ใหม่ + เพลย์ลิสต์สาธารณะ `tracks` เพลง ผ่าน HTTP (ใช้ได้ทั้ง in-process และ --url)"""
+    sess = requests.Session()
+    username = f"bench-{uuid.uuid4().hex[:8]}"
+    r = sess.post(f"{base}/register", data={"username": username, "password": "bench"}, allow_redirects=False)
+    r.raise_for_status()
+    r = sess.post(f"{base}/playlist/new", data={"name": "bench", "description": "load test", "is_public": "1"},
+                  allow_redirects=False)
+    pid = int(re.search(r"/playlist/(\d+)", r.headers["Location"]).group(1))
+    for i in range(tracks):
+        sess.post(f"{base}/playlist/{pid}/add", json={"title": f"Track {i}", "artist": f"Artist {i % 50}"},
+                  allow_redirects=False)
+    share = sess.get(f"{base}/playlist/{pid}/share")
+    token = re.search(r"/p/([\w\-]+)", share.text).group(1)
+    return {"cookies": sess.cookies.get_dict(), "pid": pid, "token": token, "username": username}
+
+
+def _connect_spotify(username: str):
+    # ใส่ token ปลอม (หมดอายุอีกนาน) ให้ user ของ bench -> export_spotify ยิง stub ได้โดยไม่ต้องผ่าน OAuth
+    repo = _start_app.app_module.repo
+    uid = repo.get_user_by_username(username)["id"]
+    repo.upsert_user_token(uid, "spotify", "bench-token", "bench-refresh", "2099-01-01T00:00:00")
+
+
+def run_route(base: str, route: Route, seed: dict, requests_n: int, concurrency: int,
+              distinct: int, warmup: int) -> dict:
+    local = threading.local()
+
+    def session() -> requests.Session:
+        if not hasattr(local, "sess"):
+            local.sess = requests.Session()
+            local.sess.cookies.update(seed["cookies"])
+        return local.sess
+
+    def url(i: int) -> str:
+        name = f"bench{i % distinct}" if distinct else f"bench-{uuid.uuid4().hex[:12]}"
+        return base + route.path.format(tag=name, artist=name, pid=seed["pid"], token=seed["token"])
+
+    def one(i: int):
+        t0 = time.perf_counter()
+        try:
+            r = session().get(url(i), allow_redirects=False, timeout=60)
+            r.content       # อ่าน body ให้ครบ (export แบบ stream)
+            ok = r.status_code == route.expect
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - t0, ok
+
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        list(ex.map(one, range(warmup)))
+        started = time.perf_counter()
+        results = list(ex.map(one, range(requests_n)))
+        elapsed = time.perf_counter() - started
+
+    latencies = sorted(d for d, _ in results)
+    return {
+        "requests": requests_n,
+        "ok": sum(ok for _, ok in results),
+        "rps": requests_n / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", help="drive an already-running server instead of starting one in-process")
+    ap.add_argument("--routes", default=",".join(r for r in ROUTES if r != "export_spotify"),
+                    help=f"comma-separated: {','.join(ROUTES)}")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--requests", type=int, default=200, help="requests per route")
+    ap.add_argument("--warmup", type=int, default=None, help="unmeasured requests per route (default: concurrency)")
+    ap.add_argument("--distinct", type=int, default=20, help="distinct tag/artist names; 0 = unique per request")
+    ap.add_argument("--tracks", type=int, default=100, help="tracks in the seeded playlist")
+    ap.add_argument("--latency-ms", type=float, default=50.0, help="stub upstream latency (in-process only)")
+    ap.add_argument("--jitter-ms", type=float, default=0.0)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--errors", default="500", help=f"comma-separated kinds: {','.join(ERROR_KINDS)}")
+    ap.add_argument("--seed", type=int, default=None)
+    ap.add_argument("--json", dest="json_out", help="also write the results to this file")
+    args = ap.parse_args()
+
+    routes = [r.strip() for r in args.routes.split(",") if r.strip()]
+    unknown = [r for r in routes if r not in ROUTES]
+    if unknown:
+        ap.error(f"unknown routes: {', '.join(unknown)}")
+    if args.url and "export_spotify" in routes:
+        ap.error("export_spotify needs a Spotify token in the DB; only available in-process")
+
+    base = args.url.rstrip("/") if args.url else _start_app(args)
+    seed = _seed(base, args.tracks)
+    if "export_spotify" in routes:
+        _connect_spotify(seed["username"])
+    warmup = args.concurrency if args.warmup is None else args.warmup
+
+    print(f"{base}  concurrency={args.concurrency} requests/route={args.requests} distinct={args.distinct}"
+          + ("" if args.url else f" upstream={args.latency_ms:g}ms+{args.jitter_ms:g} errors={args.error_rate:g}"))
+    print(f"{'route':<15}{'ok':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    report = {}
+    for name in routes:
+        res = run_route(base, ROUTES[name], seed, args.requests, args.concurrency, args.distinct, warmup)
+        report[name] = res
+        print(f"{name:<15}{res['ok']:>5}/{res['requests']:<4}{res['rps']:>10.1f}{res['p50_ms']:>10.1f}"
+              f"{res['p95_ms']:>10.1f}{res['p99_ms']:>10.1f}{res['max_ms']:>10.1f}")
+    if not args.url:
+        print("upstream:", dict(_start_app.server.stub.hits))
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump({"args": vars(args), "routes": report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Concurrent read/write throughput on one SQLite file from several processes
+(like gunicorn workers), "default" vs "production" SQLITE_PROFILE.
+
+    python bench/sqlite_concurrency.py --readers 4 --writers 2 --seconds 5
+"""
+from __future__ import annotations
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from models import Track  # noqa: E402
+from storage import StorageRepository  # noqa: E402
+
+
+def _worker(role: str, url: str, profile: str, uid: int, pid: int, seconds: float, out):
+    repo = StorageRepository(url, sqlite_profile=profile)
+    ops = errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            if role == "writer":
+                repo.insert_playlist_track(pid, Track(title=f"T{ops}", artist="bench"))
+            else:
+                repo.fetch_playlist_tracks(pid, uid, limit=50)
+                repo.list_playlists(uid)
+            ops += 1
+        except Exception:
+            errors += 1     # database is locked
+    out.put((role, ops, errors))
+
+
+def _run(profile: str, readers: int, writers: int, seconds: float):
+    with tempfile.TemporaryDirectory() as d:
+        url = f"sqlite:///{os.path.join(d, 'bench.db')}"
+        repo = StorageRepository(url, sqlite_profile=profile)
+        uid = repo.create_user("bench", "x")
+        pid = repo.create_playlist(uid, "bench", "", False)
+        repo.insert_playlist_tracks(pid, [Track(title=f"seed {i}", artist="bench") for i in range(200)])
+        repo.engine.dispose()
+
+        out = mp.Queue()
+        procs = [mp.Process(target=_worker, args=(role, url, profile, uid, pid, seconds, out))
+                 for role in ["reader"] * readers + ["writer"] * writers]
+        for p in procs:
+            p.start()
+        results = [out.get() for _ in procs]
+        for p in procs:
+            p.join()
+
+    totals = {"reader": [0, 0], "writer": [0, 0]}
+    for role, ops, errors in results:
+        totals[role][0] += ops
+        totals[role][1] += errors
+    return {role: (ops / seconds, errors) for role, (ops, errors) in totals.items()}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--readers", type=int, default=4)
+    ap.add_argument("--writers", type=int, default=2)
+    ap.add_argument("--seconds", type=float, default=5.0)
+    args = ap.parse_args()
+
+    print(f"{args.readers} reader + {args.writers} writer processes, {args.seconds:g}s each")
+    print(f"{'profile':>11} {'reads/s':>10} {'writes/s':>10} {'errors':>7}")
+    for profile in ("default", "production"):
+        r = _run(profile, args.readers, args.writers, args.seconds)
+        errors = r["reader"][1] + r["writer"][1]
+        print(f"{profile:>11} {r['reader'][0]:>10.0f} {r['writer'][0]:>10.0f} {errors:>7}")
+
+
+if __name__ == "__main__":
+    main()
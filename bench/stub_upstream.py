@@ -0,0 +1,210 @@
+"""
+Local stand-in for ws.audioscrobbler.com and api.spotify.com used by the benchmarks.
+
+    python bench/stub_upstream.py --port 8765 --latency-ms 20 --jitter-ms 10 --error-rate 0.02
+
+Point the app at it with
+    LASTFM_BASE_URL=http://127.0.0.1:8765/2.0/
+    SPOTIFY_API_BASE=http://127.0.0.1:8765/v1
+
+Responses are replayed from bench/fixtures/ (payloads in the shape the real
+APIs return). The requested tag/artist and `limit` are applied on top, so
+different names give different cache keys but the same payload size.
+
+Error injection: with --error-rate p, each request fails with probability p.
+The failure kind is picked from --errors:
+  500     HTTP 500
+  429     HTTP 429 + Retry-After: 1
+  lastfm  HTTP 200 with Last.fm error 29 (rate limit); Spotify paths get a 429 instead
+  reset   close the connection without a response
+"""
+from __future__ import annotations
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+ERROR_KINDS = ("500", "429", "lastfm", "reset")
+
+
+@lru_cache(maxsize=None)
+def _fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+        return f.read()
+
+
+def _load(name: str) -> dict:
+    # คืน copy ใหม่ทุกครั้ง (แก้ field ตาม request ได้โดยไม่กระทบ fixture)
+    return json.loads(_fixture(name))
+
+
+def _spotify_id(seed: str) -> str:
+    return hashlib.sha1(seed.encode()).hexdigest()[:22]
+
+
+def _lastfm_payload(query: dict) -> dict:
+    method = query.get("method", [""])[0]
+    limit = int(query.get("limit", ["50"])[0])
+    if method == "tag.getTopTracks":
+        data = _load("lastfm/tag.getTopTracks.json")
+        data["tracks"]["track"] = data["tracks"]["track"][:limit]
+        data["tracks"]["@attr"]["tag"] = query.get("tag", [""])[0]
+        return data
+    if method == "artist.getTopTracks":
+        artist = query.get("artist", [""])[0]
+        data = _load("lastfm/artist.getTopTracks.json")
+        data["toptracks"]["track"] = data["toptracks"]["track"][:limit]
+        for t in data["toptracks"]["track"]:
+            t["artist"]["name"] = artist
+        data["toptracks"]["@attr"]["artist"] = artist
+        return data
+    if method == "artist.getSimilar":
+        data = _load("lastfm/artist.getSimilar.json")
+        data["similarartists"]["artist"] = data["similarartists"]["artist"][:limit]
+        data["similarartists"]["@attr"]["artist"] = query.get("artist", [""])[0]
+        return data
+    return {"error": 3, "message": "Invalid Method - No method with that name in this package"}
+
+
+_USER_PLAYLISTS = re.compile(r"^/v1/users/([^/]+)/playlists$")
+_PLAYLIST_TRACKS = re.compile(r"^/v1/playlists/([^/]+)/tracks$")
+
+
+def _spotify_payload(method: str, path: str, query: dict, body: bytes) -> tuple[int, dict]:
+    if method == "GET" and path == "/v1/search":
+        q = query.get("q", [""])[0]
+        data = _load("spotify/search.json")
+        item = data["tracks"]["items"][0]
+        m = re.match(r"track:(.*) artist:(.*)", q)
+        if m:
+            item["name"], item["artists"][0]["name"] = m.group(1), m.group(2)
+        item["id"] = _spotify_id(q)
+        item["uri"] = f"spotify:track:{item['id']}"
+        return 200, data
+    if method == "GET" and path == "/v1/me":
+        return 200, _load("spotify/me.json")
+    m = _USER_PLAYLISTS.match(path)
+    if m and method == "POST":
+        data = _load("spotify/playlist.json")
+        req = json.loads(body or b"{}")
+        data.update({k: req[k] for k in ("name", "description", "public") if k in req})
+        data["id"] = _spotify_id(f"{time.time_ns()}{random.random()}")
+        data["uri"] = f"spotify:playlist:{data['id']}"
+        data["owner"]["id"] = m.group(1)
+        return 201, data
+    if m:
+        return 200, _load("spotify/user_playlists.json")
+    if _PLAYLIST_TRACKS.match(path):
+        if method == "POST":
+            return 201, _load("spotify/snapshot.json")
+        return 200, _load("spotify/playlist_tracks.json")
+    return 404, {"error": {"status": 404, "message": "Service not found"}}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive ได้
+    disable_nagle_algorithm = True
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    errors: tuple = ("500",)
+    rng: random.Random = random.Random()
+    hits: Counter = Counter()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        self._serve("GET")
+
+    def do_POST(self):
+        self._serve("POST")
+
+    def _serve(self, method: str):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        query = parse_qs(url.query)
+        spotify = url.path.startswith("/v1/")
+        with self.lock:
+            self.hits["spotify" if spotify else "lastfm"] += 1
+            delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+            error = self.rng.choice(self.errors) if self.rng.random() < self.error_rate else None
+        if delay:
+            time.sleep(delay)
+        if error:
+            with self.lock:
+                self.hits[f"error:{error}"] += 1
+            if error == "reset":
+                self.close_connection = True
+                return
+            if error == "lastfm" and not spotify:
+                return self._send(200, {"error": 29, "message": "Rate Limit Exceeded"})
+            if error in ("429", "lastfm"):
+                return self._send(429, {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                                  {"Retry-After": "1"})
+            return self._send(500, {"error": {"status": 500, "message": "Internal Server Error"}})
+        if spotify:
+            return self._send(*_spotify_payload(method, url.path, query, body))
+        self._send(200, _lastfm_payload(query))
+
+    def _send(self, status: int, payload: dict, headers: dict | None = None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub(port: int = 0, latency_ms: float = 0.0, jitter_ms: float = 0.0,
+               error_rate: float = 0.0, errors=("500",), seed: int | None = None) -> ThreadingHTTPServer:
+    """
+    Start the stub on a daemon thread; returns the server (server.server_port is the bound port,
+    server.hits counts requests per upstream and injected errors per kind).
+    """
+    unknown = set(errors) - set(ERROR_KINDS)
+    if unknown:
+        raise ValueError(f"unknown error kinds: {', '.join(sorted(unknown))}")
+    hits: Counter = Counter()
+    handler = type("Handler", (StubHandler,), {
+        "latency": latency_ms / 1000, "jitter": jitter_ms / 1000, "error_rate": error_rate,
+        "errors": tuple(errors), "rng": random.Random(seed), "hits": hits, "lock": threading.Lock(),
+    })
+    # backlog ค่าเริ่มต้น (5) ทำให้ connect พร้อมกันหลายสิบตัวโดน drop แล้วรอ SYN retry ~1s
+    server_cls = type("Server", (ThreadingHTTPServer,), {"request_queue_size": 1024})
+    server = server_cls(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.hits = hits
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--latency-ms", type=float, default=0.0)
+    ap.add_argument("--jitter-ms", type=float, default=0.0, help="extra uniform(0, jitter) latency per request")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail (0..1)")
+    ap.add_argument("--errors", default="500", help=f"comma-separated kinds: {','.join(ERROR_KINDS)}")
+    ap.add_argument("--seed", type=int, default=None)
+    args = ap.parse_args()
+    srv = start_stub(args.port, args.latency_ms, args.jitter_ms, args.error_rate,
+                     args.errors.split(","), args.seed)
+    print(f"stub Last.fm on http://127.0.0.1:{srv.server_port}/2.0/")
+    print(f"stub Spotify on http://127.0.0.1:{srv.server_port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        srv.shutdown()
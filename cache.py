@@ -0,0 +1,140 @@
+from __future__ import annotations
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 2048
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class MemoryCache:
+    """LRU cache ใน process + TTL ต่อ entry (thread-safe); เก็บเป็น JSON -> get() ได้สำเนาใหม่, จำกัดทั้งจำนวนและ byte"""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def _drop(self, key: str):
+        _, raw = self._data.pop(key)
+        self._bytes -= len(raw)
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._stats["misses"] += 1
+                return None
+            expires_at, raw = item
+            if expires_at <= time.monotonic():
+                self._drop(key)
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._data.move_to_end(key)
+            self._stats["hits"] += 1
+        return json.loads(raw)
+
+    def set(self, key: str, value: Any, ttl: float):
+        raw = json.dumps(value)         # ensure_ascii -> len(raw) = จำนวน byte
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            if len(raw) > self.max_bytes:
+                return
+            self._data[key] = (time.monotonic() + ttl, raw)
+            self._bytes += len(raw)
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._data)))
+                self._stats["evictions"] += 1
+
+    def delete(self, key: str):
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "entries": len(self._data), "bytes": self._bytes}
+
+
+class RedisCache:
+    """cache ที่ทุก worker ใช้ร่วมกันผ่าน Redis (JSON + SETEX; LRU ให้ Redis จัดการ); Redis ล่ม = miss"""
+
+    def __init__(self, client, prefix: str = "mdapp:"):
+        self.client = client
+        self.prefix = prefix
+        # นับเฉพาะของ process นี้ (eviction/ขนาดดูจาก INFO ของ Redis เอง)
+        self._stats = {"hits": 0, "misses": 0, "errors": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    @classmethod
+    def from_url(cls, url: str, prefix: str = "mdapp:") -> "RedisCache":
+        import redis
+        return cls(redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1), prefix)
+
+    def get(self, key: str) -> Optional[Any]:
+        try:
+            raw = self.client.get(self.prefix + key)
+        except Exception:
+            log.warning("redis cache get failed", exc_info=True)
+            self._count("errors")
+            self._count("misses")
+            return None
+        self._count("hits" if raw is not None else "misses")
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: str, value: Any, ttl: float):
+        try:
+            self.client.setex(self.prefix + key, max(1, int(ttl)), json.dumps(value))
+        except Exception:
+            log.warning("redis cache set failed", exc_info=True)
+
+    def delete(self, key: str):
+        try:
+            self.client.delete(self.prefix + key)
+        except Exception:
+            log.warning("redis cache delete failed", exc_info=True)
+
+    def clear(self):
+        try:
+            keys = list(self.client.scan_iter(match=self.prefix + "*"))
+            if keys:
+                self.client.delete(*keys)
+        except Exception:
+            log.warning("redis cache clear failed", exc_info=True)
+
+
+def make_cache(url: Optional[str] = None):
+    """
+    เลือก backend จาก CACHE_URL:
+    - redis://... / rediss://... / unix://...  -> RedisCache (แชร์ข้าม worker)
+    - ว่าง หรือ "memory"                        -> MemoryCache (ต่อ process)
+    """
+    url = url if url is not None else os.getenv("CACHE_URL", "")
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCache.from_url(url)
+    return MemoryCache(int(os.getenv("CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+                       int(os.getenv("CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)))
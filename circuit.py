@@ -0,0 +1,58 @@
+from __future__ import annotations
+import threading
+import time
+
+
+class CircuitOpenError(RuntimeError):
+    """ไม่ยิง upstream เพราะ circuit เปิดอยู่ (ล้มเหลวติดกันหลายครั้ง)"""
+
+
+class CircuitBreaker:
+    """
+    closed    -> ยิงได้ปกติ; ล้มเหลวติดกัน `failure_threshold` ครั้ง -> open
+    open      -> ปฏิเสธทันทีจนครบ `reset_timeout` วินาที -> half_open
+    half_open -> ปล่อยให้ลองยิงได้ทีละ 1 call: สำเร็จ -> closed, ล้มเหลว -> open อีกรอบ
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now: float) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if now - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._state(time.monotonic())
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
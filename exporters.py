@@ -0,0 +1,88 @@
+"""
+export เพลย์ลิสต์ (csv / jsonl / m3u / xspf) แบบ stream ทีละก้อน
+
+แต่ละ format รับ meta ของเพลย์ลิสต์ + iterator ของเพลง (StorageRepository.iter_playlist_tracks)
+แล้ว yield เป็น string -> ส่งเพลย์ลิสต์ขนาดเท่าไรก็ได้โดยไม่ต้องสร้างทั้งไฟล์ใน memory/ดิสก์
+"""
+from __future__ import annotations
+import csv
+import io
+import json
+from typing import Callable, Dict, Iterable, Iterator, NamedTuple
+from xml.sax.saxutils import escape
+
+CSV_FIELDS = ["id", "title", "artist", "url", "mbid", "position", "added_at"]
+CHUNK_SIZE = 16 * 1024     # รวมหลายแถวเป็นก้อนเดียวก่อนส่ง (ไม่ flush ทีละบรรทัด)
+
+
+def _chunked(parts: Iterable[str], size: int = CHUNK_SIZE) -> Iterator[str]:
+    buf, n = [], 0
+    for part in parts:
+        buf.append(part)
+        n += len(part)
+        if n >= size:
+            yield "".join(buf)
+            buf, n = [], 0
+    if buf:
+        yield "".join(buf)
+
+
+def _csv_lines(pl: dict, rows: Iterable[dict]) -> Iterator[str]:
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for r in rows:
+        writer.writerow(r)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    yield out.getvalue()
+
+
+def _jsonl_lines(pl: dict, rows: Iterable[dict]) -> Iterator[str]:
+    for r in rows:
+        yield json.dumps({k: r.get(k) for k in CSV_FIELDS}, ensure_ascii=False) + "\n"
+
+
+def _m3u_lines(pl: dict, rows: Iterable[dict]) -> Iterator[str]:
+    yield "#EXTM3U\n"
+    yield f"#PLAYLIST:{pl['name']}\n"
+    for r in rows:
+        yield f"#EXTINF:-1,{r['artist']} - {r['title']}\n"
+        if r.get("url"):
+            yield f"{r['url']}\n"
+
+
+def _xspf_lines(pl: dict, rows: Iterable[dict]) -> Iterator[str]:
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<playlist version="1" xmlns="http://xspf.org/ns/0/">\n'
+    yield f"  <title>{escape(pl['name'])}</title>\n"
+    yield "  <trackList>\n"
+    for r in rows:
+        yield "    <track>"
+        yield f"<title>{escape(r['title'])}</title><creator>{escape(r['artist'])}</creator>"
+        if r.get("url"):
+            yield f"<location>{escape(r['url'])}</location>"
+        if r.get("mbid"):
+            yield f"<identifier>https://musicbrainz.org/recording/{escape(r['mbid'])}</identifier>"
+        yield "</track>\n"
+    yield "  </trackList>\n</playlist>\n"
+
+
+class ExportFormat(NamedTuple):
+    mimetype: str
+    extension: str
+    lines: Callable[[dict, Iterable[dict]], Iterator[str]]
+
+
+EXPORT_FORMATS: Dict[str, ExportFormat] = {
+    "csv": ExportFormat("text/csv", "csv", _csv_lines),
+    "jsonl": ExportFormat("application/x-ndjson", "jsonl", _jsonl_lines),
+    "m3u": ExportFormat("audio/x-mpegurl", "m3u", _m3u_lines),
+    "xspf": ExportFormat("application/xspf+xml", "xspf", _xspf_lines),
+}
+
+
+def stream_export(fmt: str, pl: dict, rows: Iterable[dict]) -> Iterator[str]:
+    """chunk ของไฟล์ export ตาม fmt (ต้องเป็น key ใน EXPORT_FORMATS)"""
+    return _chunked(EXPORT_FORMATS[fmt].lines(pl, rows))
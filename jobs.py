@@ -0,0 +1,86 @@
+from __future__ import annotations
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+log = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+
+
+class _HandlerRegistry:
+    def __init__(self):
+        self.handlers: Dict[str, Callable[..., None]] = {}
+        self.on_error: Optional[Callable[[str, Exception], None]] = None
+
+    def register(self, name: str, fn: Callable[..., None]):
+        self.handlers[name] = fn
+
+    def _run(self, name: str, job_id: str, kwargs: dict):
+        try:
+            self.handlers[name](job_id, **kwargs)
+        except Exception as e:
+            log.exception("job %s (%s) failed", job_id, name)
+            if self.on_error:
+                self.on_error(job_id, e)
+
+
+class LocalJobQueue(_HandlerRegistry):
+    """
+    รัน job บน thread pool ของ process เอง (ไม่ต้องมี Redis)
+    thread เหล่านี้แยกจาก gthread ของ gunicorn จึงไม่กิน slot ของ request
+    """
+
+    def __init__(self, max_workers: int = JOB_WORKERS):
+        super().__init__()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+
+    def enqueue(self, name: str, job_id: str, **kwargs):
+        if name not in self.handlers:
+            raise KeyError(f"Unknown job type: {name}")
+        self._executor.submit(self._run, name, job_id, kwargs)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+
+class RedisJobQueue(_HandlerRegistry):
+    """
+    ส่ง job เข้า Redis list; process worker แยก (`flask --app app run-jobs`) เป็นคนดึงไปรัน
+    เหมาะกับตอนที่อยากให้ web worker ไม่ต้องแบกงานยาวเลย
+    """
+
+    def __init__(self, client, key: str = "mdapp:jobs"):
+        super().__init__()
+        self.client = client
+        self.key = key
+
+    @classmethod
+    def from_url(cls, url: str, key: str = "mdapp:jobs") -> "RedisJobQueue":
+        import redis
+        return cls(redis.Redis.from_url(url), key)
+
+    def enqueue(self, name: str, job_id: str, **kwargs):
+        if name not in self.handlers:
+            raise KeyError(f"Unknown job type: {name}")
+        self.client.rpush(self.key, json.dumps({"name": name, "job_id": job_id, "kwargs": kwargs}))
+
+    def work(self, max_workers: int = JOB_WORKERS, poll_timeout: int = 5):
+        """Blocking worker loop: pop jobs from Redis and run them on a local pool."""
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job") as ex:
+            while True:
+                item = self.client.blpop(self.key, timeout=poll_timeout)
+                if not item:
+                    continue
+                msg = json.loads(item[1])
+                ex.submit(self._run, msg["name"], msg["job_id"], msg.get("kwargs", {}))
+
+
+def make_job_queue(url: Optional[str] = None):
+    """JOB_QUEUE_URL=redis://... -> RedisJobQueue, ไม่ตั้ง -> LocalJobQueue"""
+    url = url if url is not None else os.getenv("JOB_QUEUE_URL", "")
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisJobQueue.from_url(url)
+    return LocalJobQueue()
@@ -1,14 +1,57 @@
 from __future__ import annotations
+import hashlib
+import logging
 import os
+import random
+import threading
+import time
 import requests
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, Callable, Iterable, List, Dict, Tuple
+from urllib.parse import urlencode
 from dotenv import load_dotenv
-from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from cache import make_cache
+from circuit import CircuitBreaker, CircuitOpenError
+from metrics import observe_upstream
+from ratelimit import make_rate_limiter, parse_retry_after
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 LASTFM_API_KEY = os.getenv("LASTFM_API_KEY", "")
-LASTFM_BASE = "https://ws.audioscrobbler.com/2.0/"
+LASTFM_BASE = os.getenv("LASTFM_BASE_URL", "https://ws.audioscrobbler.com/2.0/")
+
+# connection pool / timeout (connect กับ read แยกกัน)
+LASTFM_POOL_SIZE = int(os.getenv("LASTFM_POOL_SIZE", "10"))
+LASTFM_CONNECT_TIMEOUT = float(os.getenv("LASTFM_CONNECT_TIMEOUT", "3.05"))
+LASTFM_READ_TIMEOUT = float(os.getenv("LASTFM_READ_TIMEOUT", "10"))
+# จำนวน call ที่ยิงพร้อมกันได้ต่อ client (ใช้กับ gather)
+LASTFM_MAX_CONCURRENCY = int(os.getenv("LASTFM_MAX_CONCURRENCY", "8"))
+
+# retry เมื่อโดน rate limit (error 29) / Last.fm ล่มชั่วคราว (11, 16) / HTTP 5xx
+# รอแบบ exponential backoff + full jitter: uniform(0, min(cap, base * 2**attempt))
+LASTFM_MAX_RETRIES = int(os.getenv("LASTFM_MAX_RETRIES", "2"))
+LASTFM_BACKOFF_BASE = float(os.getenv("LASTFM_BACKOFF_BASE", "0.5"))
+LASTFM_BACKOFF_CAP = float(os.getenv("LASTFM_BACKOFF_CAP", "8"))
+RETRYABLE_ERRORS = {11, 16, 29}
+RATE_LIMIT_ERROR = 29
+
+# อายุ cache (วินาที) ต่อ Last.fm method
+CACHE_TTLS = {
+    "tag.getTopTracks": 6 * 3600,
+    "artist.getTopTracks": 6 * 3600,
+    "artist.getSimilar": 24 * 3600,
+}
+DEFAULT_CACHE_TTL = 3600
+# หลังหมดอายุ entry ยังอยู่ใน cache อีกช่วงหนึ่ง: ใช้ตอบทันที (flag stale) ระหว่าง refresh เบื้องหลัง
+# หรือตอน Last.fm ล่ม/circuit เปิด
+LASTFM_STALE_TTL = float(os.getenv("LASTFM_STALE_TTL", str(7 * 24 * 3600)))
+
+# circuit breaker: ล้มเหลวติดกัน N ครั้ง -> ไม่ยิง Last.fm เลย (ตอบ error/ของ stale ทันที) เป็นเวลา RESET วินาที
+LASTFM_BREAKER_FAILURES = int(os.getenv("LASTFM_BREAKER_FAILURES", "5"))
+LASTFM_BREAKER_RESET = float(os.getenv("LASTFM_BREAKER_RESET", "30"))
 
 def _pick_image(images: list, preferred=("extralarge","mega","large","medium")) -> str | None:
     by_size = {img.get("size"): img.get("#text") for img in images or []}
@@ -20,70 +63,372 @@ def _pick_image(images: list, preferred=("extralarge","mega","large","medium"))
             return img["#text"]
     return None
 
+class StaleList(list):
+    """ผลลัพธ์จาก cache ที่หมดอายุแล้ว (กำลัง refresh เบื้องหลัง หรือ Last.fm ใช้ไม่ได้)"""
+    stale = True
+
+class _StaleDict(dict):
+    stale = True
+
+def _result(data: Dict, items: list) -> list:
+    return StaleList(items) if getattr(data, "stale", False) else items
+
+class LastFMError(RuntimeError):
+    def __init__(self, code, message):
+        super().__init__(f"Last.fm error {code}: {message}")
+        self.code = code
+
+class _Retryable(Exception):
+    def __init__(self, error: Exception, retry_after: float | None = None):
+        self.error = error
+        self.retry_after = retry_after
+
 class LastFMClient:
-    def __init__(self, api_key: str | None = None):
+    def __init__(self, api_key: str | None = None, cache=None, ttls: Dict[str, float] | None = None,
+                 base_url: str | None = None, pool_size: int | None = None,
+                 connect_timeout: float | None = None, read_timeout: float | None = None,
+                 max_concurrency: int | None = None, rate_limiter=None,
+                 max_retries: int | None = None, backoff_base: float | None = None,
+                 breaker: CircuitBreaker | None = None, stale_ttl: float | None = None):
         self.api_key = api_key or LASTFM_API_KEY
         if not self.api_key:
             raise RuntimeError("Missing LASTFM_API_KEY. Put it in .env")
+        self.base_url = base_url or LASTFM_BASE
+        self._key_ns = hashlib.sha256(self.api_key.encode()).hexdigest()[:12]
+        self.timeout = (connect_timeout or LASTFM_CONNECT_TIMEOUT, read_timeout or LASTFM_READ_TIMEOUT)
+        self.session = self._make_session(pool_size or LASTFM_POOL_SIZE)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency or LASTFM_MAX_CONCURRENCY,
+                                            thread_name_prefix="lastfm")
+        # MemoryCache (ต่อ worker) หรือ RedisCache (แชร์ทุก worker) ตาม CACHE_URL
+        self.cache = cache if cache is not None else make_cache()
+        self.ttls = {**CACHE_TTLS, **(ttls or {})}
+        # token bucket ต่อ process หรือแชร์ทุก worker ผ่าน Redis (RATE_LIMIT_URL / CACHE_URL)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else make_rate_limiter()
+        self.max_retries = LASTFM_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_base = LASTFM_BACKOFF_BASE if backoff_base is None else backoff_base
+        self.breaker = breaker or CircuitBreaker(LASTFM_BREAKER_FAILURES, LASTFM_BREAKER_RESET)
+        self.stale_ttl = LASTFM_STALE_TTL if stale_ttl is None else stale_ttl
+        self._refreshing: set = set()
+        self._refresh_lock = threading.Lock()
+        # throttled = ต้องรอ token, retried = ยิงซ้ำ, rate_limited = ได้ error 29 กลับมา
+        # stale = ตอบจาก entry ที่หมดอายุ, short_circuited = ไม่ได้ยิงเพราะ circuit เปิด
+        self.stats = {"requests": 0, "throttled": 0, "retried": 0, "rate_limited": 0,
+                      "stale": 0, "short_circuited": 0}
+        self._stats_lock = threading.Lock()
+
+    @staticmethod
+    def _make_session(pool_size: int) -> requests.Session:
+        """
+        Session เดียวใช้ร่วมกันทุก thread ของ worker: urllib3 connection pool เป็น thread-safe
+        และเก็บ connection ไว้ (keep-alive) จึงไม่ต้อง TCP+TLS handshake ใหม่ทุก call
+        """
+        sess = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        sess.mount("https://", adapter)
+        sess.mount("http://", adapter)
+        sess.headers.update({"Connection": "keep-alive"})
+        return sess
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+    def gather(self, calls: Dict[str, Callable[[], Any]],
+               timeout: float | None = None) -> Tuple[Dict[str, Any], Dict[str, Exception]]:
+        """
+        ยิง call ที่ไม่ขึ้นต่อกันพร้อมกันบน executor ของ client แล้วรอผลรวม
+        -> latency ของหน้า = max(latency) แทน sum(latency)
+
+        คืน (results, errors) โดยใช้ key เดียวกับ `calls`; call ที่ error หรือเกิน
+        `timeout` (วินาที นับจากตอนเริ่ม) จะอยู่ใน errors แทน จึง render ผลที่เหลือได้
+        """
+        if timeout is None:
+            timeout = sum(self.timeout)
+        futures = {key: self._executor.submit(fn) for key, fn in calls.items()}
+        deadline = time.monotonic() + timeout
+        results: Dict[str, Any] = {}
+        errors: Dict[str, Exception] = {}
+        for key, fut in futures.items():
+            try:
+                results[key] = fut.result(timeout=max(0.0, deadline - time.monotonic()))
+            except FutureTimeout:
+                fut.cancel()
+                errors[key] = TimeoutError(f"{key} timed out after {timeout:g}s")
+            except Exception as e:
+                errors[key] = e
+        return results, errors
+
+    def _batch(self, fn: Callable[[str], Any], keys: Iterable[str],
+               timeout: float | None) -> Tuple[Dict[str, Any], Dict[str, Exception]]:
+        # key ซ้ำยิงครั้งเดียว; ทุก batch ใช้ executor ตัวเดียวกัน -> จำนวน call พร้อมกันรวมทั้ง worker
+        # ไม่เกิน max_concurrency ไม่ว่าจะมีกี่ request เรียก batch พร้อมกัน
+        return self.gather({k: (lambda k=k: fn(k)) for k in dict.fromkeys(keys)}, timeout=timeout)
+
+    def top_tracks_by_tags(self, tags: Iterable[str], limit: int = 20,
+                           timeout: float | None = None) -> Tuple[Dict[str, List[Dict]], Dict[str, Exception]]:
+        """top_tracks_by_tag หลาย tag พร้อมกัน -> ({tag: tracks}, {tag: error})"""
+        return self._batch(lambda tag: self.top_tracks_by_tag(tag, limit=limit), tags, timeout)
+
+    def top_tracks_by_artists(self, artists: Iterable[str], limit: int = 20,
+                              timeout: float | None = None) -> Tuple[Dict[str, List[Dict]], Dict[str, Exception]]:
+        """top_tracks_by_artist หลายศิลปินพร้อมกัน -> ({artist: tracks}, {artist: error})"""
+        return self._batch(lambda artist: self.top_tracks_by_artist(artist, limit=limit), artists, timeout)
+
+    def warm_tags(self, tags: Iterable[str], limit: int = 20, force: bool = False) -> Dict[str, Exception]:
+        """
+        ดึง top tracks ของ tag ใหม่แล้วเขียนทับลง cache; คืน error ราย tag
+        tag ที่ entry ใน cache ยังสดเกิน 10% ของ TTL ถูกข้าม (force=True = ดึงใหม่ทุก tag)
+        -> หลาย worker ที่ใช้ Redis ร่วมกัน: ตัวแรกที่ถึงรอบเป็นคนดึง ตัวอื่นเห็นว่ายังสดแล้วข้าม
+        """
+        def warm(tag: str):
+            params = self._tag_params(tag, limit)
+            if force or self._fresh_for(params) <= 0.1 * self._ttl(params):
+                self._get(params, refresh=True)
+
+        _, errors = self._batch(warm, tags, None)
+        return errors
+
+    def start_warmer(self, tags: Iterable[str], limit: int = 20, interval: float | None = None) -> threading.Event:
+        """
+        warm_tags ทันทีใน daemon thread แล้วทำซ้ำทุก `interval` วินาที
+        (ค่าเริ่มต้น 90% ของ TTL ของ tag.getTopTracks -> entry ถูกเขียนทับก่อนหมดอายุ)
+        คืน Event: set() เพื่อหยุด
+        """
+        tags = list(tags)
+        if interval is None:
+            interval = 0.9 * self.ttls.get("tag.getTopTracks", DEFAULT_CACHE_TTL)
+        stop = threading.Event()
+
+        def loop():
+            while not stop.is_set():
+                errors = self.warm_tags(tags, limit=limit)
+                if errors:
+                    log.warning("Last.fm warmer: %d/%d tags failed: %s", len(errors), len(tags),
+                                ", ".join(f"{k} ({e})" for k, e in errors.items()))
+                stop.wait(interval)
+
+        threading.Thread(target=loop, name="lastfm-warmer", daemon=True).start()
+        return stop
+
+    def _cache_key(self, params: Dict) -> str:
+        # Last.fm ไม่สนตัวพิมพ์เล็ก/ใหญ่ของ tag/artist -> "K-Pop" กับ " k-pop" ใช้ key เดียวกัน
+        # แยก namespace ตาม API key (hash ไม่ใช่ตัว key จริง) -> client คนละ key ที่ใช้ Redis ร่วมกันไม่ปนกัน
+        norm = sorted((str(k), str(v).strip().lower()) for k, v in params.items())
+        return f"lastfm:{self._key_ns}:{urlencode(norm)}"
 
-    def _get(self, params: Dict) -> Dict:
-        p = {
-            "api_key": self.api_key,
-            "format": "json",
-        }
-        p.update(params)
-        r = requests.get(LASTFM_BASE, params=p, timeout=15)
+    def _get(self, params: Dict, refresh: bool = False) -> Dict:
+        data = None if refresh else self._lookup(params)
+        if data is not None:
+            return data
+        data = self._fetch(params)
+        self._store(params, data)
+        return data
+
+    def _ttl(self, params: Dict) -> float:
+        return self.ttls.get(params.get("method"), DEFAULT_CACHE_TTL)
+
+    def _fresh_for(self, params: Dict) -> float:
+        """อีกกี่วินาที entry ใน cache จะหมดอายุ (<= 0 = ไม่มี/หมดแล้ว)"""
+        entry = self.cache.get(self._cache_key(params))
+        if not (isinstance(entry, dict) and "fetched_at" in entry):
+            return 0.0
+        return self._ttl(params) - (time.time() - entry["fetched_at"])
+
+    def _lookup(self, params: Dict) -> Dict | None:
+        """ของใน cache: ยังสด -> data, หมดอายุแล้ว -> _StaleDict (+ refresh เบื้องหลัง), ไม่มี -> None"""
+        entry = self.cache.get(self._cache_key(params))
+        if not (isinstance(entry, dict) and "fetched_at" in entry):
+            return None
+        if time.time() - entry["fetched_at"] < self._ttl(params):
+            return entry["data"]
+        # หมดอายุแล้ว: ตอบของเดิมทันที (stale) แล้ว refresh เบื้องหลัง ไม่ให้ request รอ Last.fm
+        self._count("stale")
+        self._refresh_in_background(params)
+        return _StaleDict(entry["data"])
+
+    def _store(self, params: Dict, data: Dict):
+        ttl = self._ttl(params)
+        if ttl > 0:
+            self.cache.set(self._cache_key(params), {"fetched_at": time.time(), "data": data}, ttl + self.stale_ttl)
+
+    def _refresh_in_background(self, params: Dict):
+        key = self._cache_key(params)
+        with self._refresh_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self._get(params, refresh=True)
+            except Exception as e:
+                log.info("Last.fm background refresh failed for %s: %s", params.get("method"), e)
+            finally:
+                with self._refresh_lock:
+                    self._refreshing.discard(key)
+
+        try:
+            self._executor.submit(run)
+        except RuntimeError:        # executor ปิดไปแล้ว (client.close())
+            with self._refresh_lock:
+                self._refreshing.discard(key)
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def stats_snapshot(self) -> Dict[str, int]:
+        """สำเนาของ stats ณ ตอนนี้ (อ่านใต้ lock ไม่เห็นค่าที่กำลังถูกนับครึ่งๆ กลางๆ)"""
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(LASTFM_BACKOFF_CAP, self.backoff_base * 2 ** attempt))
+
+    def _fetch(self, params: Dict) -> Dict:
+        self._enter_breaker()
+        try:
+            data = self._fetch_with_retries(params)
+        except Exception as e:
+            self._record_error(e)
+            raise
+        self.breaker.record_success()
+        return data
+
+    def _enter_breaker(self):
+        if not self.breaker.allow():
+            self._count("short_circuited")
+            raise CircuitOpenError("Last.fm is unavailable right now (circuit open)")
+
+    def _record_error(self, e: Exception):
+        # error ฝั่งข้อมูล (เช่น 6 = ไม่พบ) แปลว่า Last.fm ยังตอบได้ปกติ
+        if isinstance(e, LastFMError) and e.code not in RETRYABLE_ERRORS:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    def _fetch_with_retries(self, params: Dict) -> Dict:
+        attempt = 0
+        while True:
+            if self.rate_limiter.acquire(max_wait=self.timeout[1]) > 0:
+                self._count("throttled")
+            self._count("requests")
+            try:
+                return self._fetch_once(params)
+            except _Retryable as e:
+                if attempt >= self.max_retries:
+                    raise e.error
+                delay = max(self._backoff(attempt), e.retry_after or 0)
+                attempt += 1
+                self._count("retried")
+                log.info("Last.fm %s: retry %d in %.2fs (%s)", params.get("method"), attempt, delay, e.error)
+                time.sleep(delay)
+
+    def _request_params(self, params: Dict) -> Dict:
+        return {"api_key": self.api_key, "format": "json", **params}
+
+    def _fetch_once(self, params: Dict) -> Dict:
+        started, r, error = time.perf_counter(), None, None
+        try:
+            r = self.session.get(self.base_url, params=self._request_params(params), timeout=self.timeout)
+            return self._check_response(r)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._observe(params, started, r, error)
+
+    def _observe(self, params: Dict, started: float, r, error: Exception | None):
+        """metrics ของการยิง 1 ครั้ง: status = HTTP status / lastfm_<error code> / error (ต่อไม่ได้)"""
+        err = error.error if isinstance(error, _Retryable) else error
+        if isinstance(err, LastFMError):
+            status = f"lastfm_{err.code}"
+        else:
+            status = r.status_code if r is not None else "error"
+        observe_upstream("lastfm", params.get("method", ""), status, time.perf_counter() - started)
+
+    def _check_response(self, r) -> Dict:
+        """
+        แปลง response (requests หรือ httpx) เป็น data; 5xx/429 และ error ที่ retry ได้ -> _Retryable
+        (ใช้ร่วมกับ AsyncLastFMClient)
+        """
+        if r.status_code >= 500 or r.status_code == 429:
+            try:
+                r.raise_for_status()
+            except Exception as e:
+                raise _Retryable(e, parse_retry_after(r.headers.get("Retry-After")))
         r.raise_for_status()
         data = r.json()
         # หาก Last.fm ส่ง error format กลับมา
         if isinstance(data, dict) and data.get("error"):
-            raise RuntimeError(f"Last.fm error {data.get('error')}: {data.get('message')}")
+            err = LastFMError(data.get("error"), data.get("message"))
+            if err.code == RATE_LIMIT_ERROR:
+                # โควตาของทั้ง IP หมด -> ให้ทุก thread/worker ที่ใช้ bucket เดียวกันหยุดด้วย
+                self._count("rate_limited")
+                self.rate_limiter.penalize(self.backoff_base)
+            if err.code in RETRYABLE_ERRORS:
+                raise _Retryable(err)
+            raise err
         return data
 
+    @staticmethod
+    def _tag_params(tag: str, limit: int) -> Dict:
+        return {"method": "tag.getTopTracks", "tag": tag, "limit": limit}
+
+    @staticmethod
+    def _artist_params(artist: str, limit: int) -> Dict:
+        return {"method": "artist.getTopTracks", "artist": artist, "limit": limit}
+
+    @staticmethod
+    def _similar_params(artist: str, limit: int, autocorrect: int) -> Dict:
+        return {"method": "artist.getSimilar", "artist": artist, "limit": limit, "autocorrect": autocorrect}
+
     def top_tracks_by_tag(self, tag: str, limit: int = 20) -> List[Dict]:
-        data = self._get({"method": "tag.getTopTracks", "tag": tag, "limit": limit})
-        tracks = data.get("tracks", {}).get("track", [])
-        return [
-            {
-                "title": t.get("name"),
-                "artist": t.get("artist", {}).get("name"),
-                "url": t.get("url"),
-                "mbid": t.get("mbid")
-            } for t in tracks
-        ]
+        return _shape_tag_tracks(self._get(self._tag_params(tag, limit)))
 
     def top_tracks_by_artist(self, artist: str, limit: int = 20) -> List[Dict]:
-        data = self._get({"method": "artist.getTopTracks", "artist": artist, "limit": limit})
-        tracks = data.get("toptracks", {}).get("track", [])
-        return [
-            {
-                "title": t.get("name"),
-                "artist": artist,
-                "url": t.get("url"),
-                "mbid": t.get("mbid")
-            } for t in tracks
-        ]
-
-    @lru_cache(maxsize=512)
+        return _shape_artist_tracks(self._get(self._artist_params(artist, limit)), artist)
+
     def similar_artists(self, artist: str, limit: int = 12, autocorrect: int = 1) -> List[Dict]:
         """
         คืนรูปแบบ:
         [{"name","url","mbid","match"(0..1),"image"}]
         """
-        data = self._get({
-            "method": "artist.getSimilar",
+        return _shape_similar(self._get(self._similar_params(artist, limit, autocorrect)))
+
+
+# ---- แปลง payload ของ Last.fm เป็นรูปแบบที่ template ใช้ (ใช้ร่วมกับ AsyncLastFMClient) ----
+def _shape_tag_tracks(data: Dict) -> List[Dict]:
+    tracks = data.get("tracks", {}).get("track", [])
+    return _result(data, [
+        {
+            "title": t.get("name"),
+            "artist": t.get("artist", {}).get("name"),
+            "url": t.get("url"),
+            "mbid": t.get("mbid")
+        } for t in tracks
+    ])
+
+def _shape_artist_tracks(data: Dict, artist: str) -> List[Dict]:
+    tracks = data.get("toptracks", {}).get("track", [])
+    return _result(data, [
+        {
+            "title": t.get("name"),
             "artist": artist,
-            "limit": limit,
-            "autocorrect": autocorrect
+            "url": t.get("url"),
+            "mbid": t.get("mbid")
+        } for t in tracks
+    ])
+
+def _shape_similar(data: Dict) -> List[Dict]:
+    artists = data.get("similarartists", {}).get("artist", [])
+    result = []
+    for a in artists:
+        result.append({
+            "name": a.get("name"),
+            "url": a.get("url"),
+            "mbid": a.get("mbid"),
+            "match": float(a.get("match", 0.0)),
+            "image": _pick_image(a.get("image", [])),
         })
-        artists = data.get("similarartists", {}).get("artist", [])
-        result = []
-        for a in artists:
-            result.append({
-                "name": a.get("name"),
-                "url": a.get("url"),
-                "mbid": a.get("mbid"),
-                "match": float(a.get("match", 0.0)),
-                "image": _pick_image(a.get("image", [])),
-            })
-        return result
+    return _result(data, result)
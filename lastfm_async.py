@@ -0,0 +1,141 @@
+"""
+Last.fm client บน asyncio (httpx.AsyncClient)
+
+ใช้ cache / TTL / rate limiter / circuit breaker / stats ร่วมกับ LastFMClient ตัวที่ส่งเข้ามา
+ต่างกันแค่ transport: call ที่รอ Last.fm อยู่ไม่กิน thread -> event loop เดียวรอได้หลายร้อย call
+(asgi.py ใช้ตัวนี้ดึงข้อมูลของหน้า artist/search/tag ก่อนส่งต่อให้ Flask)
+
+cache / rate limiter ของ client เป็น API แบบ sync: ถ้าเป็น Redis จะถูกเรียกผ่าน asyncio.to_thread
+(ไม่ให้ network round trip ไป Redis บล็อก event loop); MemoryCache / TokenBucket เรียกตรงๆ
+"""
+from __future__ import annotations
+import asyncio
+import itertools
+import logging
+import os
+import time
+from typing import Any, Awaitable, Dict, List, Tuple
+
+import httpx
+
+from cache import MemoryCache
+from lastfm import (LastFMClient, _Retryable, _shape_artist_tracks, _shape_similar,
+                    _shape_tag_tracks)
+
+log = logging.getLogger(__name__)
+
+# call พร้อมกันสูงสุดต่อ process (= จำนวน connection รวม)
+LASTFM_ASYNC_MAX_CONNECTIONS = int(os.getenv("LASTFM_ASYNC_MAX_CONNECTIONS", "64"))
+# แบ่ง connection เป็นหลาย AsyncClient ย่อยละไม่เกินเท่านี้: การจัด request ลง connection ของ httpcore
+# ไล่ทุก connection ทุกครั้งที่มี request เข้า/ออก (O(n^2)) -> pool เดียว 64 ตัวช้ากว่าการรอ upstream เสียอีก
+_POOL_SHARD_SIZE = 8
+
+
+class AsyncLastFMClient:
+    def __init__(self, client: LastFMClient, max_connections: int | None = None,
+                 transport: httpx.AsyncBaseTransport | None = None):
+        self.client = client
+        connect_timeout, read_timeout = client.timeout
+        max_connections = max_connections or LASTFM_ASYNC_MAX_CONNECTIONS
+        per_shard = min(max_connections, _POOL_SHARD_SIZE)
+        self._shards = [
+            httpx.AsyncClient(
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=per_shard, max_keepalive_connections=per_shard),
+                transport=transport,
+            )
+            for _ in range(-(-max_connections // per_shard))
+        ]
+        self._next_shard = itertools.cycle(self._shards)
+        # request ที่เกินรอตรงนี้ (FIFO) ไม่ไปต่อคิวใน pool ของ httpx
+        self._sem = asyncio.Semaphore(max_connections)
+
+    async def aclose(self):
+        for http in self._shards:
+            await http.aclose()
+
+    async def gather(self, calls: Dict[str, Awaitable[Any]],
+                     timeout: float | None = None) -> Tuple[Dict[str, Any], Dict[str, Exception]]:
+        """เหมือน LastFMClient.gather แต่รับ coroutine -> (results, errors) ตาม key เดิม"""
+        if timeout is None:
+            timeout = sum(self.client.timeout)
+        tasks = {key: asyncio.ensure_future(coro) for key, coro in calls.items()}
+        done, pending = await asyncio.wait(tasks.values(), timeout=timeout) if tasks else (set(), set())
+        for task in pending:
+            task.cancel()
+        results: Dict[str, Any] = {}
+        errors: Dict[str, Exception] = {}
+        for key, task in tasks.items():
+            if task in pending:
+                errors[key] = TimeoutError(f"{key} timed out after {timeout:g}s")
+            elif task.exception() is not None:
+                errors[key] = task.exception()
+            else:
+                results[key] = task.result()
+        return results, errors
+
+    async def _cache_call(self, fn, *args):
+        # MemoryCache อยู่ใน process (ไม่มี I/O) เรียกตรงได้; อย่างอื่น (Redis) ส่งไป thread
+        if isinstance(self.client.cache, MemoryCache):
+            return fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+    async def _get(self, params: Dict) -> Dict:
+        # refresh ของ stale ยังไปทาง executor ของ client
+        data = await self._cache_call(self.client._lookup, params)
+        if data is not None:
+            return data
+        data = await self._fetch(params)
+        await self._cache_call(self.client._store, params, data)
+        return data
+
+    async def _fetch(self, params: Dict) -> Dict:
+        c = self.client
+        c._enter_breaker()
+        try:
+            data = await self._fetch_with_retries(params)
+        except Exception as e:
+            c._record_error(e)
+            raise
+        c.breaker.record_success()
+        return data
+
+    async def _fetch_with_retries(self, params: Dict) -> Dict:
+        c = self.client
+        attempt = 0
+        while True:
+            if await c.rate_limiter.acquire_async(max_wait=c.timeout[1]) > 0:
+                c._count("throttled")
+            c._count("requests")
+            try:
+                return await self._fetch_once(params)
+            except _Retryable as e:
+                if attempt >= c.max_retries:
+                    raise e.error
+                delay = max(c._backoff(attempt), e.retry_after or 0)
+                attempt += 1
+                c._count("retried")
+                log.info("Last.fm %s: retry %d in %.2fs (%s)", params.get("method"), attempt, delay, e.error)
+                await asyncio.sleep(delay)
+
+    async def _fetch_once(self, params: Dict) -> Dict:
+        c = self.client
+        async with self._sem:
+            started, r, error = time.perf_counter(), None, None     # ไม่นับเวลาที่รอ semaphore
+            try:
+                r = await next(self._next_shard).get(c.base_url, params=c._request_params(params))
+                return c._check_response(r)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                c._observe(params, started, r, error)
+
+    async def top_tracks_by_tag(self, tag: str, limit: int = 20) -> List[Dict]:
+        return _shape_tag_tracks(await self._get(LastFMClient._tag_params(tag, limit)))
+
+    async def top_tracks_by_artist(self, artist: str, limit: int = 20) -> List[Dict]:
+        return _shape_artist_tracks(await self._get(LastFMClient._artist_params(artist, limit)), artist)
+
+    async def similar_artists(self, artist: str, limit: int = 12, autocorrect: int = 1) -> List[Dict]:
+        return _shape_similar(await self._get(LastFMClient._similar_params(artist, limit, autocorrect)))
@@ -0,0 +1,259 @@
+"""
+Metrics ในตัว (ไม่ต้องมี collector ภายนอก): counter / histogram + ค่าที่อ่านสดตอน scrape
+แล้วพ่นออกเป็น Prometheus text exposition format ที่ /metrics (ดู app.py)
+
+ค่าเป็นของแต่ละ process: gunicorn หลาย worker -> scrape แต่ละตัวจะเห็นเฉพาะของ worker ที่ตอบ
+(ใช้ดูว่าเวลาหมดไปกับอะไรในภาพรวม ไม่ใช่ตัวเลขบัญชี)
+
+    from metrics import REGISTRY
+    HITS = REGISTRY.counter("thing_total", "Things", ("kind",))
+    HITS.inc(kind="a")
+    with REGISTRY.histogram("work_seconds", "Work", ("step",)).time(step="parse"):
+        ...
+"""
+from __future__ import annotations
+import abc
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+# วินาที: ตั้งแต่ cache hit / query เล็ก (ms) ถึง upstream ที่ timeout (10s)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric(abc.ABC):
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name}: expected labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[k]) for k in self.labels)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterable[Sample]:
+        """(ชื่อ, labels, ค่า) ทุกแถวที่จะพ่นออกไปตอน render"""
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterable[Sample]:
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [count ต่อ bucket (ไม่สะสม)..., +Inf, sum]
+        self._values: Dict[tuple, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = next((i for i, b in enumerate(self.buckets) if value <= b), len(self.buckets))
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[i] += 1
+            row[-1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            row = self._values.get(self._key(labels))
+            return int(sum(row[:-1])) if row else 0
+
+    def samples(self) -> Iterable[Sample]:
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        for key, row in items:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), row[:-1]):
+                cumulative += n
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield f"{self.name}_sum", labels, row[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        # ค่าที่อ่านสดตอน scrape (stats ของ cache ฯลฯ): name -> fn() -> [(metric, type, help, labels, value)]
+        self._collectors: Dict[str, Callable[[], Iterable[tuple]]] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, help: str, labels: Sequence[str], **kwargs):
+        # สร้างซ้ำชื่อเดิม (import module ใหม่) ได้ตัวเดิมคืน
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labels, **kwargs)
+            elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+                raise ValueError(f"metric {name} already registered with a different type/labels")
+            return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labels)
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+    def register_collector(self, key: str, fn: Callable[[], Iterable[tuple]]):
+        """fn() -> (name, "counter"|"gauge", help, labels, value) ทีละแถว; key เดิมถูกแทนที่"""
+        with self._lock:
+            self._collectors[key] = fn
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+            collectors = list(self._collectors.values())
+        lines: List[str] = []
+        for m in metrics:
+            lines += [f"# HELP {m.name} {m.help}", f"# TYPE {m.name} {m.kind}"]
+            lines += [f"{n}{_format_labels(l)} {_format_value(v)}" for n, l, v in m.samples()]
+        collected: Dict[str, tuple] = {}
+        for fn in collectors:
+            for name, kind, help, labels, value in fn():
+                collected.setdefault(name, (kind, help, []))[2].append((labels, value))
+        for name in sorted(collected):
+            kind, help, rows = collected[name]
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            lines += [f"{name}{_format_labels(l)} {_format_value(v)}" for l, v in rows]
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# ---------- ที่ใช้ร่วมกันหลาย module ----------
+UPSTREAM_REQUESTS = REGISTRY.counter(
+    "upstream_requests_total", "HTTP calls to Last.fm/Spotify by endpoint and outcome",
+    ("service", "endpoint", "status"))
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    "upstream_request_duration_seconds", "Latency of one HTTP call to Last.fm/Spotify",
+    ("service", "endpoint"))
+
+# id ใน path ของ Spotify (/users/<id>/playlists, /playlists/<id>/tracks) -> {id} ไม่ให้ label บาน
+_SPOTIFY_ID = re.compile(r"/(users|playlists|tracks|albums|artists)/[^/]+")
+
+
+def spotify_endpoint(path: str) -> str:
+    return _SPOTIFY_ID.sub(r"/\1/{id}", path.split("?", 1)[0])
+
+
+def observe_upstream(service: str, endpoint: str, status, seconds: float):
+    """status: HTTP status, error code ของ Last.fm (lastfm_<code>) หรือ "error" (ต่อไม่ได้/timeout)"""
+    UPSTREAM_REQUESTS.inc(service=service, endpoint=endpoint, status=str(status))
+    UPSTREAM_SECONDS.observe(seconds, service=service, endpoint=endpoint)
+
+
+# ---------- SQLAlchemy ----------
+DB_SECONDS = REGISTRY.histogram(
+    "db_query_duration_seconds", "Time spent executing one SQL statement", ("operation", "table"))
+DB_ERRORS = REGISTRY.counter("db_query_errors_total", "SQL statements that raised", ("operation", "table"))
+
+_SQL_TARGET = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+\"?(\w+)", re.IGNORECASE)
+
+
+def _statement_labels(statement: str) -> Dict[str, str]:
+    words = statement.lstrip().split(None, 1)
+    operation = words[0].upper() if words else ""
+    if operation == "WITH":
+        operation = "SELECT"
+    m = _SQL_TARGET.search(statement)
+    return {"operation": operation, "table": m.group(1).lower() if m else ""}
+
+
+def instrument_engine(engine):
+    """จับเวลาทุก statement ของ engine (before/after_cursor_execute) แยกตามคำสั่ง + ตารางแรก"""
+    from sqlalchemy import event
+
+    if getattr(engine, "_metrics_instrumented", False):
+        return
+    engine._metrics_instrumented = True
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["metrics_started"].pop()
+        DB_SECONDS.observe(time.perf_counter() - started, **_statement_labels(statement))
+
+    @event.listens_for(engine, "handle_error")
+    def _error(ctx):
+        stack = ctx.connection.info.get("metrics_started") if ctx.connection is not None else None
+        if stack:
+            stack.pop()
+        if ctx.statement:
+            DB_ERRORS.inc(**_statement_labels(ctx.statement))
+
+
+def cache_samples(name: str, cache) -> Iterable[tuple]:
+    """stats() ของ MemoryCache/RedisCache -> แถวสำหรับ register_collector"""
+    stats = cache.stats()
+    hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+    labels = {"cache": name}
+    yield "cache_requests_total", "counter", "Cache lookups by result", {**labels, "result": "hit"}, hits
+    yield "cache_requests_total", "counter", "Cache lookups by result", {**labels, "result": "miss"}, misses
+    yield "cache_hit_ratio", "gauge", "hits / (hits + misses) since start", labels, \
+        hits / (hits + misses) if hits + misses else 0.0
+    for key in ("entries", "bytes", "evictions", "expired", "errors"):
+        if key in stats:
+            kind = "gauge" if key in ("entries", "bytes") else "counter"
+            metric = f"cache_{key}" if kind == "gauge" else f"cache_{key}_total"
+            yield metric, kind, f"Cache {key}", labels, stats[key]
@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
 @dataclass
 class Track:
@@ -63,19 +63,28 @@ class PlaylistManager:
         return self.repo.get_public_playlist_by_token(token)
 
     # --- Tracks in a playlist ---
-    def add_track(self, playlist_id: int, track: Track):
-        self.repo.insert_playlist_track(playlist_id, track)
+    def add_track(self, playlist_id: int, track: Track, index: Optional[int] = None):
+        """index=None ต่อท้าย, ไม่งั้นแทรกที่ลำดับ index (0 = บนสุด)"""
+        self.repo.insert_playlist_track(playlist_id, track, index=index)
+
+    def add_tracks(self, playlist_id: int, tracks: List[Track]) -> int:
+        return self.repo.insert_playlist_tracks(playlist_id, tracks)
 
     def remove_track(self, playlist_id: int, track_id: int, user_id: int):
         self.repo.delete_playlist_track(playlist_id, track_id, user_id)
 
-    def list_tracks(self, playlist_id: int, user_id: Optional[int] = None):
-        return self.repo.fetch_playlist_tracks(playlist_id, user_id)
+    def list_tracks(self, playlist_id: int, user_id: Optional[int] = None, *,
+                    after: Optional[Tuple[int, int]] = None, limit: Optional[int] = None):
+        """limit=None คืนทั้งเพลย์ลิสต์; หน้าถัดไปส่ง after=(position, id) ของเพลงสุดท้ายที่ได้มา"""
+        return self.repo.fetch_playlist_tracks(playlist_id, user_id, limit=limit, after=after)
 
     def move_track(self, playlist_id: int, track_id: int, direction: str, user_id: int):
         """direction: 'up' or 'down'"""
         self.repo.reorder_track(playlist_id, track_id, direction, user_id)
 
+    def move_track_to(self, playlist_id: int, track_id: int, index: int, user_id: int) -> bool:
+        return self.repo.move_track_to(playlist_id, track_id, index, user_id)
+
     def clear(self, playlist_id: int, user_id: int):
         self.repo.clear_playlist_tracks(playlist_id, user_id)
 
@@ -0,0 +1,187 @@
+from __future__ import annotations
+import abc
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+# Last.fm ขอไว้ที่ ~5 req/s ต่อ IP (เฉลี่ย) -> ค่าเริ่มต้นของ bucket ที่ใช้ร่วมกันทั้งเครื่อง/ทุก worker
+DEFAULT_RATE = 5.0
+DEFAULT_BURST = 10
+
+
+class RateLimitExceeded(RuntimeError):
+    """รอ token นานเกิน max_wait"""
+
+
+def parse_retry_after(value: Optional[str], default: Optional[float] = None) -> Optional[float]:
+    """
+    header Retry-After -> จำนวนวินาทีที่ต้องรอ (ไม่ติดลบ)
+    รับได้ทั้งแบบวินาที ("120", "1.5") และ HTTP-date ("Wed, 21 Oct 2015 07:28:00 GMT");
+    ไม่มี/อ่านไม่ออก -> default
+    """
+    if not value or not value.strip():
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return default
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        seconds = (when - datetime.now(timezone.utc)).total_seconds()
+    if seconds != seconds:      # NaN
+        return default
+    return max(0.0, seconds)
+
+
+class _Bucket(abc.ABC):
+    rate: float
+
+    @abc.abstractmethod
+    def _take(self) -> float:
+        """หยิบ 1 token: คืน 0 ถ้าได้ ไม่งั้นคืนจำนวนวินาทีที่ควรรอก่อนลองใหม่"""
+
+    def acquire(self, max_wait: float) -> float:
+        """บล็อกจนได้ token; คืนเวลาที่รอ (วินาที) หรือ raise RateLimitExceeded ถ้าต้องรอเกิน max_wait"""
+        waited = 0.0
+        while True:
+            wait = self._take()
+            if wait <= 0:
+                return waited
+            if waited + wait > max_wait:
+                raise RateLimitExceeded(f"rate limit: no token within {max_wait:g}s")
+            time.sleep(wait)
+            waited += wait
+
+    async def _take_async(self) -> float:
+        return self._take()
+
+    async def acquire_async(self, max_wait: float) -> float:
+        """เหมือน acquire แต่รอด้วย asyncio.sleep (ไม่บล็อก event loop)"""
+        import asyncio
+        waited = 0.0
+        while True:
+            wait = await self._take_async()
+            if wait <= 0:
+                return waited
+            if waited + wait > max_wait:
+                raise RateLimitExceeded(f"rate limit: no token within {max_wait:g}s")
+            await asyncio.sleep(wait)
+            waited += wait
+
+
+class TokenBucket(_Bucket):
+    """Token bucket ใน process (thread-safe): เติม `rate` token/วินาที เก็บได้สูงสุด `burst`"""
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def penalize(self, seconds: float):
+        """upstream บอกว่าเร็วไป -> ทุก thread หยุดยิงอย่างน้อย `seconds` วินาที"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+# state = {tokens, ts} ใน hash เดียว; ใช้เวลาของ Redis (TIME) จึงไม่ขึ้นกับนาฬิกาของแต่ละเครื่อง
+_TAKE_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local penalty = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local wait = 0
+if penalty > 0 then
+    tokens = math.min(tokens, -penalty * rate)
+elseif tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst / rate + math.max(penalty, 0)) * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class RedisTokenBucket(_Bucket):
+    """
+    Token bucket เดียวใช้ร่วมทุก worker/ทุกเครื่องผ่าน Redis (Lua script = atomic)
+    ถ้า Redis ใช้ไม่ได้จะตกไปใช้ TokenBucket ใน process แทน (จำกัดได้แค่ต่อ worker)
+    """
+
+    def __init__(self, client, key: str = "mdapp:ratelimit:lastfm",
+                 rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST):
+        self.client = client
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self._script = client.register_script(_TAKE_LUA)
+        self._fallback = TokenBucket(rate, burst)
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "RedisTokenBucket":
+        import redis
+        return cls(redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1), **kwargs)
+
+    def _eval(self, penalty: float) -> Optional[float]:
+        try:
+            return float(self._script(keys=[self.key], args=[self.rate, self.burst, penalty]))
+        except Exception:
+            log.warning("redis rate limiter failed; using in-process bucket", exc_info=True)
+            return None
+
+    def _take(self) -> float:
+        wait = self._eval(0)
+        return self._fallback._take() if wait is None else wait
+
+    async def _take_async(self) -> float:
+        # EVALSHA เป็น network round trip -> ไม่ทำบน event loop
+        import asyncio
+        return await asyncio.to_thread(self._take)
+
+    def penalize(self, seconds: float):
+        if self._eval(seconds) is None:
+            self._fallback.penalize(seconds)
+
+
+def make_rate_limiter(url: Optional[str] = None, rate: Optional[float] = None, burst: Optional[int] = None):
+    """
+    เลือก backend จาก RATE_LIMIT_URL (ถ้าไม่ตั้งใช้ CACHE_URL):
+    redis://... -> RedisTokenBucket (แชร์ข้าม worker), อย่างอื่น -> TokenBucket (ต่อ process)
+    อัตราตั้งด้วย LASTFM_RATE_LIMIT (req/s) และ LASTFM_RATE_BURST
+    """
+    url = url if url is not None else os.getenv("RATE_LIMIT_URL", os.getenv("CACHE_URL", ""))
+    rate = rate or float(os.getenv("LASTFM_RATE_LIMIT", DEFAULT_RATE))
+    burst = burst or int(os.getenv("LASTFM_RATE_BURST", DEFAULT_BURST))
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisTokenBucket.from_url(url, rate=rate, burst=burst)
+    return TokenBucket(rate, burst)
@@ -0,0 +1,99 @@
+"""
+Spotify Web API บน asyncio (httpx.AsyncClient) สำหรับงานที่ยิงหลาย call พร้อมกัน
+เช่นค้น URI ของทั้งเพลย์ลิสต์ตอน export: รอ /search หลายสิบ call ได้โดยไม่ต้องมี thread ต่อ call
+
+token ต้องสดอยู่แล้ว (refresh ผ่าน OAuth2Session ฝั่ง sync ก่อนเรียก)
+"""
+from __future__ import annotations
+import asyncio
+import os
+import time
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import httpx
+
+from metrics import observe_upstream, spotify_endpoint
+from ratelimit import parse_retry_after
+
+SPOTIFY_ASYNC_CONCURRENCY = int(os.getenv("SPOTIFY_ASYNC_CONCURRENCY", "16"))
+
+
+class AsyncSpotify:
+    def __init__(self, access_token: str, base_url: str = "https://api.spotify.com/v1",
+                 max_retries: int = 3, concurrency: int | None = None,
+                 transport: httpx.AsyncBaseTransport | None = None):
+        self.http = httpx.AsyncClient(
+            base_url=base_url,
+            headers={"Authorization": f"Bearer {access_token}"},
+            timeout=15,
+            transport=transport,
+        )
+        self.max_retries = max_retries
+        self._sem = asyncio.Semaphore(concurrency or SPOTIFY_ASYNC_CONCURRENCY)
+        # เวลา (monotonic) ที่ยิงต่อได้หลังเจอ 429 — ใช้ร่วมทุก coroutine ของ client นี้
+        self._retry_until = 0.0
+
+    async def __aenter__(self) -> "AsyncSpotify":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        for attempt in range(self.max_retries + 1):
+            delay = self._retry_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with self._sem:
+                started = time.perf_counter()
+                try:
+                    r = await self.http.request(method, path, **kwargs)
+                except httpx.HTTPError:
+                    observe_upstream("spotify", f"{method} {spotify_endpoint(path)}", "error",
+                                     time.perf_counter() - started)
+                    raise
+            observe_upstream("spotify", f"{method} {spotify_endpoint(path)}", r.status_code,
+                             time.perf_counter() - started)
+            if r.status_code != 429 or attempt == self.max_retries:
+                break
+            retry_after = parse_retry_after(r.headers.get("Retry-After"), default=1.0)
+            self._retry_until = max(self._retry_until, time.monotonic() + retry_after)
+        r.raise_for_status()
+        return r
+
+    async def get(self, path: str, **kwargs) -> dict:
+        return (await self.request("GET", path, **kwargs)).json()
+
+    async def post(self, path: str, json=None, **kwargs) -> dict:
+        r = await self.request("POST", path, json=json, **kwargs)
+        return r.json() if r.content else {}
+
+    async def search_track_uri(self, title: str, artist: str) -> Optional[str]:
+        data = await self.get("/search", params={"q": f"track:{title} artist:{artist}", "type": "track", "limit": 1})
+        items = data.get("tracks", {}).get("items", [])
+        return items[0]["uri"] if items else None
+
+    async def search_track_uris(self, pairs: Iterable[Tuple[str, str]],
+                                on_progress: Callable[[int], None] | None = None) -> Dict[Tuple[str, str], str]:
+        """
+        ค้นทุกคู่ (title, artist) พร้อมกัน (จำกัดด้วย semaphore) -> {pair: uri} เฉพาะที่เจอ
+        on_progress(n) ถูกเรียกทุก 10 ผล และตอนครบ
+        """
+        pairs = list(pairs)
+        found: Dict[Tuple[str, str], str] = {}
+        done = 0
+
+        async def one(pair):
+            nonlocal done
+            uri = await self.search_track_uri(*pair)
+            if uri:
+                found[pair] = uri
+            done += 1
+            if on_progress and (done % 10 == 0 or done == len(pairs)):
+                on_progress(done)
+
+        await asyncio.gather(*(one(p) for p in pairs))
+        return found
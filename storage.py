@@ -1,173 +1,579 @@
-import csv
+import json
 import os
 import secrets
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
-from typing import List, Optional
-from sqlalchemy import create_engine, text, event
-from sqlalchemy.engine import Engine
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import Connection, Engine, make_url
+from sqlalchemy.exc import IntegrityError
 from models import Track
 
+# PRAGMA ที่ตั้งให้ทุก connection ของ SQLite (เลือกด้วย SQLITE_PROFILE)
+# production: WAL ให้ reader ไม่โดน writer block ข้าม gunicorn worker, synchronous=NORMAL
+# (ปลอดภัยกับ WAL; อาจเสีย transaction ล่าสุดถ้าไฟดับ แต่ DB ไม่พัง), รอ lock แทนการ error ทันที
+SQLITE_PROFILES = {
+    "default": {
+        "foreign_keys": "ON",
+    },
+    "production": {
+        "foreign_keys": "ON",
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,        # ms
+        "cache_size": -16000,        # ค่าติดลบ = KiB (~16MB ต่อ connection)
+        "mmap_size": 128 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    },
+}
+
+def _parse_pragmas(spec: str) -> Dict[str, str]:
+    """ "cache_size=-32000,mmap_size=0" -> {"cache_size": "-32000", "mmap_size": "0"}"""
+    out = {}
+    for part in spec.split(","):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            out[k.strip()] = v.strip()
+    return out
+
+def _pool_options(db_url: str) -> Dict[str, object]:
+    """
+    ขนาด connection pool ต่อ process (override ด้วย DB_POOL_SIZE / DB_MAX_OVERFLOW)
+    - SQLite: เปิด connection ถูกมาก แต่เขียนได้ทีละคน -> pool เท่าจำนวน thread ที่อาจใช้ DB พร้อมกัน
+      (gunicorn THREADS + job worker) ไม่ต้องมี overflow เยอะ
+    - PostgreSQL: connection แพงทั้งฝั่ง client/server -> pool เล็ก, pre_ping กัน connection ตาย
+      หลัง server restart/idle timeout และ recycle ก่อน LB/pgbouncer ตัดทิ้ง
+    """
+    url = make_url(db_url)
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            return {}       # :memory: ใช้ SingletonThreadPool ของ SQLAlchemy
+        return {
+            "pool_size": int(os.getenv("DB_POOL_SIZE", int(os.getenv("THREADS", "4")) + 2)),
+            "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "2")),
+            "pool_timeout": 10,
+        }
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "5")),
+        "pool_timeout": 10,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+
+class UnitOfWork:
+    """
+    ใช้ connection เดียวร่วมกันทุก repository call ใน scope (เช่นตลอด 1 Flask request)
+    - checkout connection ตอน call แรก (request ที่ไม่แตะ DB ไม่เสียอะไร)
+    - read ไม่ COMMIT: transaction ที่ค้างอยู่จบด้วย ROLLBACK ตอนปิด
+    - write ยัง COMMIT ทันทีเมื่อ method จบ (error โผล่ใน route เหมือนเดิม ไม่ใช่ตอน teardown)
+    ใช้แบบ `with repo.unit_of_work():` หรือ open()/close() คู่กันใน before/teardown_request
+    thread อื่น (job, executor) ไม่ได้ connection นี้ไปด้วย: แต่ละ call ใช้ transaction ของตัวเองตามเดิม
+    """
+
+    def __init__(self, repo: "StorageRepository"):
+        self.repo = repo
+        self._conn: Optional[Connection] = None
+        self._token = None
+
+    def connection(self) -> Connection:
+        if self._conn is None:
+            self._conn = self.repo.engine.connect()
+        return self._conn
+
+    def open(self) -> "UnitOfWork":
+        self._token = self.repo._uow.set(self)
+        return self
+
+    def close(self):
+        try:
+            if self._conn is not None:
+                self._conn.close()      # rollback transaction ที่อ่านค้างไว้ แล้วคืน pool
+        finally:
+            self._conn = None
+            if self._token is not None:
+                self.repo._uow.reset(self._token)
+                self._token = None
+
+    def __enter__(self) -> "UnitOfWork":
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
 class StorageRepository:
-    def __init__(self, db_url: str = "sqlite:///music.db"):
-        self.engine: Engine = create_engine(db_url, future=True)
+    def __init__(self, db_url: str = "sqlite:///music.db", sqlite_profile: Optional[str] = None,
+                 sqlite_pragmas: Optional[Dict[str, object]] = None):
+        self.engine: Engine = create_engine(db_url, future=True, **_pool_options(db_url))
+        self._uow: ContextVar[Optional[UnitOfWork]] = ContextVar(f"storage_uow_{id(self)}", default=None)
 
         if self.engine.url.get_backend_name() == "sqlite":
+            profile = sqlite_profile or os.getenv("SQLITE_PROFILE", "production")
+            if profile not in SQLITE_PROFILES:
+                raise ValueError(f"Unknown SQLITE_PROFILE: {profile}")
+            # override รายตัวได้ทาง SQLITE_PRAGMAS="busy_timeout=10000,mmap_size=0" หรือ sqlite_pragmas=
+            self.sqlite_pragmas = {**SQLITE_PROFILES[profile],
+                                   **_parse_pragmas(os.getenv("SQLITE_PRAGMAS", "")),
+                                   **(sqlite_pragmas or {})}
+
             @event.listens_for(self.engine, "connect")
             def set_sqlite_pragma(dbapi_connection, connection_record):
                 cursor = dbapi_connection.cursor()
-                cursor.execute("PRAGMA foreign_keys = ON")
+                for name, value in self.sqlite_pragmas.items():
+                    cursor.execute(f"PRAGMA {name} = {value}")
                 cursor.close()
 
         self._init_db()
 
+    # -------- connections --------
+    def unit_of_work(self) -> UnitOfWork:
+        return UnitOfWork(self)
+
+    @contextmanager
+    def _read(self):
+        """connection สำหรับ query อ่านอย่างเดียว: ไม่ส่ง COMMIT"""
+        uow = self._uow.get()
+        if uow is not None:
+            yield uow.connection()
+            return
+        with self.engine.connect() as conn:
+            yield conn
+
+    @contextmanager
+    def _write(self):
+        """transaction สำหรับเขียน: COMMIT เมื่อจบ block, ROLLBACK ถ้า error"""
+        uow = self._uow.get()
+        if uow is None:
+            with self.engine.begin() as conn:
+                yield conn
+            return
+        conn = uow.connection()
+        if conn.in_transaction():
+            # ปิด read transaction ที่ค้างก่อน: ถ้า upgrade snapshot เก่าเป็น writer
+            # SQLite WAL จะตอบ SQLITE_BUSY_SNAPSHOT ทันทีเมื่อ process อื่นเขียนไปแล้ว
+            conn.rollback()
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
     # -------- helpers --------
     def _table_exists(self, conn, table: str) -> bool:
-        row = conn.exec_driver_sql(
-            "SELECT name FROM sqlite_master WHERE type='table' AND name=:t",
-            {"t": table},
-        ).fetchone()
-        return bool(row)
+        return inspect(conn).has_table(table)
 
     def _table_has_column(self, conn, table: str, col: str) -> bool:
         if not self._table_exists(conn, table):
             return False
-        cols = conn.exec_driver_sql(f"PRAGMA table_info({table})").fetchall()
-        names = [c[1] for c in cols]
-        return col in names
+        return col in {c["name"] for c in inspect(conn).get_columns(table)}
 
     # -------- schema init + migrations --------
+    # migration แต่ละขั้นรันครั้งเดียวแล้วบันทึกใน schema_version; บูตครั้งถัดไปแค่อ่าน MAX(version)
+    # เพิ่มขั้นใหม่ต่อท้ายเท่านั้น (ห้ามแก้/สลับ version เดิม) และเขียนเป็น _migration_<version:03d>
+    MIGRATIONS = (
+        (1, "base schema"),
+        (2, "secondary indexes"),
+        (3, "legacy playlist -> playlists/playlist_tracks"),
+        (4, "index legacy playlist.user_id"),
+        (5, "denormalized playlist/user counters"),
+    )
+
     def _init_db(self):
         with self.engine.begin() as conn:
-            conn.exec_driver_sql("PRAGMA foreign_keys = ON")
-
-            # users
-            conn.exec_driver_sql("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    created_at TEXT NOT NULL
-                );
-            """)
-
-            # legacy single-list table (will migrate)
-            conn.exec_driver_sql("""
-                CREATE TABLE IF NOT EXISTS playlist (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    title TEXT NOT NULL,
-                    artist TEXT NOT NULL,
-                    url TEXT,
-                    mbid TEXT,
-                    added_at TEXT NOT NULL,
-                    FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
-                );
-            """)
-
-            # user_pref
+            if self.engine.url.get_backend_name() == "postgresql":
+                # CREATE TABLE IF NOT EXISTS พร้อมกันหลาย worker/หลายเครื่องชนกันได้ใน PostgreSQL -> ทำทีละคน
+                conn.exec_driver_sql("SELECT pg_advisory_xact_lock(4242)")
             conn.exec_driver_sql("""
-                CREATE TABLE IF NOT EXISTS user_pref (
-                    user_id INTEGER PRIMARY KEY,
-                    default_genre TEXT,
-                    FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
-                );
-            """)
-
-            # --- NEW: playlists (meta) ---
-            conn.exec_driver_sql("""
-                CREATE TABLE IF NOT EXISTS playlists (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
                     name TEXT NOT NULL,
-                    description TEXT DEFAULT '',
-                    is_public INTEGER NOT NULL DEFAULT 0,
-                    share_token TEXT,
-                    created_at TEXT NOT NULL,
-                    updated_at TEXT NOT NULL,
-                    UNIQUE(share_token),
-                    FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
-                );
-            """)
-
-            # --- NEW: playlist_tracks (ordered) ---
-            conn.exec_driver_sql("""
-                CREATE TABLE IF NOT EXISTS playlist_tracks (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    playlist_id INTEGER NOT NULL,
-                    title TEXT NOT NULL,
-                    artist TEXT NOT NULL,
-                    url TEXT,
-                    mbid TEXT,
-                    position INTEGER NOT NULL,
-                    added_at TEXT NOT NULL,
-                    FOREIGN KEY(playlist_id) REFERENCES playlists(id) ON DELETE CASCADE
-                );
-            """)
-
-            # --- NEW: user_tokens (for Spotify OAuth) ---
-            conn.exec_driver_sql("""
-                CREATE TABLE IF NOT EXISTS user_tokens (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    provider TEXT NOT NULL, -- 'spotify'
-                    access_token TEXT NOT NULL,
-                    refresh_token TEXT,
-                    expires_at TEXT,
-                    UNIQUE(user_id, provider),
-                    FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+                    applied_at TEXT NOT NULL
                 );
             """)
+            current = conn.exec_driver_sql("SELECT COALESCE(MAX(version), 0) FROM schema_version").scalar()
+        for version, name in self.MIGRATIONS:
+            if version > current:
+                self._apply_migration(version, name)
+
+    def schema_version(self) -> int:
+        with self._read() as conn:
+            return conn.exec_driver_sql("SELECT COALESCE(MAX(version), 0) FROM schema_version").scalar()
+
+    def _apply_migration(self, version: int, name: str) -> bool:
+        step = getattr(self, f"_migration_{version:03d}")
+        with self.engine.connect() as conn:
+            # จองเลข version ก่อน: ถ้า worker อื่นกำลัง/รันไปแล้ว INSERT จะรอ lock แล้วชน PK -> ข้าม
+            try:
+                conn.execute(
+                    text("INSERT INTO schema_version (version, name, applied_at) VALUES (:v, :n, :t)"),
+                    {"v": version, "n": name, "t": datetime.utcnow().isoformat()},
+                )
+            except IntegrityError:
+                conn.rollback()
+                return False
+            step(conn)
+            conn.commit()
+            return True
+
+    # primary key แบบเลขรันของแต่ละ backend (SQLite: AUTOINCREMENT ไม่ใช้เลข id ที่ถูกลบไปแล้วซ้ำ)
+    ID_PK = {
+        "sqlite": "INTEGER PRIMARY KEY AUTOINCREMENT",
+        "postgresql": "INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY",
+    }
+
+    def _migration_001(self, conn):
+        backend = self.engine.url.get_backend_name()
+        if backend not in self.ID_PK:
+            raise RuntimeError(f"Unsupported database backend: {backend}")
+        id_pk = self.ID_PK[backend]
+
+        # users
+        conn.exec_driver_sql("""
+            CREATE TABLE IF NOT EXISTS users (
+                id {id_pk},
+                username TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            );
+        """.format(id_pk=id_pk))
+
+        # legacy single-list table (will migrate)
+        conn.exec_driver_sql("""
+            CREATE TABLE IF NOT EXISTS playlist (
+                id {id_pk},
+                user_id INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                artist TEXT NOT NULL,
+                url TEXT,
+                mbid TEXT,
+                added_at TEXT NOT NULL,
+                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+            );
+        """.format(id_pk=id_pk))
+
+        # user_pref
+        conn.exec_driver_sql("""
+            CREATE TABLE IF NOT EXISTS user_pref (
+                user_id INTEGER PRIMARY KEY,
+                default_genre TEXT,
+                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+            );
+        """)
+
+        # --- NEW: playlists (meta) ---
+        conn.exec_driver_sql("""
+            CREATE TABLE IF NOT EXISTS playlists (
+                id {id_pk},
+                user_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                description TEXT DEFAULT '',
+                is_public INTEGER NOT NULL DEFAULT 0,
+                share_token TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                UNIQUE(share_token),
+                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+            );
+        """.format(id_pk=id_pk))
+
+        # --- NEW: playlist_tracks (ordered) ---
+        conn.exec_driver_sql("""
+            CREATE TABLE IF NOT EXISTS playlist_tracks (
+                id {id_pk},
+                playlist_id INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                artist TEXT NOT NULL,
+                url TEXT,
+                mbid TEXT,
+                position INTEGER NOT NULL,
+                added_at TEXT NOT NULL,
+                FOREIGN KEY(playlist_id) REFERENCES playlists(id) ON DELETE CASCADE
+            );
+        """.format(id_pk=id_pk))
+
+        # --- NEW: user_tokens (for Spotify OAuth) ---
+        conn.exec_driver_sql("""
+            CREATE TABLE IF NOT EXISTS user_tokens (
+                id {id_pk},
+                user_id INTEGER NOT NULL,
+                provider TEXT NOT NULL, -- 'spotify'
+                access_token TEXT NOT NULL,
+                refresh_token TEXT,
+                expires_at TEXT,
+                UNIQUE(user_id, provider),
+                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+            );
+        """.format(id_pk=id_pk))
+
+        # --- NEW: spotify_track_uris (cache ผลค้นหา (title, artist) -> Spotify URI ใช้ร่วมทุก user) ---
+        conn.exec_driver_sql("""
+            CREATE TABLE IF NOT EXISTS spotify_track_uris (
+                title_key TEXT NOT NULL,
+                artist_key TEXT NOT NULL,
+                uri TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY(title_key, artist_key)
+            );
+        """)
+
+        # --- NEW: jobs (สถานะงานเบื้องหลัง เช่น export ไป Spotify) ---
+        conn.exec_driver_sql("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL, -- queued | running | done | failed
+                progress INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                message TEXT,
+                result TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+            );
+        """)
+
+    # --- secondary indexes ---
+    INDEXES = (
+        # fetch_playlist_tracks / MAX(position) / move: WHERE playlist_id ORDER BY position
+        # (+ FK cascade ตอนลบ playlists)
+        "CREATE INDEX IF NOT EXISTS ix_playlist_tracks_playlist_position ON playlist_tracks (playlist_id, position)",
+        # list_playlists / list_playlists_with_counts / stats: WHERE user_id ORDER BY updated_at
+        "CREATE INDEX IF NOT EXISTS ix_playlists_user_updated ON playlists (user_id, updated_at)",
+        # FK user_id ของ jobs (cascade ตอนลบ users)
+        "CREATE INDEX IF NOT EXISTS ix_jobs_user ON jobs (user_id)",
+    )
+
+    def _migration_002(self, conn):
+        for ddl in self.INDEXES:
+            conn.exec_driver_sql(ddl)
+
+    def _migration_003(self, conn):
+        """
+        ย้ายแถวจากตาราง legacy "playlist" เข้า playlists/playlist_tracks แบบ set-based:
+        ถ้ายังไม่มี playlists เลย -> สร้าง "My Playlist" ให้ทุก user ที่มีแถว legacy แล้ว
+        INSERT ... SELECT เพลงทั้งหมดในคำสั่งเดียว (เรียงตาม id เดิม)
+        ตาราง playlist เดิมเก็บไว้เหมือนเดิมเพื่อ backward compatibility
+        """
+        has_new = conn.exec_driver_sql("SELECT 1 FROM playlists LIMIT 1").fetchone()
+        has_legacy = conn.exec_driver_sql("SELECT 1 FROM playlist LIMIT 1").fetchone()
+        if has_new or not has_legacy:
+            return
+        now = datetime.utcnow().isoformat()
+        conn.execute(text("""
+            INSERT INTO playlists (user_id, name, description, is_public, created_at, updated_at)
+            SELECT DISTINCT user_id, 'My Playlist', '', 0, :now, :now FROM playlist
+        """), {"now": now})
+        conn.execute(text("""
+            INSERT INTO playlist_tracks (playlist_id, title, artist, url, mbid, position, added_at)
+            SELECT p.id, l.title, l.artist, l.url, l.mbid,
+                   (ROW_NUMBER() OVER (PARTITION BY l.user_id ORDER BY l.id) - 1) * :gap,
+                   COALESCE(l.added_at, :now)
+            FROM playlist l
+            JOIN playlists p ON p.user_id = l.user_id
+        """), {"gap": self.POSITION_GAP, "now": now})
+
+    def _migration_004(self, conn):
+        # FK ของตาราง legacy: INSERT/DELETE users ต้องหาแถวลูกใน playlist (เห็นได้ใน plan ของ INSERT ... RETURNING)
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_playlist_user ON playlist (user_id)")
+
+    def _migration_005(self, conn):
+        """
+        ตัวนับที่ต้องใช้ทุกครั้งที่เปิดหน้า profile/รายการเพลย์ลิสต์ เก็บไว้เลยแทนการ JOIN + COUNT:
+        playlists.track_count, user_stats (ยอดรวมต่อ user) และ user_artist_counts
+        (จำนวนเพลงต่อศิลปินต่อ user -> รู้ได้ทันทีว่าศิลปินหายไป/เพิ่มใหม่ตอนลบ/เพิ่มเพลง)
+        ทุก method ที่แก้ playlists/playlist_tracks อัปเดตตัวนับใน transaction เดียวกัน (_bump_tracks)
+        """
+        if not self._table_has_column(conn, "playlists", "track_count"):
+            conn.exec_driver_sql("ALTER TABLE playlists ADD COLUMN track_count INTEGER NOT NULL DEFAULT 0")
+        conn.exec_driver_sql("""
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id INTEGER PRIMARY KEY,
+                total_tracks INTEGER NOT NULL DEFAULT 0,
+                unique_artists INTEGER NOT NULL DEFAULT 0,
+                public_playlists INTEGER NOT NULL DEFAULT 0,
+                private_playlists INTEGER NOT NULL DEFAULT 0,
+                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+            );
+        """)
+        conn.exec_driver_sql("""
+            CREATE TABLE IF NOT EXISTS user_artist_counts (
+                user_id INTEGER NOT NULL,
+                artist TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                PRIMARY KEY(user_id, artist),
+                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+            );
+        """)
+        self._rebuild_counters(conn)
+
+    # ---------- Denormalized counters ----------
+    # ค่าที่ควรเป็นตามข้อมูลจริง (ใช้ทั้ง rebuild และ check)
+    _EXPECTED_TRACK_COUNTS = """
+        SELECT p.id, COUNT(t.id) AS track_count
+        FROM playlists p LEFT JOIN playlist_tracks t ON t.playlist_id = p.id
+        GROUP BY p.id
+    """
+    _EXPECTED_ARTIST_COUNTS = """
+        SELECT p.user_id, t.artist, COUNT(*) AS n
+        FROM playlist_tracks t JOIN playlists p ON p.id = t.playlist_id
+        GROUP BY p.user_id, t.artist
+    """
+    _EXPECTED_USER_STATS = """
+        SELECT u.id AS user_id,
+               COALESCE(a.total_tracks, 0) AS total_tracks,
+               COALESCE(a.unique_artists, 0) AS unique_artists,
+               COALESCE(v.public_playlists, 0) AS public_playlists,
+               COALESCE(v.private_playlists, 0) AS private_playlists
+        FROM users u
+        LEFT JOIN (
+            SELECT p.user_id, COUNT(*) AS total_tracks, COUNT(DISTINCT t.artist) AS unique_artists
+            FROM playlist_tracks t JOIN playlists p ON p.id = t.playlist_id
+            GROUP BY p.user_id
+        ) a ON a.user_id = u.id
+        LEFT JOIN (
+            SELECT user_id,
+                   SUM(CASE WHEN is_public = 1 THEN 1 ELSE 0 END) AS public_playlists,
+                   SUM(CASE WHEN is_public = 0 THEN 1 ELSE 0 END) AS private_playlists
+            FROM playlists GROUP BY user_id
+        ) v ON v.user_id = u.id
+    """
+
+    def _rebuild_counters(self, conn):
+        conn.exec_driver_sql(f"""
+            UPDATE playlists SET track_count = e.track_count
+            FROM ({self._EXPECTED_TRACK_COUNTS}) AS e
+            WHERE playlists.id = e.id
+        """)
+        conn.exec_driver_sql("DELETE FROM user_artist_counts")
+        conn.exec_driver_sql(f"INSERT INTO user_artist_counts (user_id, artist, n) {self._EXPECTED_ARTIST_COUNTS}")
+        conn.exec_driver_sql("DELETE FROM user_stats")
+        conn.exec_driver_sql(f"""
+            INSERT INTO user_stats (user_id, total_tracks, unique_artists, public_playlists, private_playlists)
+            {self._EXPECTED_USER_STATS}
+        """)
+
+    def rebuild_counters(self):
+        """คำนวณตัวนับทั้งหมดใหม่จากข้อมูลจริง (full scan; ใช้ผ่าน `flask --app app check-counters --fix`)"""
+        with self._write() as conn:
+            self._rebuild_counters(conn)
+
+    def check_counters(self) -> Dict[str, int]:
+        """จำนวนแถวที่ตัวนับไม่ตรงกับข้อมูลจริง แยกตามตาราง (full scan)"""
+        with self._read() as conn:
+            def drift(stored: str, expected: str, key: str) -> int:
+                # จำนวน key ที่ค่าไม่ตรง / ขาด / เกิน (ดูทั้งสองทาง แต่ key เดียวกันนับครั้งเดียว)
+                return conn.exec_driver_sql(f"""
+                    SELECT COUNT(*) FROM (
+                        SELECT {key} FROM ({stored} EXCEPT SELECT * FROM ({expected}) AS e) AS a
+                        UNION
+                        SELECT {key} FROM (SELECT * FROM ({expected}) AS e EXCEPT {stored}) AS b
+                    ) AS d
+                """).scalar()
+            return {
+                "playlists": drift("SELECT id, track_count FROM playlists", self._EXPECTED_TRACK_COUNTS, "id"),
+                "user_artist_counts": drift("SELECT user_id, artist, n FROM user_artist_counts",
+                                            self._EXPECTED_ARTIST_COUNTS, "user_id, artist"),
+                "user_stats": drift("SELECT user_id, total_tracks, unique_artists, public_playlists, "
+                                    "private_playlists FROM user_stats", self._EXPECTED_USER_STATS, "user_id"),
+            }
+
+    def _bump_tracks(self, conn, playlist_id: int, artists: Dict[str, int], sign: int):
+        """
+        เพิ่ม (sign=1) / ลด (sign=-1) ตัวนับตามเพลงที่เพิ่ง INSERT/DELETE ใน playlist_id
+        artists = {artist: จำนวนเพลง}; เรียกใน transaction เดียวกับการแก้ playlist_tracks
+        """
+        total = sum(artists.values())
+        if not total:
+            return
+        user_id = conn.execute(
+            text("UPDATE playlists SET track_count = track_count + :d WHERE id=:pid RETURNING user_id"),
+            {"d": sign * total, "pid": playlist_id},
+        ).scalar()
+        if user_id is None:
+            return
+        if sign > 0:
+            # upsert ทีละศิลปิน: n ที่ได้กลับมา == จำนวนที่เพิ่ง add แปลว่าเป็นศิลปินใหม่ของ user นี้
+            # (ON CONFLICT ล็อกแถวไว้ -> transaction ที่ชนกันนับศิลปินใหม่ได้ครั้งเดียว)
+            new_artists = 0
+            for artist, n in artists.items():
+                after = conn.execute(text("""
+                    INSERT INTO user_artist_counts (user_id, artist, n) VALUES (:uid, :a, :n)
+                    ON CONFLICT (user_id, artist) DO UPDATE SET n = user_artist_counts.n + excluded.n
+                    RETURNING n
+                """), {"uid": user_id, "a": artist, "n": n}).scalar_one()
+                new_artists += after == n
+        else:
+            conn.execute(
+                text("UPDATE user_artist_counts SET n = n - :n WHERE user_id=:uid AND artist=:a"),
+                [{"uid": user_id, "a": a, "n": n} for a, n in artists.items()],
+            )
+            new_artists = -conn.execute(
+                text("DELETE FROM user_artist_counts WHERE user_id=:uid AND n <= 0"), {"uid": user_id}
+            ).rowcount
+        conn.execute(
+            text("""
+                UPDATE user_stats SET total_tracks = total_tracks + :d, unique_artists = unique_artists + :a
+                WHERE user_id=:uid
+            """),
+            {"d": sign * total, "a": new_artists, "uid": user_id},
+        )
+
+    def _bump_visibility(self, conn, user_id: int, was_public: Optional[bool], is_public: Optional[bool]):
+        """เพลย์ลิสต์ถูกสร้าง (was=None) / ลบ (is=None) / เปลี่ยน public<->private"""
+        delta = {True: 0, False: 0}
+        if was_public is not None:
+            delta[bool(was_public)] -= 1
+        if is_public is not None:
+            delta[bool(is_public)] += 1
+        if delta[True] or delta[False]:
+            conn.execute(
+                text("""
+                    UPDATE user_stats SET public_playlists = public_playlists + :pub,
+                                          private_playlists = private_playlists + :priv
+                    WHERE user_id=:uid
+                """),
+                {"pub": delta[True], "priv": delta[False], "uid": user_id},
+            )
 
-            # --- MIGRATION: move legacy "playlist" rows into new playlists/playlist_tracks ---
-            # If user has tracks in old "playlist" but has no playlists yet, create default one.
-            has_any_new = conn.exec_driver_sql("SELECT COUNT(1) FROM playlists").fetchone()[0] > 0
-            legacy_rows = conn.exec_driver_sql("SELECT id, user_id, title, artist, url, mbid, added_at FROM playlist").fetchall()
-            if legacy_rows and not has_any_new:
-                # create one default playlist per user who has legacy rows
-                users_with_legacy = [r[1] for r in legacy_rows]
-                unique_users = sorted(set(users_with_legacy))
-                for uid in unique_users:
-                    now = datetime.utcnow().isoformat()
-                    cur = conn.execute(
-                        text("""
-                            INSERT INTO playlists (user_id, name, description, is_public, created_at, updated_at)
-                            VALUES (:uid, :name, :desc, :pub, :c, :u)
-                        """),
-                        {"uid": uid, "name": "My Playlist", "desc": "", "pub": 0, "c": now, "u": now},
-                    )
-                    new_pid = cur.lastrowid
-                    # pull legacy items for this user and insert with ordering
-                    items = [r for r in legacy_rows if r[1] == uid]
-                    pos = 0
-                    for _, _, title, artist, url_, mbid, added_at in items:
-                        conn.execute(
-                            text("""
-                                INSERT INTO playlist_tracks (playlist_id, title, artist, url, mbid, position, added_at)
-                                VALUES (:pid, :title, :artist, :url, :mbid, :pos, :added)
-                            """),
-                            {"pid": new_pid, "title": title, "artist": artist, "url": url_, "mbid": mbid,
-                             "pos": pos, "added": added_at or now}
-                        )
-                        pos += 1
-
-            # leave the old 'playlist' table as is for backward compatibility; new code uses playlists/playlist_tracks
+    def _delete_all_tracks(self, conn, playlist_id: int) -> Dict[str, int]:
+        """ลบเพลงทั้งหมดของเพลย์ลิสต์ คืน {artist: จำนวน} ของแถวที่ลบจริง (ไม่ใช่ของที่ SELECT ไว้ก่อน)"""
+        rows = conn.execute(
+            text("DELETE FROM playlist_tracks WHERE playlist_id=:pid RETURNING artist"), {"pid": playlist_id}
+        ).scalars()
+        return Counter(rows)
+
+    def _lock_playlist(self, conn, playlist_id: int, user_id: int):
+        """
+        แตะ updated_at ของเพลย์ลิสต์แล้วคืน (is_public, share_token) เดิม หรือ None ถ้าไม่ใช่ของ user
+        UPDATE ก่อนอ่าน = ได้ lock (PostgreSQL: แถวนี้, SQLite: ทั้ง DB) -> transaction อื่นที่สลับ
+        public/private พร้อมกันต้องรอ ค่าที่อ่านได้จึงเป็นค่าเดิมจริงตอนปรับ user_stats
+        """
+        return conn.execute(
+            text("UPDATE playlists SET updated_at=:u WHERE id=:pid AND user_id=:uid RETURNING is_public, share_token"),
+            {"u": datetime.utcnow().isoformat(), "pid": playlist_id, "uid": user_id},
+        ).fetchone()
 
     # ---------- Users ----------
     def create_user(self, username: str, password_hash: str) -> int:
-        with self.engine.begin() as conn:
-            cur = conn.execute(
-                text("INSERT INTO users (username, password_hash, created_at) VALUES (:u, :p, :ts)"),
+        with self._write() as conn:
+            user_id = conn.execute(
+                text("INSERT INTO users (username, password_hash, created_at) VALUES (:u, :p, :ts) RETURNING id"),
                 {"u": username, "p": password_hash, "ts": datetime.utcnow().isoformat()},
-            )
-            user_id = cur.lastrowid
+            ).scalar_one()
             conn.execute(
                 text("INSERT INTO user_pref (user_id, default_genre) VALUES (:id, :g)"),
                 {"id": user_id, "g": os.getenv("DEFAULT_GENRE", "pop")},
             )
+            conn.execute(text("INSERT INTO user_stats (user_id) VALUES (:id)"), {"id": user_id})
             return user_id
 
     def get_user_by_username(self, username: str) -> Optional[dict]:
-        with self.engine.begin() as conn:
+        with self._read() as conn:
             row = conn.execute(
                 text("SELECT id, username, password_hash FROM users WHERE username=:u"),
                 {"u": username},
@@ -175,7 +581,7 @@ class StorageRepository:
             return dict(row._mapping) if row else None
 
     def get_user_by_id(self, user_id: int) -> Optional[dict]:
-        with self.engine.begin() as conn:
+        with self._read() as conn:
             row = conn.execute(
                 text("SELECT id, username, password_hash FROM users WHERE id=:i"),
                 {"i": user_id},
@@ -185,27 +591,28 @@ class StorageRepository:
     # ---------- Playlists ----------
     def create_playlist(self, user_id: int, name: str, description: str, is_public: bool) -> int:
         now = datetime.utcnow().isoformat()
-        with self.engine.begin() as conn:
-            cur = conn.execute(
+        with self._write() as conn:
+            playlist_id = conn.execute(
                 text("""
                     INSERT INTO playlists (user_id, name, description, is_public, created_at, updated_at)
                     VALUES (:uid, :name, :desc, :pub, :c, :u)
+                    RETURNING id
                 """),
                 {"uid": user_id, "name": name, "desc": description, "pub": 1 if is_public else 0, "c": now, "u": now},
-            )
-            return cur.lastrowid
+            ).scalar_one()
+            self._bump_visibility(conn, user_id, None, is_public)
+            return playlist_id
         
     def delete_playlist(self, playlist_id: int, user_id: int) -> bool:
-        with self.engine.begin() as conn:
+        with self._write() as conn:
             # ยืนยันความเป็นเจ้าของ
-            row = conn.execute(
-                text("SELECT 1 FROM playlists WHERE id=:pid AND user_id=:uid"),
-                {"pid": playlist_id, "uid": user_id}
-            ).fetchone()
+            row = self._lock_playlist(conn, playlist_id, user_id)
             if not row:
                 raise PermissionError("Permission denied for this playlist")
-    
-            # ลบตัวเพลย์ลิสต์ (playlist_tracks จะโดนลบอัตโนมัติด้วย ON DELETE CASCADE)
+            # ลบเพลงเองก่อน (แทนการปล่อยให้ CASCADE) เพื่อลดตัวนับตามแถวที่ลบจริง
+            self._bump_tracks(conn, playlist_id, self._delete_all_tracks(conn, playlist_id), -1)
+            self._bump_visibility(conn, user_id, row[0], None)
+
             res = conn.execute(
                 text("DELETE FROM playlists WHERE id=:pid AND user_id=:uid"),
                 {"pid": playlist_id, "uid": user_id}
@@ -213,7 +620,7 @@ class StorageRepository:
             return res.rowcount > 0
 
     def list_playlists(self, user_id: int) -> List[dict]:
-        with self.engine.begin() as conn:
+        with self._read() as conn:
             rows = conn.execute(
                 text("SELECT id, user_id, name, description, is_public, share_token, created_at, updated_at FROM playlists WHERE user_id=:uid ORDER BY updated_at DESC"),
                 {"uid": user_id},
@@ -221,15 +628,18 @@ class StorageRepository:
             return [dict(r._mapping) for r in rows]
 
     def get_playlist(self, playlist_id: int, user_id: int) -> Optional[dict]:
-        with self.engine.begin() as conn:
+        with self._read() as conn:
             row = conn.execute(
-                text("SELECT id, user_id, name, description, is_public, share_token FROM playlists WHERE id=:pid AND user_id=:uid"),
+                text("SELECT id, user_id, name, description, is_public, share_token, track_count FROM playlists WHERE id=:pid AND user_id=:uid"),
                 {"pid": playlist_id, "uid": user_id},
             ).fetchone()
             return dict(row._mapping) if row else None
 
     def update_playlist_meta(self, playlist_id: int, user_id: int, name: str, description: str, is_public: bool):
-        with self.engine.begin() as conn:
+        with self._write() as conn:
+            row = self._lock_playlist(conn, playlist_id, user_id)
+            if row is not None:
+                self._bump_visibility(conn, user_id, row[0], is_public)
             conn.execute(
                 text("""
                     UPDATE playlists SET name=:n, description=:d, is_public=:p, updated_at=:u
@@ -240,12 +650,11 @@ class StorageRepository:
             )
 
     def ensure_share_token(self, playlist_id: int, user_id: int) -> str:
-        with self.engine.begin() as conn:
-            row = conn.execute(
-                text("SELECT share_token FROM playlists WHERE id=:pid AND user_id=:uid"),
-                {"pid": playlist_id, "uid": user_id},
-            ).fetchone()
-            token = row[0] if row and row[0] else secrets.token_urlsafe(10)
+        with self._write() as conn:
+            row = self._lock_playlist(conn, playlist_id, user_id)
+            token = row[1] if row and row[1] else secrets.token_urlsafe(10)
+            if row:
+                self._bump_visibility(conn, user_id, row[0], True)
             conn.execute(
                 text("UPDATE playlists SET share_token=:t, is_public=1, updated_at=:u WHERE id=:pid AND user_id=:uid"),
                 {"t": token, "u": datetime.utcnow().isoformat(), "pid": playlist_id, "uid": user_id},
@@ -253,31 +662,115 @@ class StorageRepository:
             return token
 
     def get_public_playlist_by_token(self, token: str) -> Optional[dict]:
-        with self.engine.begin() as conn:
+        with self._read() as conn:
             row = conn.execute(
-                text("SELECT id, user_id, name, description, is_public, share_token FROM playlists WHERE share_token=:t AND is_public=1"),
+                text("SELECT id, user_id, name, description, is_public, share_token, updated_at, track_count FROM playlists WHERE share_token=:t AND is_public=1"),
                 {"t": token},
             ).fetchone()
             return dict(row._mapping) if row else None
 
     # ---------- Playlist Tracks ----------
-    def insert_playlist_track(self, playlist_id: int, track: Track):
-        with self.engine.begin() as conn:
-            # find current max position
-            pos_row = conn.execute(
-                text("SELECT COALESCE(MAX(position), -1) FROM playlist_tracks WHERE playlist_id=:pid"),
-                {"pid": playlist_id},
-            ).fetchone()
-            next_pos = (pos_row[0] if pos_row[0] is not None else 0) + 1
+    # position เว้นช่วงทีละ POSITION_GAP: ย้าย/แทรกเพลงได้ด้วย UPDATE/INSERT แถวเดียว
+    # โดยใช้ค่ากึ่งกลางระหว่างเพื่อนบ้าน; ถ้าช่องว่างหมดค่อย renumber ทั้งเพลย์ลิสต์ (นานๆ ครั้ง)
+    POSITION_GAP = 1024
+
+    def _next_position(self, conn, playlist_id: int) -> int:
+        row = conn.execute(
+            text("SELECT COALESCE(MAX(position), -:gap) + :gap FROM playlist_tracks WHERE playlist_id=:pid"),
+            {"pid": playlist_id, "gap": self.POSITION_GAP},
+        ).fetchone()
+        return row[0]
+
+    def _position_for_index(self, conn, playlist_id: int, index: int, exclude_id: Optional[int] = None) -> int:
+        """ตำแหน่งที่ทำให้เพลงไปอยู่ลำดับ `index` (0 = บนสุด) เมื่อไม่นับ exclude_id"""
+        index = max(0, index)
+        for _ in range(2):
+            rows = conn.execute(
+                text("""
+                    SELECT position FROM playlist_tracks
+                    WHERE playlist_id=:pid AND id<>:tid
+                    ORDER BY position ASC, id ASC LIMIT :n OFFSET :off
+                """),
+                {"pid": playlist_id, "tid": exclude_id or -1, "n": 2 if index else 1, "off": max(index - 1, 0)},
+            ).fetchall()
+            if index == 0:
+                prev_pos, next_pos = None, (rows[0][0] if rows else None)
+            else:
+                prev_pos = rows[0][0] if rows else None
+                next_pos = rows[1][0] if len(rows) > 1 else None
+            if prev_pos is None and next_pos is None:
+                return self._next_position(conn, playlist_id) if index else 0
+            if prev_pos is None:
+                return next_pos - self.POSITION_GAP
+            if next_pos is None:
+                return prev_pos + self.POSITION_GAP
+            if next_pos - prev_pos > 1:
+                return (prev_pos + next_pos) // 2
+            # ช่องว่างหมดแล้ว -> เว้นระยะใหม่ทั้งเพลย์ลิสต์ แล้วคำนวณอีกรอบ
+            self._renumber(conn, playlist_id)
+        raise RuntimeError("Could not allocate a track position")
+
+    def _renumber(self, conn, playlist_id: int):
+        conn.execute(
+            text("""
+                UPDATE playlist_tracks SET position = r.rn * :gap
+                FROM (
+                    SELECT id, ROW_NUMBER() OVER (ORDER BY position ASC, id ASC) - 1 AS rn
+                    FROM playlist_tracks WHERE playlist_id=:pid
+                ) AS r
+                WHERE playlist_tracks.id = r.id
+            """),
+            {"pid": playlist_id, "gap": self.POSITION_GAP},
+        )
+
+    def renumber_positions(self, playlist_id: int):
+        """เว้นระยะ position ใหม่เป็น 0, GAP, 2*GAP, ... (ลำดับเดิม)"""
+        with self._write() as conn:
+            self._renumber(conn, playlist_id)
+
+    def insert_playlist_track(self, playlist_id: int, track: Track, index: Optional[int] = None):
+        """เพิ่มเพลงต่อท้าย หรือแทรกที่ลำดับ `index` (0 = บนสุด)"""
+        with self._write() as conn:
+            if index is None:
+                pos = self._next_position(conn, playlist_id)
+            else:
+                pos = self._position_for_index(conn, playlist_id, index)
             conn.execute(
                 text("""
                     INSERT INTO playlist_tracks (playlist_id, title, artist, url, mbid, position, added_at)
                     VALUES (:pid, :title, :artist, :url, :mbid, :pos, :added)
                 """),
                 {"pid": playlist_id, "title": track.title, "artist": track.artist, "url": track.url,
-                 "mbid": track.mbid, "pos": next_pos, "added": datetime.utcnow().isoformat()}
+                 "mbid": track.mbid, "pos": pos, "added": datetime.utcnow().isoformat()}
             )
-            conn.execute(text("UPDATE playlists SET updated_at=:u WHERE id=:pid"), {"u": datetime.utcnow().isoformat(), "pid": playlist_id})
+            self._bump_tracks(conn, playlist_id, {track.artist: 1}, 1)
+            self._touch(conn, playlist_id)
+
+    def insert_playlist_tracks(self, playlist_id: int, tracks: Iterable[Track]) -> int:
+        """เพิ่มหลายเพลงต่อท้ายในครั้งเดียว: lookup ตำแหน่ง 1 ครั้ง + executemany ใน transaction เดียว"""
+        tracks = list(tracks)
+        if not tracks:
+            return 0
+        now = datetime.utcnow().isoformat()
+        with self._write() as conn:
+            start = self._next_position(conn, playlist_id)
+            conn.execute(
+                text("""
+                    INSERT INTO playlist_tracks (playlist_id, title, artist, url, mbid, position, added_at)
+                    VALUES (:pid, :title, :artist, :url, :mbid, :pos, :added)
+                """),
+                [{"pid": playlist_id, "title": t.title, "artist": t.artist, "url": t.url,
+                  "mbid": t.mbid, "pos": start + i * self.POSITION_GAP, "added": now} for i, t in enumerate(tracks)]
+            )
+            self._bump_tracks(conn, playlist_id, Counter(t.artist for t in tracks), 1)
+            self._touch(conn, playlist_id)
+        return len(tracks)
+
+    def _touch(self, conn, playlist_id: int):
+        # updated_at = เวอร์ชันของเพลย์ลิสต์: หน้า /p/<token> ใช้เป็น key ของ cache + ETag
+        # -> ทุก method ที่เปลี่ยนสิ่งที่หน้านั้นแสดง (ชื่อ/คำอธิบาย/เพลง/ลำดับ) ต้องเรียกตัวนี้
+        conn.execute(text("UPDATE playlists SET updated_at=:u WHERE id=:pid"),
+                     {"u": datetime.utcnow().isoformat(), "pid": playlist_id})
 
     def _assert_owner(self, conn, playlist_id: int, user_id: int):
         row = conn.execute(text("SELECT 1 FROM playlists WHERE id=:pid AND user_id=:uid"), {"pid": playlist_id, "uid": user_id}).fetchone()
@@ -285,23 +778,56 @@ class StorageRepository:
             raise PermissionError("Permission denied for this playlist")
 
     def delete_playlist_track(self, playlist_id: int, track_id: int, user_id: int):
-        with self.engine.begin() as conn:
+        with self._write() as conn:
             self._assert_owner(conn, playlist_id, user_id)
-            conn.execute(text("DELETE FROM playlist_tracks WHERE id=:tid AND playlist_id=:pid"),
-                         {"tid": track_id, "pid": playlist_id})
-
-    def fetch_playlist_tracks(self, playlist_id: int, user_id: Optional[int] = None, limit: Optional[int] = None) -> List[dict]:
-        with self.engine.begin() as conn:
+            artist = conn.execute(text("DELETE FROM playlist_tracks WHERE id=:tid AND playlist_id=:pid RETURNING artist"),
+                                  {"tid": track_id, "pid": playlist_id}).scalar()
+            if artist is not None:
+                self._bump_tracks(conn, playlist_id, {artist: 1}, -1)
+                self._touch(conn, playlist_id)
+
+    def fetch_playlist_tracks(self, playlist_id: int, user_id: Optional[int] = None, limit: Optional[int] = None,
+                              after: Optional[Tuple[int, int]] = None) -> List[dict]:
+        """
+        เพลงเรียงตาม (position, id); after=(position, id) ของเพลงสุดท้ายในหน้าก่อน -> หน้าถัดไป (keyset)
+        ค่าใช้จ่ายขึ้นกับ limit ไม่ขึ้นกับว่าอยู่หน้าที่เท่าไร (ไม่มี OFFSET ให้ DB ไล่ข้าม)
+        """
+        with self._read() as conn:
             if user_id is not None:
                 self._assert_owner(conn, playlist_id, user_id)
-            q = "SELECT id, title, artist, url, mbid, position, added_at FROM playlist_tracks WHERE playlist_id=:pid ORDER BY position ASC"
+            q = "SELECT id, title, artist, url, mbid, position, added_at FROM playlist_tracks WHERE playlist_id=:pid"
+            params = {"pid": playlist_id}
+            if after is not None:
+                q += " AND (position, id) > (:after_pos, :after_id)"
+                params.update(after_pos=after[0], after_id=after[1])
+            q += " ORDER BY position ASC, id ASC"
             if limit:
                 q += " LIMIT :limit"
-            rows = conn.execute(text(q), {"pid": playlist_id, "limit": limit} if limit else {"pid": playlist_id}).fetchall()
+                params["limit"] = limit
+            rows = conn.execute(text(q), params).fetchall()
             return [dict(r._mapping) for r in rows]
 
+    def iter_playlist_tracks(self, playlist_id: int, user_id: Optional[int] = None,
+                             batch_size: int = 500) -> Iterator[dict]:
+        """
+        ไล่เพลงทั้งเพลย์ลิสต์ตามลำดับแบบ streaming (สำหรับ export): server-side cursor ดึงทีละ batch_size
+        ใช้ connection ของตัวเองจนกว่าจะไล่ครบ/ปิด generator หน่วยความจำคงที่ไม่ขึ้นกับขนาดเพลย์ลิสต์
+        """
+        with self.engine.connect() as conn:
+            if user_id is not None:
+                self._assert_owner(conn, playlist_id, user_id)
+            result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(
+                text("""
+                    SELECT id, title, artist, url, mbid, position, added_at FROM playlist_tracks
+                    WHERE playlist_id=:pid ORDER BY position ASC, id ASC
+                """),
+                {"pid": playlist_id},
+            )
+            for row in result:
+                yield dict(row._mapping)
+
     def reorder_track(self, playlist_id: int, track_id: int, direction: str, user_id: int):
-        with self.engine.begin() as conn:
+        with self._write() as conn:
             self._assert_owner(conn, playlist_id, user_id)
             row = conn.execute(
                 text("SELECT id, position FROM playlist_tracks WHERE id=:tid AND playlist_id=:pid"),
@@ -310,57 +836,71 @@ class StorageRepository:
             if not row:
                 return
             current_pos = row[1]
+            # เพื่อนบ้านตามลำดับ (position, id) เดียวกับที่แสดง -> position ซ้ำกันก็ไม่ข้าม/สลับผิดแถว
             if direction == "up":
-                neighbor = conn.execute(
-                    text("SELECT id, position FROM playlist_tracks WHERE playlist_id=:pid AND position<:p ORDER BY position DESC LIMIT 1"),
-                    {"pid": playlist_id, "p": current_pos},
-                ).fetchone()
+                q = ("SELECT id, position FROM playlist_tracks WHERE playlist_id=:pid AND (position, id) < (:p, :tid) "
+                     "ORDER BY position DESC, id DESC LIMIT 1")
             else:
-                neighbor = conn.execute(
-                    text("SELECT id, position FROM playlist_tracks WHERE playlist_id=:pid AND position>:p ORDER BY position ASC LIMIT 1"),
-                    {"pid": playlist_id, "p": current_pos},
-                ).fetchone()
+                q = ("SELECT id, position FROM playlist_tracks WHERE playlist_id=:pid AND (position, id) > (:p, :tid) "
+                     "ORDER BY position ASC, id ASC LIMIT 1")
+            neighbor = conn.execute(text(q), {"pid": playlist_id, "p": current_pos, "tid": track_id}).fetchone()
             if not neighbor:
                 return
             nid, npos = neighbor
+            if npos == current_pos:
+                # position เท่ากัน สลับไปก็ไม่เปลี่ยนลำดับ -> จัดช่องใหม่ก่อน (ลำดับเดิมไม่เปลี่ยน) แล้วอ่านค่าใหม่
+                self._renumber(conn, playlist_id)
+                pos = dict(conn.execute(
+                    text("SELECT id, position FROM playlist_tracks WHERE id IN (:tid, :nid)"),
+                    {"tid": track_id, "nid": nid},
+                ).fetchall())
+                current_pos, npos = pos[track_id], pos[nid]
             # swap positions
             conn.execute(text("UPDATE playlist_tracks SET position=:np WHERE id=:tid"), {"np": npos, "tid": row[0]})
             conn.execute(text("UPDATE playlist_tracks SET position=:cp WHERE id=:nid"), {"cp": current_pos, "nid": nid})
+            self._touch(conn, playlist_id)
+
+    def move_track_to(self, playlist_id: int, track_id: int, index: int, user_id: int) -> bool:
+        """ย้ายเพลงไปลำดับ `index` (0 = บนสุด) ด้วย UPDATE แถวเดียว; คืน False ถ้าไม่พบเพลง"""
+        with self._write() as conn:
+            self._assert_owner(conn, playlist_id, user_id)
+            row = conn.execute(
+                text("SELECT id FROM playlist_tracks WHERE id=:tid AND playlist_id=:pid"),
+                {"tid": track_id, "pid": playlist_id},
+            ).fetchone()
+            if not row:
+                return False
+            pos = self._position_for_index(conn, playlist_id, index, exclude_id=track_id)
+            conn.execute(text("UPDATE playlist_tracks SET position=:p WHERE id=:tid"), {"p": pos, "tid": track_id})
+            self._touch(conn, playlist_id)
+            return True
 
     def clear_playlist_tracks(self, playlist_id: int, user_id: int):
-        with self.engine.begin() as conn:
+        with self._write() as conn:
             self._assert_owner(conn, playlist_id, user_id)
-            conn.execute(text("DELETE FROM playlist_tracks WHERE playlist_id=:pid"), {"pid": playlist_id})
+            self._bump_tracks(conn, playlist_id, self._delete_all_tracks(conn, playlist_id), -1)
+            self._touch(conn, playlist_id)
 
     # ---------- Preferences ----------
     def get_default_genre(self, user_id: int) -> str:
-        with self.engine.begin() as conn:
+        with self._read() as conn:
             row = conn.execute(text("SELECT default_genre FROM user_pref WHERE user_id=:uid"), {"uid": user_id}).fetchone()
-            if row and row[0]:
-                return row[0]
-            default_g = os.getenv("DEFAULT_GENRE", "pop")
-            conn.execute(text("INSERT OR IGNORE INTO user_pref (user_id, default_genre) VALUES (:uid, :g)"),
+        if row and row[0]:
+            return row[0]
+        default_g = os.getenv("DEFAULT_GENRE", "pop")
+        with self._write() as conn:
+            conn.execute(text("INSERT INTO user_pref (user_id, default_genre) VALUES (:uid, :g) ON CONFLICT (user_id) DO NOTHING"),
                          {"uid": user_id, "g": default_g})
             return default_g
 
     def set_default_genre(self, user_id: int, genre: str):
-        with self.engine.begin() as conn:
+        with self._write() as conn:
             conn.execute(text("UPDATE user_pref SET default_genre=:g WHERE user_id=:uid"),
                          {"g": genre, "uid": user_id})
 
-    # ---------- CSV export (top10 of specific playlist) ----------
-    def export_playlist_csv(self, playlist_id: int, user_id: int, path: str = "playlist_top10.csv") -> str:
-        rows = self.fetch_playlist_tracks(playlist_id, user_id, limit=10)
-        with open(path, "w", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=["id", "title", "artist", "url", "mbid", "position", "added_at"])
-            writer.writeheader()
-            for r in rows:
-                writer.writerow(r)
-        return path
-
     # ---------- OAuth token storage ----------
     def upsert_user_token(self, user_id: int, provider: str, access_token: str, refresh_token: Optional[str], expires_at: Optional[str]):
-        with self.engine.begin() as conn:
+        with self._write() as conn:
             conn.execute(text("""
                 INSERT INTO user_tokens (user_id, provider, access_token, refresh_token, expires_at)
                 VALUES (:uid, :p, :at, :rt, :ea)
@@ -371,46 +911,113 @@ class StorageRepository:
             """), {"uid": user_id, "p": provider, "at": access_token, "rt": refresh_token, "ea": expires_at})
 
     def get_user_token(self, user_id: int, provider: str) -> Optional[dict]:
-        with self.engine.begin() as conn:
+        with self._read() as conn:
             row = conn.execute(text("SELECT access_token, refresh_token, expires_at FROM user_tokens WHERE user_id=:uid AND provider=:p"),
                                {"uid": user_id, "p": provider}).fetchone()
             return dict(row._mapping) if row else None
 
+    # ---------- Spotify URI cache ----------
+    @staticmethod
+    def _track_key(title: str, artist: str) -> Tuple[str, str]:
+        return (title or "").strip().casefold(), (artist or "").strip().casefold()
+
+    def get_spotify_uris(self, pairs: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], str]:
+        """คืน {(title, artist): uri} เฉพาะคู่ที่เคยค้นเจอแล้ว (key ตามที่ส่งเข้ามา)"""
+        wanted: Dict[Tuple[str, str], List[Tuple[str, str]]] = {}
+        for title, artist in pairs:
+            wanted.setdefault(self._track_key(title, artist), []).append((title, artist))
+        keys = list(wanted)
+        found: Dict[Tuple[str, str], str] = {}
+        with self._read() as conn:
+            for i in range(0, len(keys), 200):
+                chunk = keys[i:i+200]
+                values = ", ".join(f"(:t{n}, :a{n})" for n in range(len(chunk)))
+                params = {}
+                for n, (t, a) in enumerate(chunk):
+                    params[f"t{n}"], params[f"a{n}"] = t, a
+                rows = conn.execute(text(f"""
+                    SELECT title_key, artist_key, uri FROM spotify_track_uris
+                    WHERE (title_key, artist_key) IN (VALUES {values})
+                """), params).fetchall()
+                for t, a, uri in rows:
+                    for original in wanted[(t, a)]:
+                        found[original] = uri
+        return found
+
+    def save_spotify_uris(self, uris: Dict[Tuple[str, str], str]):
+        if not uris:
+            return
+        now = datetime.utcnow().isoformat()
+        rows = []
+        for (title, artist), uri in uris.items():
+            t, a = self._track_key(title, artist)
+            rows.append({"t": t, "a": a, "uri": uri, "u": now})
+        with self._write() as conn:
+            conn.execute(text("""
+                INSERT INTO spotify_track_uris (title_key, artist_key, uri, updated_at)
+                VALUES (:t, :a, :uri, :u)
+                ON CONFLICT(title_key, artist_key) DO UPDATE SET
+                    uri=excluded.uri,
+                    updated_at=excluded.updated_at
+            """), rows)
+
+    # ---------- Background jobs ----------
+    JOB_FIELDS = ("status", "progress", "total", "message", "result")
+
+    def create_job(self, user_id: int, kind: str, total: int = 0) -> str:
+        job_id = uuid.uuid4().hex
+        now = datetime.utcnow().isoformat()
+        with self._write() as conn:
+            conn.execute(text("""
+                INSERT INTO jobs (id, user_id, kind, status, progress, total, created_at, updated_at)
+                VALUES (:id, :uid, :k, 'queued', 0, :total, :c, :u)
+            """), {"id": job_id, "uid": user_id, "k": kind, "total": total, "c": now, "u": now})
+        return job_id
+
+    def update_job(self, job_id: str, **fields):
+        """อัปเดตสถานะ/ความคืบหน้า; result ส่งเป็น dict ได้ (เก็บเป็น JSON)"""
+        unknown = set(fields) - set(self.JOB_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {sorted(unknown)}")
+        if "result" in fields and fields["result"] is not None:
+            fields["result"] = json.dumps(fields["result"])
+        sets = ", ".join(f"{k}=:{k}" for k in fields)
+        with self._write() as conn:
+            conn.execute(text(f"UPDATE jobs SET {sets}, updated_at=:updated_at WHERE id=:id"),
+                         {**fields, "updated_at": datetime.utcnow().isoformat(), "id": job_id})
+
+    def get_job(self, job_id: str, user_id: Optional[int] = None) -> Optional[dict]:
+        q = "SELECT id, user_id, kind, status, progress, total, message, result, created_at, updated_at FROM jobs WHERE id=:id"
+        params = {"id": job_id}
+        if user_id is not None:
+            q += " AND user_id=:uid"
+            params["uid"] = user_id
+        with self._read() as conn:
+            row = conn.execute(text(q), params).fetchone()
+        if not row:
+            return None
+        job = dict(row._mapping)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
     # ---- NEW: รวมเพลย์ลิสต์พร้อมจำนวนเพลง (ลด N+1) ----
     def list_playlists_with_counts(self, user_id: int) -> List[dict]:
-        with self.engine.begin() as conn:
+        with self._read() as conn:
             rows = conn.execute(text("""
-                SELECT p.id, p.user_id, p.name, p.description, p.is_public, p.share_token,
-                    p.created_at, p.updated_at,
-                    COUNT(t.id) AS track_count
-                FROM playlists p
-                LEFT JOIN playlist_tracks t ON t.playlist_id = p.id
-                WHERE p.user_id = :uid
-                GROUP BY p.id
-                ORDER BY p.updated_at DESC
+                SELECT id, user_id, name, description, is_public, share_token, created_at, updated_at, track_count
+                FROM playlists
+                WHERE user_id = :uid
+                ORDER BY updated_at DESC
             """), {"uid": user_id}).fetchall()
             return [dict(r._mapping) for r in rows]
 
-    # ---- NEW: สถิติโดยรวมของผู้ใช้ ----
+    # ---- NEW: สถิติโดยรวมของผู้ใช้ (อ่านจาก user_stats แถวเดียว) ----
     def get_user_music_stats(self, user_id: int) -> dict:
-        with self.engine.begin() as conn:
-            totals = conn.execute(text("""
-                SELECT COUNT(t.id) AS total_tracks,
-                    COUNT(DISTINCT t.artist) AS unique_artists
-                FROM playlists p
-                LEFT JOIN playlist_tracks t ON t.playlist_id = p.id
-                WHERE p.user_id = :uid
-            """), {"uid": user_id}).fetchone()
-            vis = conn.execute(text("""
-                SELECT
-                SUM(CASE WHEN is_public = 1 THEN 1 ELSE 0 END) AS public_pl,
-                SUM(CASE WHEN is_public = 0 THEN 1 ELSE 0 END) AS private_pl
-                FROM playlists WHERE user_id = :uid
+        with self._read() as conn:
+            row = conn.execute(text("""
+                SELECT total_tracks, unique_artists, public_playlists, private_playlists
+                FROM user_stats WHERE user_id = :uid
             """), {"uid": user_id}).fetchone()
-
-            return {
-                "total_tracks": (totals[0] or 0) if totals else 0,
-                "unique_artists": (totals[1] or 0) if totals else 0,
-                "public_playlists": (vis[0] or 0) if vis else 0,
-                "private_playlists": (vis[1] or 0) if vis else 0,
-            }
\ No newline at end of file
+            if not row:
+                return {"total_tracks": 0, "unique_artists": 0, "public_playlists": 0, "private_playlists": 0}
+            return dict(row._mapping)
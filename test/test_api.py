@@ -0,0 +1,100 @@
+import json
+
+
+def test_api_requires_login_without_redirect(logged_in_client):
+    client, app_module, repo, user_id = logged_in_client
+    r = app_module.app.test_client().get("/api/v1/playlists")
+    assert r.status_code == 401
+    assert r.get_json() == {"error": "login required"}
+
+
+def test_api_lastfm_endpoints_with_field_selection(logged_in_client):
+    client, app_module, repo, user_id = logged_in_client
+
+    r = client.get("/api/v1/tags/k-pop/tracks?fields=title,artist")
+    assert r.status_code == 200
+    assert r.get_json() == {"tracks": [{"title": "Ditto", "artist": "NewJeans"},
+                                       {"title": "FANCY", "artist": "TWICE"}], "stale": False}
+    assert b" " not in r.data.replace(b"The Feels", b"")      # compact JSON
+
+    r = client.get("/api/v1/search?q=TWICE&mode=artist&fields=title")
+    assert r.get_json()["tracks"] == [{"title": "The Feels"}]
+    assert client.get("/api/v1/search").status_code == 400
+
+    r = client.get("/api/v1/artists/TWICE/similar?fields=name,match&min_match=0.5")
+    assert r.get_json()["artists"] == [{"name": "ITZY", "match": 0.9}]
+
+
+def test_api_playlist_crud_bulk_add_and_reorder(logged_in_client):
+    client, app_module, repo, user_id = logged_in_client
+
+    r = client.post("/api/v1/playlists", json={"name": "เพลย์ลิสต์", "is_public": True})
+    assert r.status_code == 201
+    assert "เพลย์ลิสต์".encode() in r.data       # ไม่ escape เป็น \uXXXX
+    pid = r.get_json()["id"]
+
+    r = client.post(f"/api/v1/playlists/{pid}/tracks",
+                    json={"tracks": [{"title": t, "artist": "A"} for t in ("a", "b", "c")]})
+    assert r.status_code == 201 and r.get_json() == {"added": 3, "track_count": 3}
+    r = client.post(f"/api/v1/playlists/{pid}/tracks", json={"title": "top", "artist": "B", "index": 0})
+    assert r.get_json() == {"added": 1, "track_count": 4}
+    assert client.post(f"/api/v1/playlists/{pid}/tracks", json={"title": "x"}).status_code == 400
+
+    r = client.get(f"/api/v1/playlists/{pid}/tracks?fields=id,title&limit=3")
+    page = r.get_json()
+    assert [t["title"] for t in page["tracks"]] == ["top", "a", "b"] and page["next"]
+    r = client.get(f"/api/v1/playlists/{pid}/tracks?fields=title&after={page['next']}")
+    assert r.get_json() == {"tracks": [{"title": "c"}], "next": None}
+
+    ids = {t["title"]: t["id"] for t in page["tracks"]}
+    assert client.post(f"/api/v1/playlists/{pid}/tracks/{ids['top']}/move", json={"index": 2}).status_code == 204
+    assert client.post(f"/api/v1/playlists/{pid}/tracks/{ids['b']}/move", json={"direction": "up"}).status_code == 204
+    assert client.delete(f"/api/v1/playlists/{pid}/tracks/{ids['a']}").status_code == 204
+    r = client.get(f"/api/v1/playlists/{pid}/tracks?fields=title")
+    assert [t["title"] for t in r.get_json()["tracks"]] == ["b", "top", "c"]
+
+    # ต้องเป็น JSON boolean/int จริง: "false" ไม่กลายเป็น public, true ไม่ใช่ index 1
+    assert client.post("/api/v1/playlists", json={"name": "x", "is_public": "false"}).status_code == 400
+    assert client.patch(f"/api/v1/playlists/{pid}", json={"is_public": "false"}).status_code == 400
+    assert client.post(f"/api/v1/playlists/{pid}/tracks",
+                       json={"title": "t", "artist": "a", "index": True}).status_code == 400
+    assert client.post(f"/api/v1/playlists/{pid}/tracks/{ids['top']}/move",
+                       json={"index": False}).status_code == 400
+
+    r = client.patch(f"/api/v1/playlists/{pid}", json={"description": "d"})
+    assert r.get_json()["description"] == "d" and r.get_json()["name"] == "เพลย์ลิสต์"
+    assert client.get("/api/v1/playlists?fields=id,track_count").get_json() == {
+        "playlists": [{"id": pid, "track_count": 3}]}
+
+    # เพลย์ลิสต์ของคนอื่น = ไม่พบ
+    other = repo.create_user("other", "x")
+    other_pid = repo.create_playlist(other, "theirs", "", False)
+    assert client.post(f"/api/v1/playlists/{other_pid}/tracks", json={"title": "t", "artist": "a"}).status_code == 404
+    assert client.delete(f"/api/v1/playlists/{other_pid}/tracks").status_code == 404
+    assert client.get(f"/api/v1/playlists/{other_pid}").status_code == 404
+
+    assert client.delete(f"/api/v1/playlists/{pid}/tracks").status_code == 204
+    assert client.delete(f"/api/v1/playlists/{pid}").status_code == 204
+    assert client.get(f"/api/v1/playlists/{pid}").status_code == 404
+    assert json.loads(client.get("/api/v1/playlists").data) == {"playlists": []}
+
+
+def test_api_maps_lastfm_errors_and_unknown_paths_to_json(logged_in_client, monkeypatch):
+    client, app_module, repo, user_id = logged_in_client
+    from api import CircuitOpenError, LastFMError      # class เดียวกับที่ api.py ใช้ตรวจ
+
+    for error, status in ((LastFMError(6, "The artist you supplied could not be found"), 404),
+                          (CircuitOpenError("open"), 503),
+                          (LastFMError(29, "Rate Limit Exceeded"), 503),
+                          (ConnectionError("reset"), 502)):
+        def fail(*args, **kwargs):
+            raise error
+        monkeypatch.setattr(app_module.lastfm_client, "top_tracks_by_artist", fail)
+        r = client.get("/api/v1/artists/nobody/tracks")
+        assert r.status_code == status and r.get_json()["error"].startswith("Last.fm")
+
+    for path in ("/api/v1/nope", "/api/v2/playlists"):
+        r = client.get(path)
+        assert r.status_code == 404 and r.is_json and "error" in r.get_json()
+    assert client.get("/nope").status_code == 404 and not client.get("/nope").is_json
+
@@ -35,7 +35,9 @@ def test_add_tracks_position_increments(logged_in_client):
     repo.insert_playlist_track(pid, Track(title="FANCY", artist="TWICE", url="", mbid="b"))
 
     tracks = repo.fetch_playlist_tracks(pid, user_id=user_id)
-    assert [t["position"] for t in tracks] in ([0, 1], [1, 2])  # แล้วแต่ดีไซน์คุณ
+    # position เว้นช่วง (POSITION_GAP) แต่ต้องเรียงเพิ่มขึ้นตามลำดับที่เพิ่ม
+    assert [t["title"] for t in tracks] == ["Ditto", "FANCY"]
+    assert tracks[0]["position"] < tracks[1]["position"]
 
 def test_share_public_and_open(logged_in_client):
     client, app_module, repo, user_id = logged_in_client
@@ -48,6 +50,114 @@ def test_share_public_and_open(logged_in_client):
     assert r.status_code == 200
     assert b"(Public)" in r.data or b"Public" in r.data
 
+def test_public_page_cached_with_etag_and_invalidated_on_change(logged_in_client):
+    client, app_module, repo, user_id = logged_in_client
+    from models import Track
+    pid = repo.create_playlist(user_id, "Viral", "", True)
+    repo.insert_playlist_track(pid, Track(title="First Song", artist="A"))
+    token = repo.ensure_share_token(pid, user_id)
+    anon = app_module.app.test_client()
+
+    r = anon.get(f"/p/{token}")
+    assert r.status_code == 200 and b"First Song" in r.data
+    etag = r.headers["ETag"]
+    assert r.headers["Last-Modified"]
+
+    calls = []
+    real_fetch, real_lookup = repo.fetch_playlist_tracks, repo.get_public_playlist_by_token
+    repo.fetch_playlist_tracks = lambda *a, **kw: calls.append("fetch") or real_fetch(*a, **kw)
+    assert anon.get(f"/p/{token}", headers={"If-None-Match": etag}).status_code == 304
+    assert anon.get(f"/p/{token}").data == r.data
+    assert calls == []          # ทั้ง 304 และหน้าเต็มมาจาก cache
+
+    # ผู้ใช้ที่ login อยู่ได้ ETag ของตัวเอง (หน้าเดียวกันแต่ header ต่างกัน)
+    r_user = client.get(f"/p/{token}", headers={"If-None-Match": etag})
+    assert r_user.status_code == 200 and r_user.headers["ETag"] != etag
+
+    # ทุกการแก้เพลย์ลิสต์ทำให้ ETag เดิมใช้ไม่ได้
+    tracks = real_fetch(pid)
+    for change in (
+        lambda: repo.insert_playlist_track(pid, Track(title="Second Song", artist="B")),
+        lambda: repo.move_track_to(pid, tracks[0]["id"], 1, user_id),
+        lambda: repo.delete_playlist_track(pid, tracks[0]["id"], user_id),
+        lambda: repo.update_playlist_meta(pid, user_id, "Viral 2", "", True),
+        lambda: repo.clear_playlist_tracks(pid, user_id),
+    ):
+        change()
+        r = anon.get(f"/p/{token}", headers={"If-None-Match": etag})
+        assert r.status_code == 200 and r.headers["ETag"] != etag
+        etag = r.headers["ETag"]
+    assert b"Viral 2" in r.data and b"Song" not in r.data
+
+    repo.update_playlist_meta(pid, user_id, "Viral 2", "", False)
+    assert anon.get(f"/p/{token}", headers={"If-None-Match": etag}).status_code == 302
+    assert real_lookup(token) is None
+
+def test_playlist_pages_follow_next_cursor(logged_in_client, monkeypatch):
+    client, app_module, repo, user_id = logged_in_client
+    import re
+    from models import Track
+    monkeypatch.setattr(app_module, "PLAYLIST_PAGE_SIZE", 2)
+    pid = repo.create_playlist(user_id, "Big", "", True)
+    repo.insert_playlist_tracks(pid, [Track(title=f"Song{i}", artist="A") for i in range(5)])
+    token = repo.ensure_share_token(pid, user_id)
+    anon = app_module.app.test_client()
+
+    for client_, url in ((client, f"/playlist/{pid}"), (anon, f"/p/{token}")):
+        titles = []
+        while url:
+            r = client_.get(url)
+            assert r.status_code == 200
+            page = [int(n) for n in re.findall(rb"Song(\d)", r.data)]
+            assert len(page) <= 2
+            titles += page
+            m = re.search(r'href="([^"]*after=[^"]*)"[^>]*>ถัดไป', r.data.decode())
+            url = m.group(1).replace("&amp;", "&") if m else None
+        assert titles == [0, 1, 2, 3, 4]
+        assert "#5" in r.data.decode()      # เลขลำดับต่อจากหน้าก่อน
+
+    # action บนหน้า 2 กลับมาที่หน้า 2 (ไม่เด้งกลับหน้าแรก)
+    page2 = client.get(f"/playlist/{pid}").data.decode()
+    url = re.search(r'href="([^"]*after=[^"]*)"[^>]*>ถัดไป', page2).group(1).replace("&amp;", "&")
+    html = client.get(url).data.decode()
+    remove = re.search(r'href="([^"]*/remove/[^"]*)"', html).group(1).replace("&amp;", "&")
+    assert "after=" in remove and "n=2" in remove
+    r = client.get(remove)
+    assert r.status_code == 302 and "after=" in r.location and "n=2" in r.location
+
+    # ?n= ที่แก้เองไม่ได้ cache entry / ETag ใหม่ทุกค่า: บีบไว้ที่จำนวนเพลง
+    cursor = url.split("after=")[1].split("&")[0]
+    etags = {anon.get(f"/p/{token}?after={cursor}&n={n}").headers["ETag"] for n in (4, 999, 123456)}
+    assert len(etags) == 1
+
+def test_metrics_endpoint_exposes_route_db_template_and_cache_metrics(logged_in_client, monkeypatch):
+    client, app_module, repo, user_id = logged_in_client
+    assert client.get("/playlists").status_code == 200
+    client.get("/api/v1/playlists/999999")
+
+    assert app_module.app.test_client().get("/metrics").status_code == 404     # ปิดไว้โดย default
+    monkeypatch.setattr(app_module, "METRICS_PUBLIC", True)
+    body = app_module.app.test_client().get("/metrics").data.decode()
+    assert '# TYPE http_request_duration_seconds histogram' in body
+    assert 'http_request_duration_seconds_count{route="/playlists",method="GET",status="200"}' in body
+    assert 'route="/api/v1/playlists/<int:playlist_id>",method="GET",status="404"' in body
+    assert 'template_render_duration_seconds_count{template="playlists.html"}' in body
+    assert 'db_query_duration_seconds_count{operation="SELECT",table="playlists"}' in body
+    assert 'cache_hit_ratio{cache="lastfm"}' in body
+    assert 'lastfm_client_events_total{event="requests"}' in body
+
+    monkeypatch.setattr(app_module, "METRICS_PUBLIC", False)
+    monkeypatch.setattr(app_module, "METRICS_TOKEN", "s3cret")
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer s3cret"}).status_code == 200
+
+    import pytest
+    from metrics import _Metric
+    class Incomplete(_Metric):          # ลืม samples() -> พังตอนสร้าง ไม่ใช่ตอน scrape
+        kind = "gauge"
+    with pytest.raises(TypeError):
+        Incomplete("x", "x")
+
 def test_tag_view_uses_lastfm_mock(logged_in_client):
     client, app_module, repo, user_id = logged_in_client
 
@@ -88,3 +198,294 @@ def test_delete_playlist_route(logged_in_client):
 
     items = repo.list_playlists(user_id)
     assert all(p["id"] != pid for p in items)
+
+def test_artist_view_renders_partial_results(logged_in_client, monkeypatch):
+    client, app_module, repo, user_id = logged_in_client
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("Last.fm error 29: Rate limit exceeded")
+    monkeypatch.setattr(app_module.lastfm_client, "similar_artists", broken)
+
+    r = client.get("/artist?name=TWICE")
+    assert r.status_code == 200
+    assert b"The Feels" in r.data   # top tracks ยังแสดงได้แม้ similar พัง
+
+def test_spotify_resolve_uses_cache_and_honours_retry_after(logged_in_client, monkeypatch):
+    client, app_module, repo, user_id = logged_in_client
+    repo.save_spotify_uris({("Ditto", "NewJeans"): "spotify:track:cached"})
+
+    class Resp:
+        def __init__(self, status, payload=None, headers=None):
+            self.status_code, self.payload, self.headers = status, payload, headers or {}
+            self.text = "x"
+        def raise_for_status(self):
+            assert self.status_code < 400
+        def json(self):
+            return self.payload
+
+    calls = []
+    class FakeSession:
+        def request(self, method, url, **kwargs):
+            calls.append(kwargs["params"]["q"])
+            if len(calls) == 1:
+                return Resp(429, headers={"Retry-After": "0"})
+            return Resp(200, {"tracks": {"items": [{"uri": "spotify:track:new"}]}})
+
+    tracks = [{"title": "Ditto", "artist": "NewJeans"}, {"title": "FANCY", "artist": "TWICE"}]
+    uris = app_module._spotify_resolve_track_uris(FakeSession(), tracks)
+
+    assert uris == ["spotify:track:cached", "spotify:track:new"]
+    assert calls == ["track:FANCY artist:TWICE"] * 2   # โดน 429 หนึ่งครั้งแล้ว retry
+    assert repo.get_spotify_uris([("FANCY", "TWICE")]) == {("FANCY", "TWICE"): "spotify:track:new"}
+
+def test_export_spotify_runs_as_job_and_status_is_pollable(logged_in_client, monkeypatch):
+    client, app_module, repo, user_id = logged_in_client
+    from models import Track
+    pid = repo.create_playlist(user_id, "ToSpotify", "", False)
+    for i in range(3):
+        repo.insert_playlist_track(pid, Track(title=f"T{i}", artist="A", url="", mbid=str(i)))
+    repo.upsert_user_token(user_id, "spotify", "tok", None, None)
+
+    class Resp:
+        def __init__(self, payload):
+            self.status_code, self.payload, self.headers, self.text = 200, payload, {}, "x"
+        def raise_for_status(self):
+            pass
+        def json(self):
+            return self.payload
+
+    posted = []
+    class FakeSession:
+        def request(self, method, url, **kwargs):
+            if url.endswith("/me"):
+                return Resp({"id": "sp-user"})
+            if url.endswith("/users/sp-user/playlists"):
+                return Resp({"id": "sp-pl"})
+            if url.endswith("/search"):
+                return Resp({"tracks": {"items": [{"uri": "spotify:track:" + kwargs["params"]["q"]}]}})
+            posted.append(kwargs["json"]["uris"])
+            return Resp({})
+
+    # queue แบบ synchronous เพื่อให้ test ไม่ต้องรอ thread
+    class InlineQueue:
+        def enqueue(self, name, job_id, **kwargs):
+            app_module.run_spotify_export(job_id, **kwargs)
+    monkeypatch.setattr(app_module, "job_queue", InlineQueue())
+    monkeypatch.setattr(app_module, "_get_spotify_session_for_user", lambda uid: FakeSession())
+
+    r = client.get(f"/playlist/{pid}/export/spotify")
+    assert r.status_code in (302, 303)
+    job_id = r.headers["Location"].split("job=")[1]
+
+    status = client.get(f"/jobs/{job_id}").get_json()
+    assert status["status"] == "done"
+    assert status["progress"] == status["total"] == 3
+    assert status["result"]["exported"] == 3
+    assert len(posted) == 1 and len(posted[0]) == 3
+
+def test_export_spotify_leaves_no_orphan_playlist(logged_in_client, monkeypatch):
+    client, app_module, repo, user_id = logged_in_client
+    from models import Track
+    repo.upsert_user_token(user_id, "spotify", "tok", None, None)
+    calls = []
+
+    class Resp:
+        status_code, headers, text = 200, {}, "x"
+        def __init__(self, payload):
+            self.payload = payload
+        def raise_for_status(self):
+            pass
+        def json(self):
+            return self.payload
+
+    class FakeSession:
+        def request(self, method, url, **kwargs):
+            calls.append((method, url.rsplit("/v1", 1)[-1]))
+            if url.endswith("/me"):
+                return Resp({"id": "sp-user"})
+            return Resp({"tracks": {"items": []}})     # ค้นไม่เจอสักเพลง
+
+    class InlineQueue:
+        def enqueue(self, name, job_id, **kwargs):
+            app_module.run_spotify_export(job_id, **kwargs)
+    monkeypatch.setattr(app_module, "job_queue", InlineQueue())
+    monkeypatch.setattr(app_module, "_get_spotify_session_for_user", lambda uid: FakeSession())
+
+    # เพลย์ลิสต์ว่าง: ไม่สร้าง job เลย
+    empty = repo.create_playlist(user_id, "Empty", "", False)
+    r = client.get(f"/playlist/{empty}/export/spotify")
+    assert "job=" not in r.headers["Location"] and calls == []
+    with client.session_transaction() as s:
+        assert ("message", "เพลย์ลิสต์ว่าง") in s["_flashes"]
+
+    # หาเพลงไม่เจอ: job failed แต่ไม่ได้สร้างเพลย์ลิสต์บน Spotify
+    pid = repo.create_playlist(user_id, "Unknown", "", False)
+    repo.insert_playlist_track(pid, Track(title="nope", artist="nobody"))
+    r = client.get(f"/playlist/{pid}/export/spotify")
+    job_id = r.headers["Location"].split("job=")[1]
+    assert client.get(f"/jobs/{job_id}").get_json()["status"] == "failed"
+    assert not any(method == "POST" for method, _ in calls)
+
+def test_job_status_is_private(logged_in_client):
+    client, app_module, repo, user_id = logged_in_client
+    other = repo.create_user("someone-else", "x")
+    job_id = repo.create_job(other, "spotify_export")
+    assert client.get(f"/jobs/{job_id}").status_code == 404
+
+def test_mood_build_top10_creates_playlist(logged_in_client):
+    client, app_module, repo, user_id = logged_in_client
+
+    r = client.post("/mood/build_top10", data={"tag": "k-pop"})
+    assert r.status_code in (302, 303)
+
+    items = repo.list_playlists(user_id)
+    assert len(items) == 1
+    tracks = repo.fetch_playlist_tracks(items[0]["id"], user_id=user_id)
+    assert [t["title"] for t in tracks] == ["Ditto", "FANCY"]
+
+def test_move_to_index_route(logged_in_client):
+    client, app_module, repo, user_id = logged_in_client
+    from models import Track
+    pid = repo.create_playlist(user_id, "Move", "", False)
+    repo.insert_playlist_tracks(pid, [Track(title=f"T{i}", artist="A") for i in range(5)])
+    last = repo.fetch_playlist_tracks(pid, user_id=user_id)[-1]
+
+    r = client.get(f"/playlist/{pid}/move/{last['id']}/to/0")
+    assert r.status_code in (302, 303)
+    titles = [t["title"] for t in repo.fetch_playlist_tracks(pid, user_id=user_id)]
+    assert titles == ["T4", "T0", "T1", "T2", "T3"]
+
+def test_index_request_uses_one_connection_without_commit(logged_in_client):
+    from sqlalchemy import event
+    client, app_module, repo, user_id = logged_in_client
+    client.get("/")      # user_pref มีอยู่แล้ว -> หน้าแรกอ่านอย่างเดียว
+    checkouts, commits = [], []
+    event.listen(repo.engine.pool, "checkout", lambda *a: checkouts.append(1))
+    event.listen(repo.engine, "commit", lambda conn: commits.append(1))
+    r = client.get("/")
+    assert r.status_code == 200
+    assert len(checkouts) == 1
+    assert commits == []
+
+def test_user_loader_is_cached_until_invalidated(logged_in_client, monkeypatch):
+    client, app_module, repo, user_id = logged_in_client
+    calls = []
+    real = repo.get_user_by_id
+    monkeypatch.setattr(repo, "get_user_by_id", lambda uid: calls.append(uid) or real(uid))
+
+    client.get("/")
+    client.get("/")
+    assert calls == [user_id]
+
+    app_module.forget_user(user_id)
+    client.get("/")
+    assert calls == [user_id, user_id]
+
+def test_username_carried_in_session_skips_storage(logged_in_client, monkeypatch):
+    client, app_module, repo, user_id = logged_in_client
+    from werkzeug.security import generate_password_hash
+    monkeypatch.setattr(app_module, "SESSION_CARRIES_USERNAME", True)
+    monkeypatch.setattr(app_module, "USER_CACHE_TTL", 0)
+    repo.create_user("carry", generate_password_hash("pw"))
+    client.post("/login", data={"username": "carry", "password": "pw"})
+
+    monkeypatch.setattr(repo, "get_user_by_id", lambda uid: (_ for _ in ()).throw(AssertionError("DB hit")))
+    r = client.get("/")
+    assert r.status_code == 200
+    assert b"carry" in r.data
+
+def test_export_streams_whole_playlist_in_every_format(logged_in_client, tmp_path):
+    import json
+    client, app_module, repo, user_id = logged_in_client
+    from models import Track
+    pid = repo.create_playlist(user_id, "Big <list>", "", False)
+    repo.insert_playlist_tracks(pid, [Track(title=f"T{i}", artist="A & B", url=f"https://x/{i}") for i in range(25)])
+
+    r = client.get(f"/playlist/{pid}/export/csv")
+    assert r.status_code == 200 and r.is_streamed
+    assert r.mimetype == "text/csv"
+    lines = r.get_data(as_text=True).strip().splitlines()
+    assert lines[0].startswith("id,title,artist") and len(lines) == 26
+
+    rows = [json.loads(l) for l in client.get(f"/playlist/{pid}/export/jsonl").get_data(as_text=True).splitlines()]
+    assert [r["title"] for r in rows] == [f"T{i}" for i in range(25)]
+
+    m3u = client.get(f"/playlist/{pid}/export/m3u").get_data(as_text=True)
+    assert m3u.startswith("#EXTM3U") and m3u.count("#EXTINF") == 25
+
+    xspf = client.get(f"/playlist/{pid}/export/xspf").get_data(as_text=True)
+    assert "<title>Big &lt;list&gt;</title>" in xspf and xspf.count("<track>") == 25
+
+    assert client.get(f"/export/csv/{pid}").get_data(as_text=True).count("\n") == 26
+    assert client.get(f"/playlist/{pid}/export/exe").status_code == 404
+    assert list(tmp_path.glob("*.csv")) == []       # ไม่มีไฟล์ถูกเขียนลง cwd
+
+def test_export_checks_owner_before_streaming(logged_in_client):
+    client, app_module, repo, user_id = logged_in_client
+    other = repo.create_user("other", "x")
+    pid = repo.create_playlist(other, "Secret", "", False)
+    r = client.get(f"/playlist/{pid}/export/jsonl")
+    assert r.status_code in (302, 303)
+    assert b"Secret" not in r.data
+
+def test_asgi_prefetches_lastfm_on_event_loop(logged_in_client, monkeypatch):
+    import asyncio, importlib, sys, httpx
+    client, app_module, repo, user_id = logged_in_client
+    for m in ("lastfm_async", "asgi"):
+        sys.modules.pop(m, None)
+    asgi = importlib.import_module("asgi")
+    lastfm_async = importlib.import_module("lastfm_async")
+
+    # ถ้า view ยิง client sync แปลว่าไม่ได้ใช้ผลที่ prefetch ไว้
+    def sync_call(*args, **kwargs):
+        raise AssertionError("view should use prefetched data")
+    for name in ("similar_artists", "top_tracks_by_artist", "top_tracks_by_tag"):
+        monkeypatch.setattr(app_module.lastfm_client, name, sync_call)
+
+    upstream = []
+    def handler(request):
+        params = dict(request.url.params)
+        upstream.append(params["method"])
+        if params["method"] == "artist.getSimilar":
+            return httpx.Response(200, json={"similarartists": {"artist": [{"name": "BLACKPINK", "match": "0.7"}]}})
+        if params["method"] == "tag.getTopTracks":
+            return httpx.Response(200, json={"tracks": {"track": [{"name": "Hype Boy", "artist": {"name": "NewJeans"}}]}})
+        return httpx.Response(200, json={"toptracks": {"track": [{"name": "Cheer Up"}]}})
+
+    cookie = client.get_cookie("session").value
+
+    async def run():
+        asgi.application._alf = lastfm_async.AsyncLastFMClient(
+            app_module.lastfm_client, transport=httpx.MockTransport(handler))
+        transport = httpx.ASGITransport(app=asgi.application)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            anon = await http.get("/artist", params={"name": "TWICE"})
+        async with httpx.AsyncClient(transport=transport, base_url="http://test",
+                                     cookies={"session": cookie}) as http:
+            pages = await asyncio.gather(http.get("/artist", params={"name": "TWICE"}),
+                                         http.get("/tag/k-pop"))
+        await asgi.application._alf.aclose()
+        return anon, pages
+
+    anon, (artist, tag) = asyncio.run(run())
+    assert anon.status_code == 302      # ยังไม่ login -> redirect โดยไม่ยิง Last.fm
+    assert artist.status_code == 200 and tag.status_code == 200
+    assert "BLACKPINK" in artist.text and "Cheer Up" in artist.text
+    assert "Hype Boy" in tag.text
+    assert sorted(upstream) == ["artist.getSimilar", "artist.getTopTracks", "tag.getTopTracks"]
+
+def test_asgi_run_wsgi_app_override_matches_asgiref(logged_in_client):
+    # asgi.py แทน run_wsgi_app ของ asgiref ด้วยตัวที่ไม่ thread_sensitive; ถ้า asgiref เปลี่ยนรูปร่าง
+    # ของ method นี้ (อัปเกรดเวอร์ชัน) ต้องพังตรงนี้ ไม่ใช่ไปเงียบๆ กลับไปรันทีละ request
+    import importlib, inspect, sys
+    from asgiref.sync import SyncToAsync
+    from asgiref.wsgi import WsgiToAsgiInstance
+    original = WsgiToAsgiInstance.__dict__["run_wsgi_app"]
+    assert isinstance(original, SyncToAsync) and callable(original.func)
+    assert list(inspect.signature(original.func).parameters) == ["self", "body"]
+
+    sys.modules.pop("asgi", None)
+    asgi = importlib.import_module("asgi")
+    override = asgi._WsgiToAsgiInstance.__dict__["run_wsgi_app"]
+    assert override.func is original.func
+    assert override._thread_sensitive is False and override._executor is asgi._executor
@@ -0,0 +1,24 @@
+import threading
+
+from jobs import LocalJobQueue
+
+def test_local_queue_runs_handler_and_reports_errors():
+    q = LocalJobQueue(max_workers=2)
+    done = threading.Event()
+    seen, failed = [], []
+
+    def handler(job_id, n):
+        seen.append((job_id, n))
+        if n < 0:
+            raise ValueError("bad n")
+        done.set()
+
+    q.register("count", handler)
+    q.on_error = lambda job_id, e: failed.append((job_id, str(e)))
+    q.enqueue("count", "j1", n=3)
+    q.enqueue("count", "j2", n=-1)
+    q.shutdown(wait=True)
+
+    assert done.is_set()
+    assert sorted(seen) == [("j1", 3), ("j2", -1)]
+    assert failed == [("j2", "bad n")]
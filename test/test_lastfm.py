@@ -0,0 +1,445 @@
+import time
+
+import pytest
+from cache import MemoryCache
+from lastfm import LastFMClient
+
+class FakeResponse:
+    def __init__(self, payload, status_code=200, headers=None):
+        self.payload = payload
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.HTTPError(f"{self.status_code} error")
+
+    def json(self):
+        return self.payload
+
+def _fake_get(calls, payload):
+    def fake_get(url, params=None, timeout=None, **kwargs):
+        calls.append(dict(params))
+        return FakeResponse(payload)
+    return fake_get
+
+def test_tag_top_tracks_served_from_cache(monkeypatch):
+    calls = []
+    payload = {"tracks": {"track": [{"name": "Ditto", "artist": {"name": "NewJeans"}}]}}
+    client = LastFMClient(api_key="k", cache=MemoryCache())
+    monkeypatch.setattr(client.session, "get", _fake_get(calls, payload))
+
+    first = client.top_tracks_by_tag("k-pop", limit=10)
+    # ตัวพิมพ์/ช่องว่างต่างกันต้องได้ cache key เดียวกัน
+    second = client.top_tracks_by_tag(" K-Pop ", limit=10)
+
+    assert first == second
+    assert first[0]["title"] == "Ditto"
+    assert len(calls) == 1
+
+def test_zero_ttl_disables_cache(monkeypatch):
+    calls = []
+    client = LastFMClient(api_key="k", cache=MemoryCache(), ttls={"artist.getSimilar": 0})
+    monkeypatch.setattr(client.session, "get", _fake_get(calls, {"similarartists": {"artist": []}}))
+
+    client.similar_artists("TWICE")
+    client.similar_artists("TWICE")
+    assert len(calls) == 2
+
+def test_memory_cache_ttl_and_lru(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("cache.time.monotonic", lambda: now[0])
+    c = MemoryCache(max_entries=2)
+
+    c.set("a", 1, ttl=10)
+    c.set("b", 2, ttl=10)
+    assert c.get("a") == 1      # a ถูกใช้ล่าสุด -> b จะโดนไล่ออกก่อน
+    c.set("c", 3, ttl=10)
+    assert c.get("b") is None
+    assert c.get("a") == 1 and c.get("c") == 3
+
+    now[0] += 11
+    assert c.get("a") is None
+
+def test_session_pool_and_split_timeouts():
+    client = LastFMClient(api_key="k", cache=MemoryCache(), pool_size=4, connect_timeout=1.5, read_timeout=7)
+    adapter = client.session.get_adapter("https://ws.audioscrobbler.com/2.0/")
+    assert adapter._pool_maxsize == 4
+    assert client.timeout == (1.5, 7)
+    client.close()
+
+def test_gather_runs_concurrently_and_keeps_partial_results():
+    import threading, time
+    client = LastFMClient(api_key="k", cache=MemoryCache(), max_concurrency=4)
+    barrier = threading.Barrier(2, timeout=2)
+
+    def ok():
+        barrier.wait()      # ผ่านได้ก็ต่อเมื่ออีก call รันพร้อมกันอยู่
+        return ["ok"]
+
+    def boom():
+        barrier.wait()
+        raise RuntimeError("Last.fm error 6")
+
+    def slow():
+        time.sleep(1)
+        return ["late"]
+
+    results, errors = client.gather({"a": ok, "b": boom})
+    assert results == {"a": ["ok"]}
+    assert isinstance(errors["b"], RuntimeError)
+
+    results, errors = client.gather({"slow": slow}, timeout=0.05)
+    assert results == {}
+    assert isinstance(errors["slow"], TimeoutError)
+    client.close()
+
+def test_batch_tags_keyed_by_input_under_concurrency_cap(monkeypatch):
+    import threading, time
+    client = LastFMClient(api_key="k", cache=MemoryCache(), max_concurrency=2)
+    lock = threading.Lock()
+    active, peak, calls = [0], [0], []
+
+    def fake_get(url, params=None, timeout=None, **kwargs):
+        with lock:
+            calls.append(params["tag"])
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+        if params["tag"] == "bad":
+            return FakeResponse({"error": 6, "message": "Tag not found"})
+        return FakeResponse({"tracks": {"track": [{"name": params["tag"].upper(), "artist": {"name": "x"}}]}})
+
+    monkeypatch.setattr(client.session, "get", fake_get)
+    results, errors = client.top_tracks_by_tags(["pop", "rnb", "pop", "folk", "thai", "bad"], limit=5)
+
+    assert list(results) == ["pop", "rnb", "folk", "thai"]
+    assert results["rnb"][0]["title"] == "RNB"
+    assert isinstance(errors["bad"], RuntimeError)
+    assert sorted(calls) == sorted(["pop", "rnb", "folk", "thai", "bad"])     # "pop" ซ้ำยิงครั้งเดียว
+    assert peak[0] == 2
+    client.close()
+
+def test_warmer_refreshes_cache_until_stopped(monkeypatch):
+    calls = []
+    client = LastFMClient(api_key="k", cache=MemoryCache())
+    monkeypatch.setattr(client.session, "get", _fake_get(calls, {"tracks": {"track": []}}))
+
+    client.top_tracks_by_tag("pop", limit=24)
+    assert client.warm_tags(["pop", "rnb"], limit=24) == {}
+    assert len(calls) == 2                  # "pop" ยังสดใน cache -> ไม่ดึงซ้ำ
+    client.top_tracks_by_tag("rnb", limit=24)
+    assert len(calls) == 2                  # คลิกแรกหลัง warm ได้จาก cache
+    assert client.warm_tags(["pop"], limit=24, force=True) == {}
+    assert len(calls) == 3
+
+    # worker อื่นที่ใช้ cache เดียวกัน (Redis) ไม่ดึงซ้ำ จนกว่า entry ใกล้หมดอายุ
+    other = LastFMClient(api_key="k", cache=client.cache)
+    monkeypatch.setattr(other.session, "get", _fake_get(calls, {"tracks": {"track": []}}))
+    assert other.warm_tags(["pop", "rnb"], limit=24) == {}
+    assert len(calls) == 3
+    real_time = time.time
+    monkeypatch.setattr("lastfm.time.time", lambda: real_time() + 0.95 * other._ttl(other._tag_params("pop", 24)))
+    assert other.warm_tags(["pop", "rnb"], limit=24) == {}
+    assert len(calls) == 5
+    monkeypatch.setattr("lastfm.time.time", real_time)
+    other.close()
+
+    # interval ค่าเริ่มต้น = 90% ของ TTL -> entry ใกล้หมดอายุทุกรอบ ถูกดึงใหม่
+    client.ttls["tag.getTopTracks"] = 0.05
+    stop = client.start_warmer(["folk"], limit=24)
+    deadline = time.monotonic() + 2
+    while sum(c["tag"] == "folk" for c in calls) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stop.set()
+    assert sum(c["tag"] == "folk" for c in calls) >= 2
+    client.close()
+
+def test_token_bucket_limits_rate_and_penalty(monkeypatch):
+    from ratelimit import RateLimitExceeded, TokenBucket
+    now = [0.0]
+    monkeypatch.setattr("ratelimit.time.monotonic", lambda: now[0])
+    monkeypatch.setattr("ratelimit.time.sleep", lambda s: now.__setitem__(0, now[0] + s))
+    bucket = TokenBucket(rate=2, burst=2)
+
+    assert bucket.acquire(max_wait=0) == 0
+    assert bucket.acquire(max_wait=0) == 0
+    assert abs(bucket.acquire(max_wait=1) - 0.5) < 1e-9   # token ถัดไปอีก 0.5 วินาที
+
+    bucket.penalize(3)
+    import pytest
+    with pytest.raises(RateLimitExceeded):
+        bucket.acquire(max_wait=1)
+
+def test_parse_retry_after_seconds_and_http_date():
+    from datetime import datetime, timedelta, timezone
+    from email.utils import format_datetime
+    from ratelimit import _Bucket, parse_retry_after
+
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("1.5") == 1.5
+    assert parse_retry_after("-3") == 0
+    assert parse_retry_after(None) is None and parse_retry_after("soon", default=1.0) == 1.0
+    later = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 <= parse_retry_after(later) <= 30
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0      # ผ่านไปแล้ว
+    with pytest.raises(TypeError):
+        _Bucket()
+
+def test_retries_rate_limit_and_5xx_with_backoff(monkeypatch):
+    class Limiter:
+        penalties = []
+        def acquire(self, max_wait):
+            return 0.0
+        def penalize(self, seconds):
+            self.penalties.append(seconds)
+
+    sleeps = []
+    monkeypatch.setattr("lastfm.time.sleep", sleeps.append)
+    limiter = Limiter()
+    client = LastFMClient(api_key="k", cache=MemoryCache(), rate_limiter=limiter, max_retries=2, backoff_base=0.1)
+    responses = [FakeResponse({"error": 29, "message": "Rate Limit Exceeded"}),
+                 FakeResponse({}, status_code=503),
+                 FakeResponse({"tracks": {"track": [{"name": "Ditto", "artist": {"name": "NewJeans"}}]}})]
+    monkeypatch.setattr(client.session, "get", lambda *a, **kw: responses.pop(0))
+
+    assert client.top_tracks_by_tag("k-pop")[0]["title"] == "Ditto"
+    assert len(sleeps) == 2 and all(0 <= s <= 0.4 for s in sleeps)
+    assert client.stats["retried"] == 2
+    assert client.stats["rate_limited"] == 1
+    assert limiter.penalties == [0.1]          # error 29 -> หยุดทุก worker ที่ใช้ bucket เดียวกันด้วย
+    assert client.stats["requests"] == 3
+
+    # error อื่น (เช่น 6 = ไม่พบ) ไม่ retry; retry ครบแล้วยังพังก็ raise error เดิม
+    monkeypatch.setattr(client.session, "get", lambda *a, **kw: FakeResponse({"error": 6, "message": "nope"}))
+    import pytest
+    with pytest.raises(RuntimeError, match="error 6"):
+        client.top_tracks_by_tag("unknown")
+    assert client.stats["retried"] == 2
+    monkeypatch.setattr(client.session, "get", lambda *a, **kw: FakeResponse({}, status_code=502))
+    with pytest.raises(Exception):
+        client.top_tracks_by_tag("down")
+    assert client.stats["retried"] == 4
+    client.close()
+
+def test_redis_bucket_falls_back_to_local_when_redis_is_down():
+    from ratelimit import RedisTokenBucket
+
+    class DownRedis:
+        def register_script(self, lua):
+            def run(keys, args):
+                raise ConnectionError("redis down")
+            return run
+
+    bucket = RedisTokenBucket(DownRedis(), rate=1, burst=1)
+    assert bucket.acquire(max_wait=0) == 0
+    assert bucket._take() > 0          # bucket ใน process ถูกใช้แทน
+
+def test_circuit_breaker_opens_then_half_opens(monkeypatch):
+    from circuit import CircuitBreaker
+    now = [0.0]
+    monkeypatch.setattr("circuit.time.monotonic", lambda: now[0])
+    b = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+
+    b.record_failure()
+    assert b.allow()
+    b.record_failure()
+    assert b.state == "open" and not b.allow()
+
+    now[0] += 10
+    assert b.allow()            # half-open: ลองได้ 1 call
+    assert not b.allow()
+    b.record_failure()          # ลองแล้วพัง -> เปิดอีกรอบ
+    assert not b.allow()
+
+    now[0] += 10
+    assert b.allow()
+    b.record_success()
+    assert b.state == "closed" and b.allow()
+
+def test_stale_result_served_while_refreshing_and_breaker_fails_fast(monkeypatch):
+    import time
+    import requests
+    from circuit import CircuitBreaker
+    clock = [1000.0]
+    monkeypatch.setattr("lastfm.time.time", lambda: clock[0])
+    client = LastFMClient(api_key="k", cache=MemoryCache(), max_retries=0, ttls={"tag.getTopTracks": 60},
+                          breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+    calls = []
+    monkeypatch.setattr(client.session, "get", _fake_get(calls, {"tracks": {"track": [{"name": "Ditto", "artist": {"name": "NewJeans"}}]}}))
+    fresh = client.top_tracks_by_tag("k-pop")
+    assert not getattr(fresh, "stale", False)
+
+    def down(*a, **kw):
+        calls.append("down")
+        raise requests.ConnectionError("Last.fm down")
+    monkeypatch.setattr(client.session, "get", down)
+    clock[0] += 61
+
+    stale = client.top_tracks_by_tag("k-pop")
+    assert stale.stale and stale[0]["title"] == "Ditto"
+    deadline = time.monotonic() + 2
+    while "down" not in calls and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert "down" in calls                  # refresh เบื้องหลังถูกยิงแล้ว
+
+    # ไม่มีของใน cache: พังติดกันจน circuit เปิด -> call ถัดไปไม่ยิงเลย
+    for tag in ("a", "b"):
+        try:
+            client.top_tracks_by_tag(tag)
+        except Exception:
+            pass
+    n = len(calls)
+    import pytest
+    with pytest.raises(RuntimeError, match="circuit open"):
+        client.top_tracks_by_tag("c")
+    assert len(calls) == n
+    assert client.top_tracks_by_tag("k-pop").stale     # ของ stale ยังตอบได้ตอน circuit เปิด
+    assert client.stats["short_circuited"] >= 1
+    client.close()
+
+def test_cache_returns_copies_and_is_keyed_per_api_key(monkeypatch):
+    shared = MemoryCache()
+    calls = []
+    payload = {"similarartists": {"artist": [{"name": "ITZY", "match": "0.9"}]}}
+    a = LastFMClient(api_key="key-a", cache=shared)
+    b = LastFMClient(api_key="key-b", cache=shared)
+    monkeypatch.setattr(a.session, "get", _fake_get(calls, payload))
+    monkeypatch.setattr(b.session, "get", _fake_get(calls, payload))
+
+    first = a.similar_artists("TWICE")
+    first.clear()                              # caller แก้ list ที่ได้ไป ไม่กระทบ cache
+    assert a.similar_artists("TWICE")[0]["name"] == "ITZY"
+    assert len(calls) == 1
+
+    b.similar_artists("TWICE")                 # API key อื่น -> ไม่ใช้ entry ของ a
+    assert len(calls) == 2
+    assert all("key-a" not in k and "key-b" not in k for k in shared._data)
+    a.close(); b.close()
+
+def test_memory_cache_byte_budget_and_stats():
+    c = MemoryCache(max_entries=100, max_bytes=50)
+    c.set("a", "x" * 20, ttl=10)               # '"xxx..."' = 22 bytes
+    c.set("b", "y" * 20, ttl=10)
+    c.set("c", "z" * 20, ttl=10)               # เกิน 50 bytes -> "a" ถูกไล่ออก
+    c.set("huge", "h" * 100, ttl=10)           # ใหญ่กว่างบทั้งหมด -> ไม่เก็บ
+    value = c.get("b")
+    assert c.get("a") is None and c.get("huge") is None and value == "y" * 20
+
+    stats = c.stats()
+    assert stats["entries"] == 2 and stats["bytes"] == 44
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 1 and stats["misses"] == 2
+
+def test_async_client_shares_cache_retries_and_gathers(monkeypatch):
+    import asyncio, importlib, httpx
+    import lastfm_async
+    importlib.reload(lastfm_async)      # ให้ชี้ไปที่ lastfm ใน sys.modules ตอนนี้ (test อื่น reload ไว้)
+    monkeypatch.setattr("lastfm.random.uniform", lambda a, b: 0)
+    client = lastfm_async.LastFMClient(api_key="k", cache=MemoryCache(), max_retries=1)
+    seen = []
+
+    def handler(request):
+        params = dict(request.url.params)
+        seen.append(params["method"])
+        if params["method"] == "artist.getSimilar" and seen.count("artist.getSimilar") == 1:
+            return httpx.Response(503)
+        if params["method"] == "artist.getSimilar":
+            return httpx.Response(200, json={"similarartists": {"artist": [{"name": "ITZY", "match": "0.8"}]}})
+        return httpx.Response(200, json={"toptracks": {"track": [{"name": "FANCY"}]}})
+
+    async def run():
+        alf = lastfm_async.AsyncLastFMClient(client, transport=httpx.MockTransport(handler))
+        try:
+            return await alf.gather({
+                "similar": alf.similar_artists("TWICE"),
+                "top_tracks": alf.top_tracks_by_artist("TWICE"),
+                "slow": asyncio.sleep(5),
+            }, timeout=0.5)
+        finally:
+            await alf.aclose()
+
+    results, errors = asyncio.run(run())
+    assert results["similar"][0]["name"] == "ITZY" and results["similar"][0]["match"] == 0.8
+    assert results["top_tracks"] == [{"title": "FANCY", "artist": "TWICE", "url": None, "mbid": None}]
+    assert isinstance(errors["slow"], TimeoutError)
+    assert client.stats["retried"] == 1 and client.breaker.state == "closed"
+
+    # ผลที่ได้ถูกเก็บใน cache ของ client sync ตัวเดียวกัน
+    monkeypatch.setattr(client.session, "get", lambda *a, **kw: pytest.fail("should be cached"))
+    assert client.top_tracks_by_artist("TWICE") == results["top_tracks"]
+    client.close()
+
+def test_async_client_keeps_blocking_cache_and_limiter_off_the_loop():
+    import asyncio, importlib, threading, httpx
+    import lastfm_async
+    import ratelimit
+    importlib.reload(lastfm_async)
+    threads = []
+
+    class SlowCache:                      # แทน RedisCache: ไม่ใช่ MemoryCache = อาจบล็อก
+        def __init__(self):
+            self.inner = MemoryCache()
+
+        def get(self, key):
+            threads.append(threading.get_ident())
+            return self.inner.get(key)
+
+        def set(self, key, value, ttl):
+            self.inner.set(key, value, ttl)
+
+    class Bucket(ratelimit.RedisTokenBucket):
+        def __init__(self):
+            self.rate, self.burst = 5.0, 10
+
+        def _take(self):
+            threads.append(threading.get_ident())
+            return 0.0
+
+    client = lastfm_async.LastFMClient(api_key="k", cache=SlowCache(), rate_limiter=Bucket())
+    handler = lambda request: httpx.Response(200, json={"toptracks": {"track": [{"name": "FANCY"}]}})
+
+    async def run():
+        alf = lastfm_async.AsyncLastFMClient(client, transport=httpx.MockTransport(handler))
+        try:
+            await alf.top_tracks_by_artist("TWICE")
+            return threading.get_ident()
+        finally:
+            await alf.aclose()
+
+    loop_thread = asyncio.run(run())
+    assert len(threads) == 2 and loop_thread not in threads
+    client.close()
+
+def test_client_against_stub_fixtures_and_injected_errors(monkeypatch):
+    from bench.stub_upstream import start_stub
+    from metrics import UPSTREAM_REQUESTS, UPSTREAM_SECONDS
+    monkeypatch.setattr("lastfm.time.sleep", lambda s: None)
+    before_500 = UPSTREAM_REQUESTS.value(service="lastfm", endpoint="tag.getTopTracks", status="500")
+    before_similar = UPSTREAM_SECONDS.count(service="lastfm", endpoint="artist.getSimilar")
+    ok = start_stub(latency_ms=0)
+    bad = start_stub(error_rate=1.0, errors=["500"], seed=1)
+    try:
+        client = LastFMClient(api_key="k", cache=MemoryCache(), base_url=f"http://127.0.0.1:{ok.server_port}/2.0/",
+                              max_retries=1)
+        tracks = client.top_tracks_by_artist("IVE", limit=5)
+        similar = client.similar_artists("IVE", limit=3)
+        assert len(tracks) == 5 and all(t["artist"] == "IVE" for t in tracks)
+        assert len(similar) == 3 and similar[0]["match"] >= similar[-1]["match"]
+
+        failing = LastFMClient(api_key="k", cache=MemoryCache(), base_url=f"http://127.0.0.1:{bad.server_port}/2.0/",
+                               max_retries=1)
+        with pytest.raises(Exception, match="500"):
+            failing.top_tracks_by_tag("pop")
+        assert bad.hits["error:500"] == 2       # ครั้งแรก + retry 1 ครั้ง
+        # metrics นับทุกครั้งที่ยิงจริง (รวม retry) แยกตาม method + status
+        assert UPSTREAM_REQUESTS.value(service="lastfm", endpoint="tag.getTopTracks", status="500") == before_500 + 2
+        assert UPSTREAM_SECONDS.count(service="lastfm", endpoint="artist.getSimilar") == before_similar + 1
+        client.close()
+        failing.close()
+    finally:
+        ok.shutdown()
+        bad.shutdown()
@@ -0,0 +1,98 @@
+import re
+
+import pytest
+from sqlalchemy import event
+
+from models import Track
+
+# ชื่อตาราง/alias จริง: "SCAN <ชื่อพวกนี้>" = full table scan
+# (SCAN ของ subquery/CONSTANT ROW/ตาราง materialize ชั่วคราวไม่นับ)
+TABLES = {"schema_version", "users", "user_pref", "playlist", "playlists", "playlist_tracks", "user_tokens",
+          "spotify_track_uris", "jobs", "user_stats", "user_artist_counts", "p", "t"}
+
+def _exercise(repo):
+    """เรียกทุก method ของ repository อย่างน้อย 1 ครั้ง; คืนชื่อ method ที่เรียกไป"""
+    called = set()
+
+    def call(name, *args, **kwargs):
+        called.add(name)
+        return getattr(repo, name)(*args, **kwargs)
+
+    call("schema_version")
+    uid = call("create_user", "u", "pw")
+    call("get_user_by_username", "u")
+    call("get_user_by_id", uid)
+    with call("unit_of_work"):
+        call("get_user_by_id", uid)
+    pid = call("create_playlist", uid, "p", "", False)
+    call("insert_playlist_track", pid, Track(title="a", artist="x"))
+    call("insert_playlist_tracks", pid, [Track(title=c, artist="y") for c in "bcd"])
+    call("insert_playlist_track", pid, Track(title="e", artist="z"), index=1)
+    tracks = call("fetch_playlist_tracks", pid, uid)
+    call("fetch_playlist_tracks", pid, uid, limit=2)
+    call("fetch_playlist_tracks", pid, uid, limit=2, after=(tracks[1]["position"], tracks[1]["id"]))
+    list(call("iter_playlist_tracks", pid, uid))
+    call("move_track_to", pid, tracks[-1]["id"], 0, uid)
+    call("reorder_track", pid, tracks[0]["id"], "down", uid)
+    call("reorder_track", pid, tracks[1]["id"], "up", uid)
+    call("renumber_positions", pid)
+    call("list_playlists", uid)
+    call("get_playlist", pid, uid)
+    call("update_playlist_meta", pid, uid, "n", "d", True)
+    token = call("ensure_share_token", pid, uid)
+    call("get_public_playlist_by_token", token)
+    call("delete_playlist_track", pid, tracks[0]["id"], uid)
+    call("get_default_genre", uid)
+    call("set_default_genre", uid, "rock")
+    call("upsert_user_token", uid, "spotify", "at", None, None)
+    call("get_user_token", uid, "spotify")
+    call("list_playlists_with_counts", uid)
+    call("get_user_music_stats", uid)
+    call("save_spotify_uris", {("a", "x"): "spotify:track:1"})
+    call("get_spotify_uris", [("a", "x")])
+    job = call("create_job", uid, "k")
+    call("update_job", job, status="done")
+    call("get_job", job, uid)
+    call("clear_playlist_tracks", pid, uid)
+    call("delete_playlist", pid, uid)
+    return called
+
+def test_repository_queries_do_not_scan_tables(tmp_db_path):
+    from storage import StorageRepository
+    repo = StorageRepository(f"sqlite:///{tmp_db_path}")
+
+    statements = {}
+    def capture(conn, cursor, statement, params, context, executemany):
+        statements.setdefault(statement, params[0] if executemany else params)
+    event.listen(repo.engine, "before_cursor_execute", capture)
+    called = _exercise(repo)
+    event.remove(repo.engine, "before_cursor_execute", capture)
+    # ตรวจ/สร้างตัวนับใหม่ทั้งตาราง (CLI) สแกนทุกแถวโดยตั้งใจ -> เรียกนอกช่วงที่ตรวจ plan
+    for name in ("check_counters", "rebuild_counters"):
+        getattr(repo, name)()
+        called.add(name)
+
+    # method ใหม่ใน repository ต้องถูกเพิ่มเข้า _exercise ด้วย
+    public = {name for name in dir(repo)
+              if not name.startswith("_") and callable(getattr(repo, name)) and name.islower()}
+    assert public <= called, f"not covered by the query-plan test: {sorted(public - called)}"
+
+    scans = []
+    with repo.engine.connect() as conn:
+        for sql, params in statements.items():
+            if sql.lstrip().upper().startswith(("PRAGMA", "BEGIN", "COMMIT", "ROLLBACK")):
+                continue
+            plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            for row in plan:
+                m = re.match(r"SCAN (\w+)", row[-1])
+                if m and m.group(1) in TABLES:
+                    scans.append(f"{' '.join(sql.split())[:120]}  ->  {row[-1]}")
+    assert not scans, "full table scans:\n" + "\n".join(scans)
+
+@pytest.mark.parametrize("index", ["ix_playlist_tracks_playlist_position", "ix_playlists_user_updated", "ix_playlist_user"])
+def test_indexes_created_by_migration(tmp_db_path, index):
+    from storage import StorageRepository
+    repo = StorageRepository(f"sqlite:///{tmp_db_path}")
+    with repo.engine.connect() as conn:
+        names = {r[0] for r in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type='index'")}
+    assert index in names
@@ -1,8 +1,8 @@
 from models import Track
 
-def test_storage_crud(tmp_db_path):
+def test_storage_crud(db_url):
     from storage import StorageRepository
-    repo = StorageRepository(f"sqlite:///{tmp_db_path}")
+    repo = StorageRepository(db_url)
 
     uid = repo.create_user("u1", "pw")
     pid = repo.create_playlist(uid, "P1", "d", False)
@@ -32,3 +32,262 @@ def test_storage_crud(tmp_db_path):
     # delete playlist
     ok = repo.delete_playlist(pid, uid)
     assert ok
+
+def test_spotify_uri_cache_roundtrip(db_url):
+    from storage import StorageRepository
+    repo = StorageRepository(db_url)
+
+    repo.save_spotify_uris({("Ditto", "NewJeans"): "spotify:track:1", ("FANCY", "TWICE"): "spotify:track:2"})
+    # key ไม่สนตัวพิมพ์/ช่องว่าง แต่คืนค่าตาม key ที่ส่งเข้าไป
+    got = repo.get_spotify_uris([(" ditto ", "NEWJEANS"), ("FANCY", "TWICE"), ("Nope", "X")])
+    assert got == {(" ditto ", "NEWJEANS"): "spotify:track:1", ("FANCY", "TWICE"): "spotify:track:2"}
+
+    repo.save_spotify_uris({("FANCY", "TWICE"): "spotify:track:3"})
+    assert repo.get_spotify_uris([("FANCY", "TWICE")]) == {("FANCY", "TWICE"): "spotify:track:3"}
+
+def test_bulk_insert_appends_in_order(db_url):
+    from storage import StorageRepository
+    from models import PlaylistManager
+    repo = StorageRepository(db_url)
+    manager = PlaylistManager(repo)
+
+    uid = repo.create_user("u1", "pw")
+    pid = repo.create_playlist(uid, "P1", "", False)
+    repo.insert_playlist_track(pid, Track(title="first", artist="X"))
+
+    n = manager.add_tracks(pid, [Track(title=f"T{i}", artist="Y") for i in range(5)])
+    assert n == 5
+    assert manager.add_tracks(pid, []) == 0
+
+    tracks = repo.fetch_playlist_tracks(pid, user_id=uid)
+    assert [t["title"] for t in tracks] == ["first", "T0", "T1", "T2", "T3", "T4"]
+    positions = [t["position"] for t in tracks]
+    assert positions == sorted(set(positions))
+
+def test_move_and_insert_at_index_with_renumbering(db_url):
+    from storage import StorageRepository
+    repo = StorageRepository(db_url)
+    uid = repo.create_user("u1", "pw")
+    pid = repo.create_playlist(uid, "P1", "", False)
+    repo.insert_playlist_tracks(pid, [Track(title=t, artist="X") for t in "ABCDE"])
+
+    def titles():
+        return "".join(t["title"] for t in repo.fetch_playlist_tracks(pid, user_id=uid))
+
+    ids = {t["title"]: t["id"] for t in repo.fetch_playlist_tracks(pid, user_id=uid)}
+    assert repo.move_track_to(pid, ids["E"], 0, user_id=uid)
+    assert titles() == "EABCD"
+    repo.move_track_to(pid, ids["E"], 2, user_id=uid)
+    assert titles() == "ABECD"
+    repo.move_track_to(pid, ids["A"], 99, user_id=uid)      # เกินจำนวน -> ท้ายสุด
+    assert titles() == "BECDA"
+    assert not repo.move_track_to(pid, 12345, 0, user_id=uid)
+
+    repo.insert_playlist_track(pid, Track(title="F", artist="X"), index=1)
+    assert titles() == "BFECDA"
+
+    # แทรกที่ลำดับเดิมซ้ำๆ จนช่องว่างหมด -> ต้อง renumber เองและลำดับยังถูกต้อง
+    for i in range(15):
+        repo.insert_playlist_track(pid, Track(title=chr(ord("a") + i), artist="X"), index=1)
+    assert titles() == "B" + "onmlkjihgfedcba" + "FECDA"
+    positions = [t["position"] for t in repo.fetch_playlist_tracks(pid, user_id=uid)]
+    assert len(set(positions)) == len(positions)
+
+def test_migrations_run_once_and_move_legacy_rows(tmp_db_path):
+    import sqlite3
+    from storage import StorageRepository
+
+    # DB รุ่นเก่า: มีแต่ตาราง users + playlist (legacy)
+    raw = sqlite3.connect(tmp_db_path)
+    raw.executescript("""
+        CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL,
+                            password_hash TEXT NOT NULL, created_at TEXT NOT NULL);
+        CREATE TABLE playlist (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+                               title TEXT NOT NULL, artist TEXT NOT NULL, url TEXT, mbid TEXT,
+                               added_at TEXT NOT NULL);
+        INSERT INTO users (username, password_hash, created_at) VALUES ('a', 'x', 'now'), ('b', 'x', 'now');
+        INSERT INTO playlist (user_id, title, artist, added_at) VALUES
+            (1, 'A1', 'X', 't'), (2, 'B1', 'Y', 't'), (1, 'A2', 'X', 't'), (1, 'A3', 'Z', 't');
+    """)
+    raw.commit()
+    raw.close()
+
+    repo = StorageRepository(f"sqlite:///{tmp_db_path}")
+    assert repo.schema_version() == StorageRepository.MIGRATIONS[-1][0]
+
+    pl_a = repo.list_playlists(1)
+    pl_b = repo.list_playlists(2)
+    assert [p["name"] for p in pl_a] == ["My Playlist"] and len(pl_b) == 1
+    assert [t["title"] for t in repo.fetch_playlist_tracks(pl_a[0]["id"], 1)] == ["A1", "A2", "A3"]
+    assert [t["title"] for t in repo.fetch_playlist_tracks(pl_b[0]["id"], 2)] == ["B1"]
+
+    # บูตซ้ำต้องไม่ย้ายซ้ำ
+    repo2 = StorageRepository(f"sqlite:///{tmp_db_path}")
+    assert len(repo2.list_playlists(1)) == 1
+    assert len(repo2.fetch_playlist_tracks(pl_a[0]["id"], 1)) == 3
+    with repo2.engine.connect() as conn:
+        applied = [r[0] for r in conn.exec_driver_sql("SELECT version FROM schema_version ORDER BY version")]
+    assert applied == [v for v, _ in StorageRepository.MIGRATIONS]
+
+def test_sqlite_production_profile_applied_per_connection(tmp_db_path):
+    from storage import StorageRepository
+    repo = StorageRepository(f"sqlite:///{tmp_db_path}", sqlite_profile="production",
+                             sqlite_pragmas={"busy_timeout": 1234})
+    with repo.engine.connect() as conn:
+        get = lambda name: conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+        assert get("journal_mode").lower() == "wal"
+        assert get("synchronous") == 1          # NORMAL
+        assert get("busy_timeout") == 1234
+        assert get("foreign_keys") == 1
+        assert get("temp_store") == 2           # MEMORY
+
+def test_sqlite_profile_can_be_switched_by_env(tmp_db_path, monkeypatch):
+    import pytest
+    from storage import StorageRepository
+    monkeypatch.setenv("SQLITE_PROFILE", "default")
+    repo = StorageRepository(f"sqlite:///{tmp_db_path}")
+    with repo.engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar().lower() == "delete"
+    with pytest.raises(ValueError):
+        StorageRepository(f"sqlite:///{tmp_db_path}", sqlite_profile="turbo")
+
+def test_unit_of_work_shares_one_connection_and_skips_commit_for_reads(db_url):
+    from sqlalchemy import event
+    from storage import StorageRepository
+    repo = StorageRepository(db_url)
+    uid = repo.create_user("u", "pw")
+    pid = repo.create_playlist(uid, "p", "", False)
+
+    checkouts, commits = [], []
+    event.listen(repo.engine.pool, "checkout", lambda *a: checkouts.append(1))
+    event.listen(repo.engine, "commit", lambda conn: commits.append(1))
+
+    with repo.unit_of_work():
+        repo.get_user_by_id(uid)
+        repo.list_playlists(uid)
+        repo.get_default_genre(uid)
+        repo.fetch_playlist_tracks(pid, uid)
+    assert len(checkouts) == 1
+    assert commits == []
+
+    # write ใน unit of work: commit ทันที (อ่านจาก connection อื่นก็เห็น)
+    with repo.unit_of_work():
+        repo.list_playlists(uid)
+        repo.insert_playlist_track(pid, Track(title="A", artist="X"))
+        assert commits == [1]
+        with repo.engine.connect() as other:
+            assert other.exec_driver_sql("SELECT COUNT(*) FROM playlist_tracks").scalar() == 1
+    assert len(checkouts) == 3      # unit of work + connection "other"
+
+    # นอก unit of work: แต่ละ call ใช้ connection ของตัวเองเหมือนเดิม
+    repo.get_user_by_id(uid)
+    repo.list_playlists(uid)
+    assert len(checkouts) == 5
+
+def test_failed_write_in_unit_of_work_rolls_back(db_url):
+    import pytest
+    from storage import StorageRepository
+    repo = StorageRepository(db_url)
+    uid = repo.create_user("u", "pw")
+    other = repo.create_user("v", "pw")
+    pid = repo.create_playlist(uid, "p", "", False)
+    repo.insert_playlist_track(pid, Track(title="A", artist="X"))
+    with repo.unit_of_work():
+        with pytest.raises(PermissionError):
+            repo.clear_playlist_tracks(pid, other)
+        assert len(repo.fetch_playlist_tracks(pid, uid)) == 1
+
+def test_pool_options_per_backend(monkeypatch):
+    from storage import _pool_options
+    monkeypatch.delenv("DB_POOL_SIZE", raising=False)
+    monkeypatch.setenv("THREADS", "4")
+    assert _pool_options("sqlite:///music.db")["pool_size"] == 6
+    assert _pool_options("sqlite://") == {}
+    pg = _pool_options("postgresql+psycopg2://u:p@db/music")
+    assert pg["pool_pre_ping"] is True and pg["pool_size"] == 5
+    monkeypatch.setenv("DB_POOL_SIZE", "20")
+    assert _pool_options("postgresql+psycopg2://u:p@db/music")["pool_size"] == 20
+
+def test_default_genre_row_recreated_once(db_url):
+    from sqlalchemy import text
+    from storage import StorageRepository
+    repo = StorageRepository(db_url)
+    uid = repo.create_user("u", "pw")
+    with repo.engine.begin() as conn:
+        conn.execute(text("DELETE FROM user_pref WHERE user_id=:u"), {"u": uid})
+    assert repo.get_default_genre(uid) == "pop"
+    repo.set_default_genre(uid, "jazz")
+    assert repo.get_default_genre(uid) == "jazz"
+    assert repo.schema_version() == StorageRepository.MIGRATIONS[-1][0]
+
+def test_counters_follow_mutations_and_rebuild_fixes_drift(db_url):
+    from storage import StorageRepository
+    repo = StorageRepository(db_url)
+    uid = repo.create_user("u1", "pw")
+    p1 = repo.create_playlist(uid, "P1", "", False)
+    p2 = repo.create_playlist(uid, "P2", "", True)
+    repo.insert_playlist_tracks(p1, [Track(title=t, artist="X") for t in "ab"] + [Track(title="c", artist="Y")])
+    repo.insert_playlist_track(p2, Track(title="d", artist="Z"))
+    repo.insert_playlist_track(p2, Track(title="e", artist="X"))
+    assert repo.get_user_music_stats(uid) == {"total_tracks": 5, "unique_artists": 3,
+                                              "public_playlists": 1, "private_playlists": 1}
+    assert {p["id"]: p["track_count"] for p in repo.list_playlists_with_counts(uid)} == {p1: 3, p2: 2}
+
+    # ลบเพลงสุดท้ายของ Y -> ศิลปินไม่ซ้ำลดลง; X ยังเหลือใน P2
+    y = next(t for t in repo.fetch_playlist_tracks(p1, uid) if t["artist"] == "Y")
+    repo.delete_playlist_track(p1, y["id"], uid)
+    repo.clear_playlist_tracks(p1, uid)
+    repo.ensure_share_token(p1, uid)
+    assert repo.get_user_music_stats(uid) == {"total_tracks": 2, "unique_artists": 2,
+                                              "public_playlists": 2, "private_playlists": 0}
+    repo.update_playlist_meta(p2, uid, "P2", "", False)
+    repo.delete_playlist(p1, uid)
+    p3 = repo.create_playlist(uid, "P3", "", True)
+    repo.insert_playlist_tracks(p3, [Track(title="f", artist="W"), Track(title="g", artist="X")])
+    repo.delete_playlist(p3, uid)          # ลบทั้งเพลย์ลิสต์ที่ยังมีเพลง -> ตัวนับลดตามเพลงที่ถูกลบ
+    assert repo.get_user_music_stats(uid) == {"total_tracks": 2, "unique_artists": 2,
+                                              "public_playlists": 0, "private_playlists": 1}
+    assert repo.check_counters() == {"playlists": 0, "user_artist_counts": 0, "user_stats": 0}
+
+    with repo.engine.begin() as conn:
+        conn.exec_driver_sql("UPDATE playlists SET track_count = 99")
+        conn.exec_driver_sql("DELETE FROM user_artist_counts")
+    drift = repo.check_counters()
+    assert drift["playlists"] == 1 and drift["user_artist_counts"] == 2 and drift["user_stats"] == 0
+    repo.rebuild_counters()
+    assert repo.check_counters() == {"playlists": 0, "user_artist_counts": 0, "user_stats": 0}
+    assert repo.list_playlists_with_counts(uid)[0]["track_count"] == 2
+
+def test_reorder_with_tied_positions_moves_the_adjacent_track(db_url):
+    from storage import StorageRepository
+    from sqlalchemy import text
+    repo = StorageRepository(db_url)
+    uid = repo.create_user("u", "pw")
+    pid = repo.create_playlist(uid, "P", "", False)
+    repo.insert_playlist_tracks(pid, [Track(title=t, artist="A") for t in "abc"])
+    with repo.engine.begin() as conn:       # position ซ้ำกันทั้งหมด (ลำดับมาจาก id)
+        conn.execute(text("UPDATE playlist_tracks SET position = 0 WHERE playlist_id=:pid"), {"pid": pid})
+    ids = {t["title"]: t["id"] for t in repo.fetch_playlist_tracks(pid, uid)}
+
+    repo.reorder_track(pid, ids["b"], "down", uid)
+    assert [t["title"] for t in repo.fetch_playlist_tracks(pid, uid)] == ["a", "c", "b"]
+    repo.reorder_track(pid, ids["c"], "up", uid)
+    assert [t["title"] for t in repo.fetch_playlist_tracks(pid, uid)] == ["c", "a", "b"]
+
+def test_keyset_pages_cover_playlist_in_order(db_url):
+    from storage import StorageRepository
+    repo = StorageRepository(db_url)
+    uid = repo.create_user("u1", "pw")
+    pid = repo.create_playlist(uid, "P1", "", False)
+    repo.insert_playlist_tracks(pid, [Track(title=f"T{i}", artist="X") for i in range(7)])
+    repo.insert_playlist_track(pid, Track(title="first", artist="X"), index=0)
+
+    seen, after = [], None
+    while True:
+        page = repo.fetch_playlist_tracks(pid, uid, limit=3, after=after)
+        seen += [t["title"] for t in page]
+        if len(page) < 3:
+            break
+        after = (page[-1]["position"], page[-1]["id"])
+    assert seen == [t["title"] for t in repo.fetch_playlist_tracks(pid, uid)]
+    assert seen[0] == "first" and len(seen) == 8